@@ -0,0 +1,209 @@
+# Stoichometry
+# batch.py
+#
+# This file contains functions for headless ("Auto") batch stoichiometry
+# calculations over many dataset files, using a pool of worker processes.
+#
+# Usage:
+#   python batch.py DATA_DIR_OR_GLOB [...] --system NAME [--assign PATTERN=NAME ...]
+#                   [--output-dir DIR] [--workers N] [--delimiter tab|comma] [--chunksize ROWS]
+#
+
+import argparse
+import concurrent.futures
+import fnmatch
+import glob
+import os
+import time
+import pandas as pd
+import util
+import stoich_calc
+import engine
+
+# Extension of results files.
+results_ext = '.stoichres'
+delimiters = {'tab':'\t','comma':','}
+
+# Per-process state of batch workers, loaded once by init_worker.
+worker_sram_lib = None
+worker_min_systems = None
+worker_workspace = None
+
+# init_worker function.
+def init_worker(nist,patch,snapshot,minsys_dir):
+  '''
+  Loads the SRAM library and mineral systems once for each worker process, and
+  creates its CationWorkspace (see stoich_calc.calc_cations_per_formula_unit).
+  '''
+  global worker_sram_lib, worker_min_systems, worker_workspace
+  worker_sram_lib = util.load_sram_library(nist,patch,engine.sram_snapshot_path(nist,patch,snapshot))
+  worker_min_systems = util.load_mineral_systems(minsys_dir)
+  worker_workspace = stoich_calc.CationWorkspace()
+
+# process_file function.
+def process_file(path,system_name,output_dir,delimiter,chunksize=None):
+  '''
+  Performs stoichiometry calculations for a single dataset file and writes the
+  results next to it (or to output_dir). If a chunksize is specified, the file
+  is streamed in chunks of that many rows. Errors are caught and reported in the
+  returned summary dict, so that one bad file does not stop a batch; files
+  without any oxide column of the mineral system are reported as errors.
+  '''
+  summary = {'input':path,'output':None,'system':system_name,'rows':0,'seconds':0.0,'error':None}
+  start = time.perf_counter()
+  try:
+    if system_name not in worker_min_systems:
+      raise KeyError('Unknown mineral system: {:}'.format(system_name))
+    min_sys = worker_min_systems[system_name]
+    target = results_path(path,output_dir)
+    # Check the header first, so that files of other data fail rather than give empty results.
+    header = pd.read_csv(path,sep=delimiter,index_col=0,nrows=0)
+    if not stoich_calc.find_active_columns(header,min_sys):
+      raise ValueError('No {:} oxide columns found (expected some of {:}).'.format(
+                       system_name,', '.join(min_sys.getOxideList())))
+    if chunksize:
+      rows = stoich_calc.stream_stoich(path,target,min_sys,worker_sram_lib,chunksize,delimiter)
+    else:
+      dataset = pd.read_csv(path,sep=delimiter,index_col=0)
+      results = stoich_calc.calc_stoich(dataset,min_sys,worker_sram_lib,workspace=worker_workspace)
+      results.to_csv(target,sep=delimiter)
+      rows = len(results)
+    summary['output'], summary['rows'] = target, rows
+  except Exception as e:
+    summary['error'] = '{:}: {:}'.format(type(e).__name__,e)
+  summary['seconds'] = time.perf_counter() - start
+  return summary
+
+# results_path function.
+def results_path(path,output_dir=None):
+  '''
+  Returns the path of the results file for the specified dataset file: next to
+  it (or in output_dir), with its extension replaced by results_ext.
+  '''
+  return os.path.join(output_dir or os.path.dirname(path),os.path.splitext(os.path.basename(path))[0] + results_ext)
+
+# expand_inputs function.
+def expand_inputs(inputs):
+  '''
+  Expands the specified list of files, directories and glob patterns into a
+  sorted list of dataset files. Results files are skipped.
+  '''
+  paths = set()
+  for item in inputs:
+    if os.path.isdir(item):
+      matches = glob.glob(os.path.join(item,'*'))
+    else:
+      matches = glob.glob(item)
+    for path in matches:
+      if os.path.isfile(path) and not path.endswith(results_ext):
+        paths.add(path)
+  return sorted(paths)
+
+# assign_system function.
+def assign_system(path,assignment):
+  '''
+  Returns the name of the mineral system assigned to the specified file. The
+  assignment is either a single mineral system name, or a list of (pattern,
+  name) pairs matched in order against the file name; None if nothing matches.
+  '''
+  if isinstance(assignment,str):
+    return assignment
+  for (pattern,name) in assignment:
+    if fnmatch.fnmatch(os.path.basename(path),pattern) or fnmatch.fnmatch(path,pattern):
+      return name
+  return None
+
+# run_batch function.
+def run_batch(inputs,assignment,output_dir=None,workers=None,delimiter='\t',chunksize=None,
+              nist=None,patch=None,snapshot=None,minsys_dir=None,verbose=True):
+  '''
+  Performs stoichiometry calculations for every dataset in the specified inputs
+  (files, directories or glob patterns) on a pool of worker processes, writing
+  one results file per input (streamed in chunks, if a chunksize is specified).
+  Inputs whose results files would have the same path (e.g., a.txt and a.csv)
+  are reported as failed rather than overwriting each other's results. Returns
+  a summary dict with per-file results and throughput (rows/sec, files/sec).
+  Resource paths default to those of the engine module.
+  '''
+  nist = nist or engine.def_sram_nist_path
+  patch = patch or engine.def_sram_patch_path
+  snapshot = snapshot or engine.def_sram_snapshot_path
+  minsys_dir = minsys_dir or engine.def_minsys_dir
+  paths = expand_inputs(inputs)
+  targets = {}
+  for path in paths:
+    targets.setdefault(results_path(path,output_dir),[]).append(path)
+  if output_dir is not None:
+    os.makedirs(output_dir,exist_ok=True)
+  start = time.perf_counter()
+  files = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers,initializer=init_worker,
+                                              initargs=(nist,patch,snapshot,minsys_dir)) as pool:
+    futures = {}
+    for path in paths:
+      system_name = assign_system(path,assignment)
+      target = results_path(path,output_dir)
+      others = [p for p in targets[target] if p != path]
+      error = None
+      if system_name is None:
+        error = 'No mineral system assigned.'
+      elif others:
+        error = 'Results file {:} would also be written for {:}.'.format(target,', '.join(others))
+      if error is not None:
+        files.append({'input':path,'output':None,'system':system_name,'rows':0,'seconds':0.0,'error':error})
+      else:
+        futures[pool.submit(process_file,path,system_name,output_dir,delimiter,chunksize)] = path
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        summary = future.result()
+      except Exception as e:
+        # The worker itself failed (e.g., it was killed).
+        summary = {'input':futures[future],'output':None,'system':None,'rows':0,'seconds':0.0,
+                   'error':'{:}: {:}'.format(type(e).__name__,e)}
+      files.append(summary)
+      if verbose:
+        if summary['error'] is None:
+          print('Processed {:} ({:} rows, {:.2f} s).'.format(summary['input'],summary['rows'],summary['seconds']))
+        else:
+          print('Failed {:}: {:}'.format(summary['input'],summary['error']))
+  elapsed = time.perf_counter() - start
+  # Summarize throughput.
+  done = [f for f in files if f['error'] is None]
+  rows = sum(f['rows'] for f in done)
+  report = {'files':sorted(files,key=lambda f: f['input']),'processed':len(done),
+            'failed':len(files) - len(done),'rows':rows,'seconds':elapsed,
+            'rows_per_sec':rows/elapsed if elapsed > 0 else 0.0,
+            'files_per_sec':len(done)/elapsed if elapsed > 0 else 0.0}
+  if verbose:
+    print('Batch complete: {:} files processed, {:} failed, {:} rows in {:.2f} s '
+          '({:.0f} rows/sec, {:.2f} files/sec).\n'.format(report['processed'],report['failed'],
+          rows,elapsed,report['rows_per_sec'],report['files_per_sec']))
+  return report
+
+# main function.
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Batch stoichiometry calculations.')
+  parser.add_argument('inputs',nargs='+',help='dataset files, directories or glob patterns')
+  parser.add_argument('--system',help='mineral system used for all inputs')
+  parser.add_argument('--assign',action='append',default=[],metavar='PATTERN=NAME',
+                      help='mineral system for file names matching PATTERN (may be repeated)')
+  parser.add_argument('--output-dir',help='directory for results files (default: next to inputs)')
+  parser.add_argument('--workers',type=int,help='number of worker processes (default: CPU count)')
+  parser.add_argument('--delimiter',choices=list(delimiters.keys()),default='tab')
+  parser.add_argument('--chunksize',type=int,help='stream each file in chunks of this many rows')
+  parser.add_argument('--minsys-dir',help='directory of .minsys files')
+  args = parser.parse_args(argv)
+  # Build the mineral system assignment.
+  if any('=' not in a for a in args.assign):
+    parser.error('--assign values must have the form PATTERN=NAME')
+  assignment = [tuple(a.split('=',1)) for a in args.assign]
+  if args.system is not None:
+    assignment.append(('*',args.system))
+  if not assignment:
+    parser.error('specify --system or at least one --assign PATTERN=NAME')
+  report = run_batch(args.inputs,assignment,args.output_dir,args.workers,delimiters[args.delimiter],
+                     args.chunksize,minsys_dir=args.minsys_dir)
+  return 1 if report['failed'] > 0 else 0
+
+if __name__ == '__main__':
+  raise SystemExit(main())
@@ -0,0 +1,295 @@
+# Stoichometry
+# benchmark.py
+#
+# Benchmarks for the stoichiometry hot paths, using synthetic microprobe datasets
+# generated for the loaded mineral systems. Each stage is timed separately, and
+# throughput and peak (traced) memory are reported as JSON lines, so that results
+# can be compared between revisions.
+#
+# Usage:
+#   python benchmark.py [--rows N] [--systems NAME ...] [--missing FRACTION]
+#                       [--hydrous | --anhydrous] [--repeat N] [--seed N]
+#                       [--workers N] [--shard-rows N] [--oxides OXIDE ...] [--rename OXIDE=HEADER ...]
+#                       [--minsys-dir DIR] [--output FILE]
+#   python benchmark.py --check-startup [--minsys-dir DIR]
+#
+# The startup check measures, in a fresh interpreter, the time to import the
+# stoichiometry module and the latency of a first small calculation, and exits
+# with a non-zero status if either exceeds startup_budget.
+#
+
+import argparse
+import concurrent.futures
+import json
+import platform
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import util
+import stoich_calc
+import stoichiometry
+import parallel
+
+# Number of rows used to time the (slow) reference implementation.
+reference_rows = 200
+# Startup time budget (seconds), checked by check_startup. pandas and the
+# calculation modules are only imported once they are used, and resources are
+# loaded on first use, so importing the stoichiometry module is fast.
+startup_budget = {'import_seconds':0.25,'first_result_seconds':2.0}
+
+# Script run in a fresh interpreter by measure_startup. It imports the
+# stoichiometry module and computes cations for a single synthetic analysis.
+startup_script = '''
+import json, sys, time
+start = time.perf_counter()
+import stoichiometry
+imported = time.perf_counter()
+import benchmark, stoich_calc
+stoichiometry.set_resource_paths(minsys_dir=sys.argv[1])
+min_systems = stoichiometry.get_min_systems()
+if not min_systems:
+  raise RuntimeError('No mineral systems found in: {:}'.format(sys.argv[1]))
+min_sys = min_systems[sys.argv[2] if len(sys.argv) > 2 else sorted(min_systems.keys())[0]]
+sram_lib = stoichiometry.get_sram_lib()
+dataset = benchmark.make_synthetic_dataset(min_sys,sram_lib,rows=1,missing=0.0)
+stoich_calc.calc_stoich(dataset,min_sys,sram_lib)
+done = time.perf_counter()
+print(json.dumps({'system':min_sys.getSystemName(),'import_seconds':imported - start,
+                  'first_result_seconds':done - start}))
+'''
+
+# make_synthetic_dataset function.
+def make_synthetic_dataset(min_sys,sram_lib,rows=10000,missing=0.05,hydrous=None,seed=0,oxides=None,columns=None):
+  '''
+  Generates a synthetic dataset of oxide wt% analyses for the specified
+  MineralSystem. Compositions are random mixtures of the endmembers, with minor
+  amounts of the oxides that no endmember contains, 1% relative analytical
+  noise, and the specified fraction of missing values.
+
+  If hydrous is True (by default, if the MineralSystem is hydrous), the water
+  of the endmembers is left out of the analyses, so that totals fall short of
+  100 wt% as they do for real microprobe analyses of hydrous minerals.
+
+  Arguments:
+  - oxides  - The oxide columns of the dataset, in order (default: those of the
+              MineralSystem). Oxides of the MineralSystem that are not listed
+              are dropped; other oxides are added with minor amounts.
+  - columns - A map of oxides to column headers, e.g., {'FeO':'FeOT (wt%)'},
+              to exercise the resolution of active columns.
+  '''
+  rng = np.random.default_rng(seed)
+  if hydrous is None:
+    hydrous = min_sys.isHydrous()
+  selected = oxides
+  oxides = min_sys.getOxideList()
+  coefficients = min_sys.getCoefficientMatrix(sram_lib)
+  # Moles of each element per formula unit, from random endmember mixtures.
+  counts, elements = util.parse_many(min_sys.getEndmemberList())
+  fractions = rng.dirichlet(np.ones(len(counts)),rows)
+  moles = fractions @ counts
+  # Moles of each oxide; minor oxides for cations not in any endmember.
+  oxide_moles = np.empty((rows,len(oxides)))
+  assigned = set()
+  for (j,ox) in enumerate(oxides):
+    cation = list(util.parse_compound(ox).keys())[0]
+    if cation in elements and cation not in assigned:
+      oxide_moles[:,j] = moles[:,elements.index(cation)]/coefficients[j,0]
+      assigned.add(cation)
+    else:
+      oxide_moles[:,j] = rng.exponential(0.002,rows)
+  # Convert to wt% with analytical noise.
+  wt = oxide_moles*coefficients[:,2]
+  water = np.zeros(rows)
+  if 'H' in elements:
+    water = moles[:,elements.index('H')]/2.0*util.molecular_weight('H2O',sram_lib)
+  total = rng.normal(100.0,0.5,rows)
+  if hydrous:
+    total = total*(1.0 - water/(wt.sum(axis=1) + water))
+  wt = wt*(total/wt.sum(axis=1))[:,np.newaxis]*(1.0 + 0.01*rng.standard_normal(wt.shape))
+  wt[rng.random(wt.shape) < missing] = np.nan
+  index = pd.Index(['synthetic-{:07d}'.format(i) for i in range(rows)],name='Analysis')
+  dataset = pd.DataFrame(np.round(wt,3),index,oxides)
+  if selected is not None:
+    for ox in selected:
+      if ox not in dataset.columns:
+        extra = rng.exponential(0.002,rows)*util.molecular_weight(ox,sram_lib)
+        extra[rng.random(rows) < missing] = np.nan
+        dataset[ox] = np.round(extra,3)
+    dataset = dataset[list(selected)]
+  if columns:
+    dataset = dataset.rename(columns=columns)
+  return dataset
+
+# time_stage function.
+def time_stage(stage,func,repeat=3,rows=None,**info):
+  '''
+  Runs the specified function repeat times, and returns a dict with the best
+  wall time, the throughput (if a number of rows is given) and the peak memory
+  traced during the first run.
+  '''
+  times = []
+  peak = 0
+  for i in range(repeat):
+    if i == 0:
+      tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+    if i == 0:
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+  record = {'stage':stage,'seconds':min(times),'median_seconds':float(np.median(times)),
+            'repeat':repeat,'rows':rows,'rows_per_sec':None,'peak_bytes':peak}
+  if rows:
+    record['rows_per_sec'] = rows/min(times)
+  record.update(info)
+  return record
+
+# measure_startup function.
+def measure_startup(minsys_dir=stoichiometry.def_minsys_dir,system=None):
+  '''
+  Measures the import time of the stoichiometry module and the latency of its
+  first result (import, resource loading and a one-row calculation) in a fresh
+  interpreter. Returns a benchmark record (dict). Raises a RuntimeError if the
+  measurement fails, e.g., if there are no mineral systems.
+  '''
+  here = os.path.dirname(os.path.abspath(__file__))
+  args = [sys.executable,'-c',startup_script,minsys_dir] + ([system] if system else [])
+  proc = subprocess.run(args,cwd=here,capture_output=True,text=True)
+  if proc.returncode != 0:
+    lines = proc.stderr.strip().splitlines()
+    raise RuntimeError('Startup measurement failed: {:}'.format(lines[-1] if lines else proc.returncode))
+  timing = json.loads(proc.stdout.strip().splitlines()[-1])
+  record = {'stage':'startup','seconds':timing['first_result_seconds'],'rows':1}
+  record.update(timing)
+  return record
+
+# check_startup function.
+def check_startup(record,budget=None):
+  '''
+  Returns a list of messages for the startup times of the specified record (see
+  measure_startup) that exceed the budget (startup_budget by default).
+  '''
+  budget = budget or startup_budget
+  return ['{:} = {:.3f} s exceeds budget of {:.3f} s'.format(k,record[k],limit)
+          for (k,limit) in budget.items() if record[k] > limit]
+
+# run_benchmarks function.
+def run_benchmarks(rows=10000,systems=None,missing=0.05,hydrous=None,repeat=3,seed=0,
+                   nist=stoichiometry.def_sram_nist_path,patch=stoichiometry.def_sram_patch_path,
+                   minsys_dir=stoichiometry.def_minsys_dir,workers=None,shard_rows=parallel.def_shard_rows,
+                   oxides=None,columns=None):
+  '''
+  Runs all benchmark stages and returns a list of records (dicts). The parallel
+  stage uses the specified number of worker processes (default: CPU count) and
+  shard size. Oxides and columns configure the columns of the synthetic
+  datasets (see make_synthetic_dataset).
+  '''
+  records = [measure_startup(minsys_dir,systems[0] if systems else None)]
+  # Resource loading stages.
+  records.append(time_stage('load_atomic_weights',lambda: util.update_sram_lib(
+                            util.load_atomic_weights(nist),util.load_atomic_weights(patch)),repeat))
+  sram_lib = util.update_sram_lib(util.load_atomic_weights(nist),util.load_atomic_weights(patch))
+  with tempfile.TemporaryDirectory() as tmp:
+    snapshot = os.path.join(tmp,'sram_lib.snapshot')
+    util.load_sram_library(nist,patch,snapshot)
+    records.append(time_stage('load_sram_library (snapshot)',lambda: util.load_sram_library(nist,patch,snapshot),repeat))
+  records.append(time_stage('load_mineral_systems',lambda: util.load_mineral_systems(minsys_dir),repeat))
+  min_systems = util.load_mineral_systems(minsys_dir)
+  if not min_systems:
+    raise RuntimeError('No mineral systems found in: {:}'.format(minsys_dir))
+  names = systems or sorted(min_systems.keys())
+  # Formula parsing, without and with warm caches.
+  formulas = list(dict.fromkeys(ox for name in names for ox in min_systems[name].getOxideList()))
+  def parse_cold():
+    util.parse_cache.invalidate()
+    util.formula_cache.invalidate()
+    for ox in formulas:
+      util.parse_compound(ox)
+      util.molecular_weight(ox,sram_lib)
+  def parse_warm():
+    for ox in formulas:
+      util.parse_compound(ox)
+      util.molecular_weight(ox,sram_lib)
+  records.append(time_stage('parse_compound/molecular_weight (cold)',parse_cold,repeat,formulas=len(formulas)))
+  parse_warm()
+  records.append(time_stage('parse_compound/molecular_weight (warm)',parse_warm,repeat,formulas=len(formulas)))
+  # Calculation stages, per mineral system.
+  for name in names:
+    min_sys = min_systems[name]
+    dataset = make_synthetic_dataset(min_sys,sram_lib,rows,missing,hydrous,seed,oxides,columns)
+    active_cols = stoich_calc.find_active_columns(dataset,min_sys)
+    info = {'system':name,'columns':len(active_cols)}
+    records.append(time_stage('find_active_columns',lambda: stoich_calc.find_active_columns(dataset,min_sys),
+                              repeat,rows,**info))
+    records.append(time_stage('normalize_anhydrous_oxides',
+                              lambda: stoich_calc.normalize_anhydrous_oxides(dataset,active_cols,min_sys),
+                              repeat,rows,**info))
+    records.append(time_stage('calc_cations_per_formula_unit',
+                              lambda: stoich_calc.calc_cations_per_formula_unit(dataset,active_cols,min_sys,sram_lib),
+                              repeat,rows,**info))
+    # The multi-process mode, with a pool started once for all repeats.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+      records.append(time_stage('calc_stoich_parallel',
+                                lambda: parallel.calc_stoich_parallel(dataset,min_sys,sram_lib,hydrous,workers,
+                                                                      shard_rows,pool),
+                                repeat,rows,workers=workers or os.cpu_count(),shard_rows=shard_rows,**info))
+    # The row-by-row reference implementation, on a subset of the rows.
+    subset = dataset.iloc[:min(rows,reference_rows)]
+    records.append(time_stage('calc_cations_per_formula_unit_reference',
+                              lambda: stoich_calc.calc_cations_per_formula_unit_reference(subset,active_cols,min_sys,sram_lib),
+                              1,len(subset),**info))
+  return records
+
+# main function.
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the stoichiometry hot paths.')
+  parser.add_argument('--rows',type=int,default=10000,help='rows per synthetic dataset')
+  parser.add_argument('--systems',nargs='+',help='mineral systems to benchmark (default: all)')
+  parser.add_argument('--missing',type=float,default=0.05,help='fraction of missing values')
+  group = parser.add_mutually_exclusive_group()
+  group.add_argument('--hydrous',dest='hydrous',action='store_true',default=None)
+  group.add_argument('--anhydrous',dest='hydrous',action='store_false')
+  parser.add_argument('--repeat',type=int,default=3)
+  parser.add_argument('--seed',type=int,default=0)
+  parser.add_argument('--workers',type=int,help='worker processes of the parallel stage (default: CPU count)')
+  parser.add_argument('--shard-rows',type=int,default=parallel.def_shard_rows,help='rows per shard of the parallel stage')
+  parser.add_argument('--oxides',nargs='+',help='oxide columns of the synthetic datasets (default: those of each system)')
+  parser.add_argument('--rename',nargs='+',default=[],metavar='OXIDE=HEADER',help='column headers of oxides')
+  parser.add_argument('--minsys-dir',default=stoichiometry.def_minsys_dir)
+  parser.add_argument('--output',help='JSON lines file to append results to (default: stdout)')
+  parser.add_argument('--check-startup',action='store_true',help='only check startup times against the budget')
+  args = parser.parse_args(argv)
+  if args.check_startup:
+    try:
+      record = measure_startup(args.minsys_dir,args.systems[0] if args.systems else None)
+    except RuntimeError as e:
+      print(e)
+      return 1
+    failures = check_startup(record)
+    print(json.dumps(record))
+    for msg in failures:
+      print('Startup budget exceeded: {:}'.format(msg))
+    return 1 if failures else 0
+  # Run the benchmarks, and write one JSON record per stage.
+  records = run_benchmarks(args.rows,args.systems,args.missing,args.hydrous,args.repeat,args.seed,
+                           minsys_dir=args.minsys_dir,workers=args.workers,shard_rows=args.shard_rows,
+                           oxides=args.oxides,columns=dict(item.split('=',1) for item in args.rename))
+  run = {'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'),'python':platform.python_version(),
+         'numpy':np.__version__,'pandas':pd.__version__}
+  out = open(args.output,'a') if args.output else sys.stdout
+  try:
+    for record in records:
+      record.update(run)
+      out.write(json.dumps(record) + '\n')
+  finally:
+    if args.output:
+      out.close()
+
+if __name__ == '__main__':
+  raise SystemExit(main())
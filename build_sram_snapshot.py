@@ -0,0 +1,38 @@
+# Stoichometry
+# build_sram_snapshot.py
+#
+# Regenerates the binary snapshot of the patched library of standard relative
+# atomic masses (SRAMs) that is loaded at startup. The snapshot is regenerated
+# automatically when its source files change; this tool forces a rebuild.
+#
+# Usage:
+#   python build_sram_snapshot.py [--nist PATH] [--patch PATH] [--output PATH]
+#
+
+import argparse
+import time
+import util
+import stoichiometry
+
+# main function.
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Regenerate the SRAM library snapshot.')
+  parser.add_argument('--nist',default=stoichiometry.def_sram_nist_path,
+                      help='NIST atomic weights file (default: %(default)s)')
+  parser.add_argument('--patch',default=stoichiometry.def_sram_patch_path,
+                      help='Geologic atomic weights patch file (default: %(default)s)')
+  parser.add_argument('--output',default=stoichiometry.def_sram_snapshot_path,
+                      help='Snapshot file to write (default: %(default)s)')
+  args = parser.parse_args(argv)
+  # Build and write the snapshot.
+  sram_lib = util.update_sram_lib(util.load_atomic_weights(args.nist),util.load_atomic_weights(args.patch))
+  util.write_sram_snapshot(sram_lib,[args.nist,args.patch],args.output)
+  # Time a load of the new snapshot.
+  start = time.perf_counter()
+  util.load_sram_library(args.nist,args.patch,args.output)
+  elapsed = time.perf_counter() - start
+  print('SRAM library snapshot written: {:} ({:} elements, loads in {:.3f} ms).'.format(
+        args.output,len(sram_lib),elapsed*1000))
+
+if __name__ == '__main__':
+  main()
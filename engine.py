@@ -0,0 +1,171 @@
+# Stoichometry
+# engine.py
+#
+# This file contains the StoichiometryEngine, a programmatic interface to the
+# stoichiometry calculations that holds no global state and never prompts the
+# user. An engine owns its SRAM library and mineral system registry (loaded on
+# first use), and may be shared between threads for concurrent calculations.
+# The calculation modules (and pandas) are imported by the methods that use
+# them, so that importing the engine is fast.
+#
+
+import hashlib
+import os
+import threading
+import util
+
+# Default resource paths.
+def_sram_nist_path = 'resources/AtomicWeights_IsotopicCompositions_NIST_4.1.txt'
+def_sram_patch_path = 'resources/SelectedGeologicAtomicWeights.txt'
+def_sram_snapshot_path = 'resources/sram_lib.snapshot'
+def_minsys_dir = 'resources/mineral_systems'
+
+# sram_snapshot_path function.
+def sram_snapshot_path(nist,patch,snapshot=def_sram_snapshot_path):
+  '''
+  Returns the SRAM library snapshot path to use for the specified source files.
+  The default snapshot path is only used for the default sources; other sources
+  get their own snapshot next to it, named by a digest of their paths, so that
+  alternating library configurations do not keep rewriting the same snapshot.
+  '''
+  if snapshot != def_sram_snapshot_path or (nist,patch) == (def_sram_nist_path,def_sram_patch_path):
+    return snapshot
+  digest = hashlib.sha256('\n'.join(os.path.abspath(p) for p in [nist,patch]).encode('utf-8')).hexdigest()[:12]
+  (root,ext) = os.path.splitext(snapshot)
+  return '{:}-{:}{:}'.format(root,digest,ext)
+
+# StoichiometryEngine class.
+class StoichiometryEngine(object):
+  '''
+  Performs stoichiometry calculations with its own SRAM library and mineral
+  system registry. Resources are loaded from the specified paths on first use,
+  unless they are given directly (sram_lib and min_systems; a plain dict
+  sram_lib is copied into an SRAMLibrary).
+
+  Calculations do not modify the engine, its resources or the input datasets,
+  so a single engine may be used from several threads at once.
+  '''
+  def __init__(self,nist=def_sram_nist_path,patch=def_sram_patch_path,snapshot=def_sram_snapshot_path,
+               minsys_dir=def_minsys_dir,sram_lib=None,min_systems=None):
+    self.paths = {'nist':nist,'patch':patch,'snapshot':snapshot,'minsys_dir':minsys_dir}
+    self._sram_lib = None if sram_lib is None else util.as_sram_library(sram_lib)
+    self._min_systems = min_systems
+    self.lock = threading.Lock()
+
+  @property
+  def sram_lib(self):
+    '''
+    The library of standard relative atomic weights (SRAMs).
+    '''
+    if self._sram_lib is None:
+      with self.lock:
+        if self._sram_lib is None:
+          snapshot = sram_snapshot_path(self.paths['nist'],self.paths['patch'],self.paths['snapshot'])
+          self._sram_lib = util.load_sram_library(self.paths['nist'],self.paths['patch'],snapshot)
+    return self._sram_lib
+
+  @property
+  def min_systems(self):
+    '''
+    The registry (mapping of names to MineralSystem objects) of mineral systems.
+    '''
+    if self._min_systems is None:
+      with self.lock:
+        if self._min_systems is None:
+          self._min_systems = util.load_mineral_systems(self.paths['minsys_dir'])
+    return self._min_systems
+
+  def system(self,system):
+    '''
+    Returns the MineralSystem with the specified name. MineralSystem objects are
+    returned as they are. Raises a KeyError for unknown mineral systems.
+    '''
+    if hasattr(system,'getOxideList'):
+      return system
+    if system not in self.min_systems:
+      raise KeyError('Unknown mineral system: {:}'.format(system))
+    return self.min_systems[system]
+
+  def systems(self,hydrous=None,silicate=None):
+    '''
+    Returns the sorted names of the mineral systems, optionally only those with
+    the specified hydrous/silicate flags.
+    '''
+    names = []
+    for (name,ms) in self.min_systems.items():
+      if (hydrous is None or ms.isHydrous() == hydrous) and (silicate is None or ms.isSilicate() == silicate):
+        names.append(name)
+    return sorted(names)
+
+  def compute(self,dataset,system,hydrous=None,incremental=False,workers=1,shard_rows=None):
+    '''
+    Returns a dataframe of formula cations for the specified dataset and mineral
+    system (a name or MineralSystem). If hydrous is True (by default, for hydrous
+    systems), the anhydrous oxides are normalized first. If incremental is True,
+    rows calculated before are reused (see stoich_calc.calc_stoich_incremental).
+    Otherwise, if workers is not 1, large datasets are split into shards of
+    shard_rows rows (by default, parallel.def_shard_rows) calculated by that
+    many processes (None for the CPU count; see parallel.calc_stoich_parallel).
+    '''
+    import stoich_calc
+    min_sys = self.system(system)
+    if workers != 1 and not incremental:
+      import parallel
+      if shard_rows is None:
+        shard_rows = parallel.def_shard_rows
+      return parallel.calc_stoich_parallel(dataset,min_sys,self.sram_lib,hydrous,workers,shard_rows)
+    if incremental:
+      return stoich_calc.calc_stoich_incremental(dataset,min_sys,self.sram_lib,hydrous)
+    return stoich_calc.calc_stoich(dataset,min_sys,self.sram_lib,hydrous)
+
+  def compute_bases(self,dataset,system,bases,hydrous=None):
+    '''
+    Returns a list of dataframes of formula cations for the specified dataset and
+    mineral system, one for each of the specified normalization bases, computed
+    in a single pass (see stoich_calc.calc_stoich_bases).
+    '''
+    import stoich_calc
+    return stoich_calc.calc_stoich_bases(dataset,self.system(system),self.sram_lib,bases,hydrous)
+
+  def compute_file(self,path,output_path,system,chunksize=100000,delimiter='\t'):
+    '''
+    Calculates formula cations for the dataset file at the specified path in
+    chunks of rows, writing the results to output_path. Returns the number of
+    rows processed (see stoich_calc.stream_stoich).
+    '''
+    import stoich_calc
+    return stoich_calc.stream_stoich(path,output_path,self.system(system),self.sram_lib,chunksize,delimiter)
+
+  def classify(self,dataset,systems=None):
+    '''
+    Evaluates the specified mineral systems (names; by default, all of them) for
+    every analysis in the dataset, and returns the classification dataframe (see
+    stoich_calc.classify_mineral_systems).
+    '''
+    import stoich_calc
+    names = systems or self.systems()
+    return stoich_calc.classify_mineral_systems(dataset,{n:self.system(n) for n in names},self.sram_lib)
+
+  def endmember_proportions(self,formula_cations,system,tol=1e-9):
+    '''
+    Returns the endmember proportions for the specified formula cations (see
+    stoich_calc.calc_endmember_proportions).
+    '''
+    import stoich_calc
+    return stoich_calc.calc_endmember_proportions(formula_cations,self.system(system),tol)
+
+  def fe3_charge_balance(self,formula_cations,system,cpfu=None):
+    '''
+    Returns the formula cations with Fe split into Fe2+ and Fe3+ by charge
+    balance (see stoich_calc.calc_fe3_charge_balance).
+    '''
+    import stoich_calc
+    return stoich_calc.calc_fe3_charge_balance(formula_cations,self.system(system),cpfu)
+
+  def site_allocation(self,formula_cations,system):
+    '''
+    Returns the formula cations with site occupancies and vacancies (see
+    stoich_calc.calc_site_allocation).
+    '''
+    import stoich_calc
+    return stoich_calc.calc_site_allocation(formula_cations,self.system(system))
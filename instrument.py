@@ -0,0 +1,238 @@
+# Stoichometry
+# instrument.py
+#
+# This file contains an opt-in instrumentation layer for the stoichiometry
+# program. Functions decorated with instrumented() record their wall time, the
+# number of rows processed, the copies of data they make (see record_copy) and
+# the formula cache hits and misses during the call. Records are collected into
+# a report (see report()) and passed to any number of sinks, e.g., log files or
+# JSON lines files.
+#
+# Instrumentation is disabled by default, in which case instrumented functions
+# cost a single flag check. Set the STOICH_INSTRUMENT environment variable to
+# the path of a JSON lines file to enable it at import time.
+#
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+# Largest number of records kept for report(); older records are dropped, but
+# still counted in the per-stage totals.
+max_records = 10000
+
+# Module state.
+enabled = False
+sinks = []
+records = collections.deque(maxlen=max_records)
+stage_totals = {}
+records_lock = threading.Lock()
+local = threading.local() # Per-thread stack of open records.
+
+# StageRecord class.
+class StageRecord(object):
+  '''
+  Measurements for a single call of an instrumented function. Times, copies
+  and cache counts include those of nested instrumented calls.
+  '''
+  __slots__ = ['stage','start','seconds','rows','copies','copy_bytes','cache_hits','cache_misses','depth']
+
+  def __init__(self,stage,depth):
+    self.stage = stage
+    self.start = time.time()
+    self.seconds = 0.0
+    self.rows = None
+    self.copies, self.copy_bytes = 0, 0
+    self.cache_hits, self.cache_misses = 0, 0
+    self.depth = depth
+
+  def as_dict(self):
+    return {k:getattr(self,k) for k in self.__slots__}
+
+# InstrumentationReport class.
+class InstrumentationReport(object):
+  '''
+  A structured report of instrumentation records, with per-stage totals. The
+  totals cover all calls, including those whose records are no longer kept.
+  '''
+  def __init__(self,records,totals=None):
+    self.records = list(records)
+    if totals is None:
+      totals = {}
+      for rec in self.records:
+        add_to_totals(totals,rec)
+    self.totals = {stage:dict(st) for (stage,st) in totals.items()}
+
+  def summary(self):
+    '''
+    Returns a dict of per-stage totals (calls, seconds, rows, copies, copy bytes,
+    cache hits and misses), keyed by stage name.
+    '''
+    return self.totals
+
+  def __str__(self):
+    lines = ['{:<48} {:>6} {:>10} {:>10} {:>7} {:>12} {:>8}'.format(
+             'Stage','Calls','Seconds','Rows','Copies','Copy bytes','Hits')]
+    for (stage,st) in self.summary().items():
+      lines.append('{:<48} {:>6} {:>10.4f} {:>10} {:>7} {:>12} {:>8}'.format(
+                   stage,st['calls'],st['seconds'],st['rows'],st['copies'],st['copy_bytes'],st['cache_hits']))
+    return '\n'.join(lines)
+
+# add_to_totals function.
+def add_to_totals(totals,rec):
+  '''
+  Adds the measurements of the specified StageRecord to a dict of per-stage totals.
+  '''
+  st = totals.setdefault(rec.stage,{'calls':0,'seconds':0.0,'rows':0,'copies':0,'copy_bytes':0,
+                                    'cache_hits':0,'cache_misses':0})
+  st['calls'] += 1
+  st['seconds'] += rec.seconds
+  st['rows'] += rec.rows or 0
+  st['copies'] += rec.copies
+  st['copy_bytes'] += rec.copy_bytes
+  st['cache_hits'] += rec.cache_hits
+  st['cache_misses'] += rec.cache_misses
+
+# LogFileSink class.
+class LogFileSink(object):
+  '''
+  Sink that appends a human-readable line per record to a log file.
+  '''
+  def __init__(self,path):
+    self.file = open(path,'a')
+
+  def emit(self,rec):
+    self.file.write('{:} {:}{:} {:.6f} s, rows={:}, copies={:} ({:} bytes), cache hits={:}, misses={:}\n'.format(
+                    time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(rec.start)),'  '*rec.depth,rec.stage,
+                    rec.seconds,rec.rows,rec.copies,rec.copy_bytes,rec.cache_hits,rec.cache_misses))
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+# JSONLinesSink class.
+class JSONLinesSink(object):
+  '''
+  Sink that appends a JSON object per record to a JSON lines file.
+  '''
+  def __init__(self,path):
+    self.file = open(path,'a')
+
+  def emit(self,rec):
+    self.file.write(json.dumps(rec.as_dict()) + '\n')
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+# enable function.
+def enable(new_sinks=None):
+  '''
+  Enables instrumentation, adding the specified sinks (objects with an emit
+  method that is passed each StageRecord).
+  '''
+  global enabled
+  sinks.extend(new_sinks or [])
+  enabled = True
+
+# disable function.
+def disable():
+  '''
+  Disables instrumentation, and closes and removes all sinks.
+  '''
+  global enabled
+  enabled = False
+  for sink in sinks:
+    if hasattr(sink,'close'):
+      sink.close()
+  del sinks[:]
+
+# reset function.
+def reset():
+  '''
+  Discards all collected records and per-stage totals.
+  '''
+  with records_lock:
+    records.clear()
+    stage_totals.clear()
+
+# report function.
+def report():
+  '''
+  Returns an InstrumentationReport of the records collected so far (at most
+  max_records of the most recent ones) and the totals of all of them.
+  '''
+  with records_lock:
+    return InstrumentationReport(records,stage_totals)
+
+# record_copy function.
+def record_copy(nbytes):
+  '''
+  Records a copy of the specified number of bytes of data, for all open stages
+  of the current thread. Callers should check the enabled flag first.
+  '''
+  for rec in getattr(local,'stack',[]):
+    rec.copies += 1
+    rec.copy_bytes += int(nbytes)
+
+# record_cache function.
+def record_cache(hit):
+  '''
+  Records a formula cache hit (or miss), for all open stages of the current
+  thread. Callers should check the enabled flag first.
+  '''
+  for rec in getattr(local,'stack',[]):
+    if hit:
+      rec.cache_hits += 1
+    else:
+      rec.cache_misses += 1
+
+# count_rows function.
+def count_rows(args,result):
+  '''
+  Returns the number of rows processed by a call: that of the resulting
+  dataframe, or else of the first dataframe argument (None if there is none).
+  '''
+  for obj in (result,) + tuple(args):
+    if hasattr(obj,'index') and hasattr(obj,'columns'):
+      return len(obj)
+  return None
+
+# instrumented function.
+def instrumented(stage=None):
+  '''
+  Decorator that records a StageRecord for each call of the decorated function
+  while instrumentation is enabled. The stage name defaults to the qualified
+  function name.
+  '''
+  def decorator(func):
+    name = stage or '{:}.{:}'.format(func.__module__,func.__name__)
+    @functools.wraps(func)
+    def wrapper(*args,**kwargs):
+      if not enabled:
+        return func(*args,**kwargs)
+      stack = local.__dict__.setdefault('stack',[])
+      rec = StageRecord(name,len(stack))
+      stack.append(rec)
+      start = time.perf_counter()
+      try:
+        result = func(*args,**kwargs)
+      finally:
+        rec.seconds = time.perf_counter() - start
+        stack.pop()
+      rec.rows = count_rows(args,result)
+      with records_lock:
+        records.append(rec)
+        add_to_totals(stage_totals,rec)
+      for sink in sinks:
+        sink.emit(rec)
+      return result
+    return wrapper
+  return decorator
+
+# Enable instrumentation from the environment, if requested.
+if os.environ.get('STOICH_INSTRUMENT'):
+  enable([JSONLinesSink(os.environ['STOICH_INSTRUMENT'])])
@@ -1,28 +1,46 @@
 # mineral_system.py
 # Class definition file for dealing with mineral systems in the stoichiometry program.
 
+import glob
+import os
+import pickle
+import threading
+import numpy as np
 import util
 
+# Lock for the per-library coefficient matrices cached on mineral systems.
+coefficients_lock = threading.Lock()
+
+# Version of the pickled MineralSystem fields; cached systems of other versions
+# are parsed again.
+cache_format = 3
+
+# Normalization basis kinds, and the charges of anions for the charge basis.
+basis_kinds = ('anions','cations','charge')
+anion_charges = {'O':2,'S':2,'F':1,'Cl':1,'Br':1,'I':1}
+
 # Class definition.
 class MineralSystem(object):
   '''
   This class contains information specific to a particular mineral system for
   use in stoichiometry calculations.
+
+  MineralSystem objects are immutable. Besides the definitions read from the
+  .minsys file, they carry precomputed arrays for calculations: the cation and
+  anion counts of each oxide and the endmember composition matrix. Molecular
+  weights depend on the SRAM library and are computed once per library version
+  (see getCoefficientMatrix).
   '''
-  # Instance variables (fields) to add in the future: 
+  # Instance variables (fields) to add in the future:
   # - list of validity check parameters (possibly for each oxide; enhancement for later?)
   # - possible enhancement: store lists of charges for elements in each oxide... e.g., Fe+2 and Fe+3, O-2, etc.
-  
+  __slots__ = ['system_name','hydrous','silicate','oxides','anions','apfu','endmembers','cpfu','sites','normalization',
+               'oxide_elements','cation_counts','anion_counts','composition','coefficients']
+
   # Constructor method.
   def __init__(self,filepath):
     # Set instance variables to None, for safety checks later.
-    self.system_name = None
-    self.hydrous = None
-    self.silicate = None
-    self.oxides = None
-    self.anions = None
-    self.apfu = None
-    self.endmembers = None
+    fields = dict.fromkeys(self.__slots__)
     # Read definition file, parse the contents, and overwrite instance variables.
     with open(filepath,'r') as f:
       lines = f.readlines()
@@ -33,61 +51,367 @@ class MineralSystem(object):
         items[i] = items[i].strip()
       # Store information to instance variables.
       if items[0].lower() == 'system name':
-        self.system_name = items[1]
+        fields['system_name'] = items[1]
       elif items[0].lower() == 'hydrous':
-        self.hydrous = items[1].lower() == 'true'
+        fields['hydrous'] = items[1].lower() == 'true'
       elif items[0].lower() == 'silicate':
-        self.silicate = items[1].lower() == 'true'
+        fields['silicate'] = items[1].lower() == 'true'
       elif items[0].lower() == 'oxides':
-        temp_oxides = items[1].split(',')
-        for i in range(len(temp_oxides)):
-          temp_oxides[i] = temp_oxides[i].strip()
-        self.oxides = temp_oxides
+        fields['oxides'] = tuple(ox.strip() for ox in items[1].split(','))
       elif items[0].lower() == 'anions':
-        temp_anions = items[1].split(',')
-        for i in range(len(temp_anions)):
-          temp_anions[i] = temp_anions[i].strip()
-        self.anions = temp_anions
+        fields['anions'] = tuple(an.strip() for an in items[1].split(','))
       elif items[0].lower() == 'anions per formula unit':
-        self.apfu = int(items[1])
+        fields['apfu'] = int(items[1])
       elif items[0].lower() == 'endmembers':
-        temp_endmembers = items[1].split(';')
-        for i in range(len(temp_endmembers)):
-          temp_endmembers[i] = temp_endmembers[i].strip()
-        self.endmembers = temp_endmembers
+        fields['endmembers'] = tuple(em.strip() for em in items[1].split(';') if em.strip())
+      elif items[0].lower() == 'cations per formula unit':
+        # Optional; otherwise derived from the endmembers.
+        fields['cpfu'] = float(items[1])
+      elif items[0].lower() == 'sites':
+        # Optional; site allocation rules.
+        fields['sites'] = parse_sites(items[1],filepath)
+      elif items[0].lower() == 'normalization':
+        # Optional; otherwise normalized to the anions per formula unit.
+        try:
+          fields['normalization'] = parse_basis(items[1])
+        except ValueError:
+          raise RuntimeError('Invalid normalization basis "{:}" in: {:}'.format(items[1],filepath))
+    if fields['sites'] is None:
+      fields['sites'] = ()
+    if fields['normalization'] is None and fields['apfu'] is not None:
+      fields['normalization'] = ('anions',fields['apfu'],())
     # Check that all instance variables have been initialized.
-    if None in [self.system_name,self.hydrous,self.silicate,self.oxides,self.anions,self.apfu,self.endmembers]:
+    required = ['system_name','hydrous','silicate','oxides','anions','apfu','endmembers']
+    if None in [fields[k] for k in required]:
       raise RuntimeError('Failed to load mineral system from: {:}'.format(filepath))
-  
+    for ox in fields['oxides']:
+      # Single-element species (e.g., F or Cl) have no cation and anion counts.
+      if len(util.parsed_compound(ox)) != 2:
+        raise RuntimeError('Oxide "{:}" must consist of a cation and an anion in: {:}'.format(ox,filepath))
+    # Precompute arrays for calculations.
+    fields.update(self.precompute(fields))
+    for (k,v) in fields.items():
+      object.__setattr__(self,k,v)
+
+  @staticmethod
+  def precompute(fields):
+    '''
+    Returns a dict of the precomputed (read-only) arrays for the specified
+    mineral system definition fields.
+    '''
+    pre = {'oxide_elements':[],'coefficients':{}}
+    # Cation (first element) and anion (second element) counts of the oxides.
+    counts = np.empty((2,len(fields['oxides'])))
+    for (i,ox) in enumerate(fields['oxides']):
+      atoms = util.parsed_compound(ox)
+      pre['oxide_elements'].append((atoms[0][0],atoms[1][0]))
+      counts[:,i] = atoms[0][1], atoms[1][1]
+    counts.flags.writeable = False
+    pre['cation_counts'], pre['anion_counts'] = counts[0], counts[1]
+    pre['oxide_elements'] = tuple(pre['oxide_elements'])
+    # Cations per formula unit of each endmember, counting hydrogen as hydroxyl
+    # (each H replaces half an anion and is not counted as a cation).
+    if fields['endmembers']:
+      em_counts, elements = util.parse_many(fields['endmembers'])
+      is_anion = np.array([e in fields['anions'] for e in elements])
+      hydrogen = em_counts[:,elements.index('H')] if 'H' in elements else np.zeros(len(em_counts))
+      anions = em_counts[:,is_anion].sum(axis=1) - 0.5*hydrogen
+      keep = ~is_anion & (np.array(elements) != 'H')
+      matrix = em_counts[:,keep]*(fields['apfu']/anions)[:,np.newaxis]
+      matrix.flags.writeable = False
+      pre['composition'] = (matrix,tuple(e for (e,k) in zip(elements,keep) if k))
+      if fields['cpfu'] is None:
+        pre['cpfu'] = float(matrix.sum(axis=1).mean())
+    else:
+      pre['composition'] = (np.zeros((0,0)),())
+    return pre
+
+  def __setattr__(self,name,value):
+    raise AttributeError('MineralSystem objects are immutable.')
+
+  def __reduce__(self):
+    # Pickle the definition and precomputed arrays, without cached coefficients.
+    state = {k:getattr(self,k) for k in self.__slots__ if k != 'coefficients'}
+    return (restore_mineral_system,(state,))
+
   # Instance methods.
-  
+
   # getSystemName method.
   def getSystemName(self):
     return self.system_name
-  
+
   # isHydrous method.
   def isHydrous(self):
     return self.hydrous
-  
+
   # isSilicate method.
   def isSilicate(self):
     return self.silicate
-  
+
   # getOxideList method.
   def getOxideList(self):
     return self.oxides
-  
+
   # getAnions method.
   def getAnionList(self):
     return self.anions
-  
+
   # getAnionsPerFormulaUnit method.
   def getAnionsPerFormulaUnit(self):
     return self.apfu
-  
+
   # getEndmembers method.
   def getEndmemberList(self):
     return self.endmembers
-  
-  
-  
\ No newline at end of file
+
+  # getOxideElements method.
+  def getOxideElements(self):
+    '''
+    Returns a tuple of (cation, anion) element pairs, one per oxide.
+    '''
+    return self.oxide_elements
+
+  # getNormalization method.
+  def getNormalization(self):
+    '''
+    Returns the normalization basis of the formula, a tuple of (kind, target,
+    excluded elements), where kind is 'anions', 'cations' or 'charge' (total
+    positive charge). Unless given in the definition file, e.g., as
+    'Normalization = cations 8 exclude Na, K', this is ('anions', apfu, ()).
+    '''
+    return self.normalization
+
+  # getBasisWeights method.
+  def getBasisWeights(self,basis=None):
+    '''
+    Returns an array with the normalization weight of each oxide (in
+    getOxideList order) for the specified basis (by default, getNormalization),
+    i.e., the anions, cations (zero for excluded elements) or positive charge
+    per oxide formula.
+    '''
+    (kind,target,excluded) = self.normalization if basis is None else basis
+    if kind == 'anions':
+      return self.anion_counts
+    if kind == 'cations':
+      keep = np.array([cation not in excluded for (cation,anion) in self.oxide_elements])
+      return np.where(keep,self.cation_counts,0.0)
+    charges = [anion_charges.get(anion) for (cation,anion) in self.oxide_elements]
+    if None in charges:
+      raise ValueError('Unknown anion charge for the {:} mineral system.'.format(self.system_name))
+    return self.anion_counts*np.array(charges,dtype=float)
+
+  # getSiteList method.
+  def getSiteList(self):
+    '''
+    Returns a tuple of (site, multiplicity, elements) tuples, one per site in
+    order of filling, for site allocation (see stoich_calc.calc_site_allocation).
+    Each site is filled with the listed elements in order, up to its
+    multiplicity; elements listed for several sites fill the later sites with
+    what remains of them. Empty if the definition file has no site rules.
+    '''
+    return self.sites
+
+  # getCationsPerFormulaUnit method.
+  def getCationsPerFormulaUnit(self):
+    '''
+    Returns the ideal number of cations per formula unit (on the basis of
+    getAnionsPerFormulaUnit anions). Unless given in the definition file, this is
+    the mean over the endmembers (see getEndmemberComposition), or None if there
+    are no endmembers.
+    '''
+    return self.cpfu
+
+  # getEndmemberComposition method.
+  def getEndmemberComposition(self):
+    '''
+    Returns a tuple of (matrix, elements), where the matrix holds the number of
+    each cation per formula unit (on the basis of getAnionsPerFormulaUnit
+    anions) for each endmember. Hydrogen is counted as hydroxyl, i.e., each H
+    replaces half an anion and is not counted as a cation.
+    '''
+    return self.composition
+
+  # getCoefficientMatrix method.
+  def getCoefficientMatrix(self,sram_lib):
+    '''
+    Returns an array with one row per oxide (in getOxideList order) holding the
+    cation count, anion count and molecular weight of that oxide. The matrix is
+    built once per SRAM library version and cached on the mineral system (for
+    SRAMLibrary objects only; see util.sram_version).
+    '''
+    version = util.sram_version(sram_lib)
+    matrix = None if version is None else self.coefficients.get(version)
+    if matrix is None:
+      weights = [util.molecular_weight(ox,sram_lib) for ox in self.oxides]
+      matrix = np.column_stack([self.cation_counts,self.anion_counts,weights])
+      matrix.flags.writeable = False
+      if version is None:
+        return matrix
+      with coefficients_lock:
+        # Keep only the most recent libraries.
+        if len(self.coefficients) >= 4:
+          self.coefficients.pop(next(iter(self.coefficients)))
+        self.coefficients[version] = matrix
+    return matrix
+
+# parse_sites function.
+def parse_sites(text,filepath):
+  '''
+  Parses site allocation rules of the form 'T(8): Si, Al; C(5): Al, Ti, Mg' into
+  a tuple of (site, multiplicity, elements) tuples.
+  '''
+  sites = []
+  for rule in text.split(';'):
+    if not rule.strip():
+      continue
+    site, sep, elements = rule.partition(':')
+    name, sep2, mult = site.partition('(')
+    elements = tuple(e.strip() for e in elements.split(',') if e.strip())
+    try:
+      mult = float(mult.rstrip().rstrip(')'))
+    except ValueError:
+      mult = None
+    if (not sep or not sep2 or not name.strip() or mult is None or mult <= 0.0 or not elements
+        or len(set(elements)) != len(elements)):
+      raise RuntimeError('Invalid site rule "{:}" in: {:}'.format(rule.strip(),filepath))
+    sites.append((name.strip(),mult,elements))
+  return tuple(sites)
+
+# parse_basis function.
+def parse_basis(text):
+  '''
+  Parses a normalization basis of the form '<kind> <target> [exclude <elements>]',
+  e.g., 'anions 24', 'cations 8 exclude Na, K' or 'charge 16', into a tuple of
+  (kind, target, excluded elements). Tuples are returned as they are. Raises a
+  ValueError if the basis is invalid.
+  '''
+  if isinstance(text,tuple):
+    return text
+  items = text.split(None,2)
+  excluded = ()
+  if len(items) == 3:
+    keyword, sep, elements = items[2].partition(' ')
+    excluded = tuple(e.strip() for e in elements.split(',') if e.strip())
+    if keyword.lower() != 'exclude' or not excluded or items[0].lower() != 'cations':
+      raise ValueError('Invalid normalization basis: {:}'.format(text))
+  try:
+    target = float(items[1])
+  except (IndexError,ValueError):
+    target = None
+  if not items or items[0].lower() not in basis_kinds or target is None or not target > 0.0:
+    raise ValueError('Invalid normalization basis: {:}'.format(text))
+  return (items[0].lower(),target,excluded)
+
+# format_basis function.
+def format_basis(basis):
+  '''
+  Returns the text form of a normalization basis (see parse_basis).
+  '''
+  (kind,target,excluded) = basis
+  text = '{:} {:g}'.format(kind,target)
+  if excluded:
+    text += ' exclude {:}'.format(', '.join(excluded))
+  return text
+
+# restore_mineral_system function.
+def restore_mineral_system(state):
+  '''
+  Recreates a MineralSystem from its pickled state.
+  '''
+  ms = object.__new__(MineralSystem)
+  for (k,v) in state.items():
+    object.__setattr__(ms,k,v)
+  object.__setattr__(ms,'coefficients',{})
+  return ms
+
+# Registry class definition.
+class MineralSystemRegistry(object):
+  '''
+  A read-only mapping of mineral system names to MineralSystem objects, for all
+  .minsys files in a directory.
+
+  The registry is backed by an on-disk cache of the pickled systems, so that
+  only .minsys files that are new or have changed (by modification time and
+  size) since the cache was written, or were cached in an older format (see
+  cache_format), are parsed. Systems from the cache are
+  unpickled lazily, the first time they are requested by name.
+  '''
+  def __init__(self,directory,cache_path=None):
+    self.directory = directory
+    self.cache_path = cache_path
+    self.entries = {}  # Name -> [pickled system or None, MineralSystem or None].
+    self.paths = {}    # Name -> path of the .minsys file.
+    self.lock = threading.Lock()
+    cached = self.read_cache()
+    files = {}
+    changed = False
+    for path in sorted(glob.glob(os.path.join(directory,'*.minsys'))):
+      st = os.stat(path)
+      sig = (st.st_mtime_ns,st.st_size,cache_format)
+      entry = cached.get(path)
+      if entry is not None and entry['sig'] == sig:
+        name, data, system = entry['name'], entry['data'], None
+      else:
+        system = MineralSystem(path)
+        name, data = system.getSystemName(), pickle.dumps(system,pickle.HIGHEST_PROTOCOL)
+        changed = True
+      files[path] = {'sig':sig,'name':name,'data':data}
+      self.entries[name] = [data,system]
+      self.paths[name] = path
+    if changed or set(files) != set(cached):
+      self.write_cache(files)
+
+  def read_cache(self):
+    '''
+    Returns the per-file entries of the on-disk cache, or an empty dict.
+    '''
+    if self.cache_path is None or not os.path.isfile(self.cache_path):
+      return {}
+    try:
+      with open(self.cache_path,'rb') as f:
+        return pickle.load(f)
+    except (OSError,EOFError,pickle.UnpicklingError):
+      return {}
+
+  def write_cache(self,files):
+    '''
+    Writes the specified per-file entries to the on-disk cache, if possible.
+    '''
+    if self.cache_path is None:
+      return
+    tmp_path = '{:}.{:}.tmp'.format(self.cache_path,os.getpid())
+    try:
+      with open(tmp_path,'wb') as f:
+        pickle.dump(files,f,pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path,self.cache_path)
+    except OSError:
+      print('Warning: could not write mineral system cache: {:}'.format(self.cache_path))
+
+  def __getitem__(self,name):
+    entry = self.entries[name]
+    if entry[1] is None:
+      with self.lock:
+        if entry[1] is None:
+          entry[1] = pickle.loads(entry[0])
+    return entry[1]
+
+  def __contains__(self,name):
+    return name in self.entries
+
+  def __iter__(self):
+    return iter(self.entries)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def keys(self):
+    return self.entries.keys()
+
+  def values(self):
+    return [self[name] for name in self.entries]
+
+  def items(self):
+    return [(name,self[name]) for name in self.entries]
+
+  def get(self,name,default=None):
+    return self[name] if name in self.entries else default
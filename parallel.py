@@ -0,0 +1,131 @@
+# Stoichometry
+# parallel.py
+#
+# This file contains a multi-process execution mode for stoichiometry
+# calculations on very large single datasets. The active oxide block is copied
+# once into shared memory, split into row shards that a pool of worker processes
+# normalize and convert to formula cations, and the results are written into a
+# shared output buffer. Only shard bounds and the (small) coefficient matrix are
+# passed to the workers; dataframes are never pickled.
+#
+
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import util
+import instrument
+import stoich_calc
+
+# Default number of rows per shard.
+def_shard_rows = 100000
+
+# Per-process buffers of calc_shard, reused for all shards of a worker.
+shard_workspace = None
+
+# SharedArray class.
+class SharedArray(object):
+  '''
+  A float array in a shared memory block. The process that creates the array
+  owns the block and unlinks it on close; other processes attach by name.
+
+  Arrays are column-major, like the blocks of a dataframe, so that reductions
+  along rows add values in the same order as for the dataframe's own arrays
+  and results match those of calc_stoich exactly.
+  '''
+  def __init__(self,shape,name=None):
+    self.shape = tuple(shape)
+    nbytes = max(int(np.prod(self.shape))*8,1)
+    self.owner = name is None
+    self.shm = shared_memory.SharedMemory(name=name,create=self.owner,size=nbytes)
+    self.array = np.ndarray(self.shape,dtype=float,buffer=self.shm.buf,order='F')
+
+  @property
+  def name(self):
+    return self.shm.name
+
+  def close(self):
+    self.array = None
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
+
+# calc_shard function.
+def calc_shard(data_name,data_shape,out_name,start,stop,coefficients,apfu,norm_mask=None,target_sum=100.0):
+  '''
+  Worker function: normalizes (if norm_mask is given) and converts the rows
+  start:stop of the shared oxide block to formula cations and totals, written to
+  the same rows of the shared output buffer. Returns the positions of the rows
+  without any data, if normalized.
+  '''
+  global shard_workspace
+  if shard_workspace is None:
+    shard_workspace = stoich_calc.CationWorkspace()
+  data = SharedArray(data_shape,data_name)
+  out = SharedArray((data_shape[0],data_shape[1] + 1),out_name)
+  try:
+    block = data.array[start:stop]
+    empty = np.zeros(0,int)
+    if norm_mask is not None:
+      block, empty = stoich_calc.normalize_kernel(block,norm_mask,target_sum)
+      empty = np.flatnonzero(empty) + start
+    stoich_calc.cations_kernel(block,coefficients,apfu,shard_workspace,out.array[start:stop])
+    return empty
+  finally:
+    data.close()
+    out.close()
+
+# calc_stoich_parallel function.
+@instrument.instrumented()
+def calc_stoich_parallel(dataset,min_sys,sram_lib,hydrous=None,workers=None,shard_rows=def_shard_rows,pool=None):
+  '''
+  Performs the calculations of calc_stoich on a pool of worker processes, with
+  the active oxide block split into shards of shard_rows rows. The block and the
+  results are exchanged through shared memory. Returns a dataframe of formula
+  cations, identical to that of calc_stoich.
+
+  Arguments:
+  - workers    - Number of worker processes (default: CPU count).
+  - shard_rows - Rows per shard; datasets with at most this many rows (or a
+                 single worker) are calculated in this process.
+  - pool       - An existing concurrent.futures.ProcessPoolExecutor to use,
+                 e.g., for several calls; otherwise one is started per call.
+  '''
+  if hydrous is None:
+    hydrous = min_sys.isHydrous()
+  workers = workers or os.cpu_count()
+  if len(dataset) <= shard_rows or (workers <= 1 and pool is None):
+    return stoich_calc.calc_stoich(dataset,min_sys,sram_lib,hydrous)
+  active_cols = stoich_calc.find_active_columns(dataset,min_sys)
+  coefficients, target = stoich_calc.basis_coefficients(active_cols,min_sys,sram_lib)
+  coefficients = np.ascontiguousarray(coefficients)
+  norm_mask = np.ones(len(active_cols),dtype=bool) if hydrous else None
+  # Copy the active oxide block into shared memory, with a shared output buffer.
+  rows, cols = len(dataset), len(active_cols)
+  data = SharedArray((rows,cols))
+  out = SharedArray((rows,cols + 1))
+  own_pool = pool is None
+  try:
+    data.array[:] = dataset[list(active_cols.keys())].to_numpy(dtype=float)
+    if instrument.enabled:
+      instrument.record_copy(data.array.nbytes)
+    if own_pool:
+      pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    futures = [pool.submit(calc_shard,data.name,data.shape,out.name,start,min(start + shard_rows,rows),
+                           coefficients,target,norm_mask)
+               for start in range(0,rows,shard_rows)]
+    empty = np.concatenate([f.result() for f in futures])
+    formula_cations = pd.DataFrame(out.array.copy(),dataset.index,
+                                   stoich_calc.results_column_names(active_cols,min_sys),copy=False)
+  finally:
+    if own_pool and pool is not None:
+      pool.shutdown()
+    data.close()
+    out.close()
+  if len(empty):
+    mask = np.zeros(rows,dtype=bool)
+    mask[empty] = True
+    stoich_calc.warn_empty_analyses(dataset.index,mask)
+  stoich_calc.set_results_metadata(formula_cations,min_sys,sram_lib)
+  return formula_cations
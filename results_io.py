@@ -0,0 +1,145 @@
+# Stoichometry
+# results_io.py
+#
+# This file contains functions for exporting and importing stoichiometry results
+# in text (.stoichres) and columnar binary formats. Parquet and Feather files
+# require the optional pyarrow package; the NumPy formats are always available.
+#
+# Binary formats carry the results metadata stored in DataFrame.attrs (mineral
+# system, anions per formula unit, SRAM library version). The .npy format writes
+# the results array to a .npy file with a .json sidecar holding the index,
+# column names and metadata, so that results can be memory-mapped.
+#
+
+import importlib.util
+import json
+import os
+import numpy as np
+import pandas as pd
+import util
+
+# Optional dependency for Parquet/Feather support (see load_pyarrow).
+has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+
+# Results file formats, by file extension.
+formats = {'.stoichres':'text','.parquet':'parquet','.feather':'feather','.npy':'npy','.npz':'npz'}
+metadata_key = b'stoichiometry'
+
+# available_formats function.
+def available_formats():
+  '''
+  Returns the list of results file formats supported in this environment.
+  '''
+  if not has_pyarrow:
+    return ['text','npy','npz']
+  return ['text','parquet','feather','npy','npz']
+
+# load_pyarrow function.
+def load_pyarrow():
+  '''
+  Imports and returns the pyarrow package, with its feather and parquet modules.
+  '''
+  import pyarrow.feather
+  import pyarrow.parquet
+  return pyarrow
+
+# results_format function.
+def results_format(path):
+  '''
+  Returns the results file format for the specified path, based on its extension.
+  '''
+  ext = os.path.splitext(path)[1].lower()
+  if ext not in formats:
+    raise ValueError('Unknown results file extension: {:}'.format(ext))
+  fmt = formats[ext]
+  if fmt not in available_formats():
+    raise RuntimeError('The {:} format requires the pyarrow package.'.format(fmt))
+  return fmt
+
+# sidecar_path function.
+def sidecar_path(path):
+  '''
+  Returns the path of the .json sidecar file for the specified .npy results file.
+  '''
+  return os.path.splitext(path)[0] + '.json'
+
+# export_results function.
+def export_results(results,path,delimiter='\t'):
+  '''
+  Writes the specified results dataframe to the specified path, in the format
+  given by the file extension (see formats).
+  '''
+  fmt = results_format(path)
+  metadata = dict(results.attrs)
+  if fmt == 'text':
+    results.to_csv(path,sep=delimiter)
+  elif fmt in ['parquet','feather']:
+    pyarrow = load_pyarrow()
+    table = pyarrow.Table.from_pandas(results)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[metadata_key] = json.dumps(metadata).encode('utf-8')
+    table = table.replace_schema_metadata(schema_metadata)
+    if fmt == 'parquet':
+      pyarrow.parquet.write_table(table,path)
+    else:
+      # Uncompressed, so the file can be memory-mapped.
+      pyarrow.feather.write_feather(table,path,compression='uncompressed')
+  else:
+    data = results_array(results)
+    header = {'index':results.index.tolist(),'index_name':results.index.name,
+              'columns':list(results.columns),'metadata':metadata}
+    if fmt == 'npy':
+      np.save(path,data)
+      with open(sidecar_path(path),'w') as fp:
+        json.dump(header,fp)
+    else:
+      np.savez(path,data=data,header=np.array(json.dumps(header)))
+
+# results_array function.
+def results_array(results):
+  '''
+  Returns the values of the specified results dataframe as a float array,
+  raising a ValueError if it has non-numeric columns.
+  '''
+  for (colname,dtype) in results.dtypes.items():
+    if not pd.api.types.is_numeric_dtype(dtype):
+      raise ValueError('NumPy results files only support numeric columns: {:}'.format(colname))
+  return np.ascontiguousarray(results.to_numpy(dtype=float))
+
+# import_results function.
+def import_results(path,mmap=True,delimiter='\t'):
+  '''
+  Reads results from the specified path, in the format given by the file
+  extension. Metadata are restored to DataFrame.attrs. If mmap is True, .npy
+  and Feather results are memory-mapped rather than read into memory; .npy
+  results are mapped copy-on-write, so they can be modified without changing
+  the file.
+  '''
+  fmt = results_format(path)
+  metadata = {}
+  if fmt == 'text':
+    results = pd.read_csv(path,sep=delimiter,index_col=0)
+  elif fmt in ['parquet','feather']:
+    pyarrow = load_pyarrow()
+    if fmt == 'parquet':
+      table = pyarrow.parquet.read_table(path,memory_map=mmap)
+    else:
+      table = pyarrow.feather.read_table(path,memory_map=mmap)
+    schema_metadata = table.schema.metadata or {}
+    if metadata_key in schema_metadata:
+      metadata = json.loads(schema_metadata[metadata_key].decode('utf-8'))
+    results = table.to_pandas()
+  else:
+    if fmt == 'npy':
+      data = np.load(path,mmap_mode='c' if mmap else None)
+      with open(sidecar_path(path),'r') as fp:
+        header = json.load(fp)
+    else:
+      with np.load(path) as npz:
+        data = npz['data']
+        header = json.loads(str(npz['header']))
+    index = pd.Index(header['index'],name=header['index_name'])
+    results = pd.DataFrame(data,index,header['columns'],copy=False)
+    metadata = header['metadata']
+  results.attrs.update(metadata)
+  return results
@@ -0,0 +1,257 @@
+# Stoichometry
+# session_store.py
+#
+# This file contains a memory-bounded store for the datasets and results of an
+# interactive stoichiometry session. When the dataframes held in memory exceed
+# the memory budget, the least recently used ones are spilled to binary files on
+# local disk (see results_io) and dropped from memory. Spilled entries are
+# reloaded transparently, memory-mapped where the file format allows it, the
+# next time they are accessed.
+#
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import results_io
+
+# Default memory budget (bytes).
+def_budget = 2**30
+
+# StoreEntry class.
+class StoreEntry(object):
+  '''
+  A single entry of a SessionStore. The value is None while the entry is spilled
+  to disk; mapped values are memory-mapped from the spill file and do not count
+  against the memory budget.
+  '''
+  __slots__ = ['value','nbytes','path','mapped']
+
+  def __init__(self,value,nbytes):
+    self.value = value
+    self.nbytes = nbytes
+    self.path = None
+    self.mapped = False
+
+  def location(self):
+    if self.value is None:
+      return 'disk'
+    return 'mapped' if self.mapped else 'memory'
+
+# SessionStore class.
+class SessionStore(object):
+  '''
+  A mapping of names to dataframes, with a memory budget (in bytes). Entries
+  are kept in least recently used order; when the in-memory entries exceed the
+  budget, the least recently used ones are spilled to files in spill_dir (a new
+  temporary directory by default). Dataframes whose columns are all float64 are
+  spilled to .npy files and reloaded memory-mapped (copy-on-write, so they can be
+  modified in place without changing the file); others are spilled to Feather
+  files if pyarrow is available, and otherwise stay in memory, so that their
+  dtypes are preserved. Mapped entries are never spilled again; other reloaded
+  entries are rewritten the next time they are spilled.
+
+  Keys may be any hashable; see SessionView for a mapping over a subset of them.
+  '''
+  def __init__(self,budget=def_budget,spill_dir=None):
+    self.budget = budget
+    self.spill_dir = spill_dir
+    self.owns_spill_dir = spill_dir is None
+    self.entries = OrderedDict()
+    self.spills = 0
+    self.reloads = 0
+    self.counter = 0
+
+  def __setitem__(self,key,value):
+    if key in self.entries:
+      self.discard(key)
+    self.entries[key] = StoreEntry(value,frame_nbytes(value))
+    self.enforce_budget(key)
+
+  def __getitem__(self,key):
+    entry = self.entries[key]
+    self.entries.move_to_end(key)
+    if entry.value is None:
+      entry.value = results_io.import_results(entry.path,mmap=True)
+      entry.mapped = results_io.results_format(entry.path) == 'npy'
+      if not entry.mapped:
+        # The value is a copy: write it again when it is next spilled.
+        remove_spill_file(entry.path)
+        entry.path = None
+      self.reloads += 1
+      self.enforce_budget(key)
+    return entry.value
+
+  def __delitem__(self,key):
+    self.discard(key)
+
+  def __contains__(self,key):
+    return key in self.entries
+
+  def __iter__(self):
+    return iter(list(self.entries))
+
+  def __len__(self):
+    return len(self.entries)
+
+  def keys(self):
+    return list(self.entries)
+
+  def get(self,key,default=None):
+    return self[key] if key in self.entries else default
+
+  def discard(self,key):
+    '''
+    Removes the specified entry and its spill file, if any.
+    '''
+    entry = self.entries.pop(key)
+    if entry.path is not None:
+      remove_spill_file(entry.path)
+
+  def memory_in_use(self):
+    '''
+    Returns the number of bytes of the entries held in memory (not mapped).
+    '''
+    return sum(e.nbytes for e in self.entries.values() if e.value is not None and not e.mapped)
+
+  def enforce_budget(self,keep=None):
+    '''
+    Spills least recently used entries until the entries held in memory fit the
+    budget. The specified key (the entry just used) is never spilled.
+    '''
+    in_use = self.memory_in_use()
+    for (key,entry) in list(self.entries.items()):
+      if in_use <= self.budget:
+        break
+      if key == keep or entry.value is None or entry.mapped:
+        continue
+      if self.spill(entry):
+        in_use -= entry.nbytes
+
+  def spill(self,entry):
+    '''
+    Writes the specified entry to a spill file (unless it already has one) and
+    drops it from memory. Returns False if it cannot be spilled.
+    '''
+    if entry.path is None:
+      path = self.spill_path(entry.value)
+      if path is None:
+        return False
+      results_io.export_results(entry.value,path)
+      entry.path = path
+    entry.value = None
+    entry.mapped = False
+    self.spills += 1
+    return True
+
+  def spill_path(self,value):
+    '''
+    Returns a new spill file path for the specified value, or None if it cannot
+    be spilled.
+    '''
+    if not hasattr(value,'columns'):
+      return None
+    if all(dtype == np.float64 for dtype in value.dtypes):
+      ext = '.npy'
+    elif 'feather' in results_io.available_formats():
+      ext = '.feather'
+    else:
+      return None
+    if self.spill_dir is None:
+      self.spill_dir = tempfile.mkdtemp(prefix='stoich-session-')
+    self.counter += 1
+    return os.path.join(self.spill_dir,'entry-{:06d}{:}'.format(self.counter,ext))
+
+  def usage(self):
+    '''
+    Returns a list of (key, bytes, location) tuples, from least to most recently
+    used, where location is 'memory', 'mapped' or 'disk'.
+    '''
+    return [(k,e.nbytes,e.location()) for (k,e) in self.entries.items()]
+
+  def report(self):
+    '''
+    Returns a human-readable report of the memory usage of the store.
+    '''
+    lines = ['{:<56} {:>12} {:>8}'.format('Entry','MB','Location')]
+    for (key,nbytes,location) in self.usage():
+      lines.append('{:<56} {:>12.2f} {:>8}'.format(str(key),nbytes/2**20,location))
+    lines.append('In memory: {:.2f} MB of {:.2f} MB budget ({:} spills, {:} reloads).'.format(
+                 self.memory_in_use()/2**20,self.budget/2**20,self.spills,self.reloads))
+    return '\n'.join(lines)
+
+  def close(self):
+    '''
+    Removes all entries and spill files.
+    '''
+    for key in list(self.entries):
+      self.discard(key)
+    if self.owns_spill_dir and self.spill_dir is not None:
+      shutil.rmtree(self.spill_dir,ignore_errors=True)
+      self.spill_dir = None
+
+# SessionView class.
+class SessionView(object):
+  '''
+  A mapping over the entries of a SessionStore whose keys are (namespace, name)
+  tuples, e.g., the datasets or results of a session, which then share the
+  store's memory budget. Keys of the view are the names.
+  '''
+  def __init__(self,store,namespace):
+    self.store = store
+    self.namespace = namespace
+
+  def __setitem__(self,name,value):
+    self.store[(self.namespace,name)] = value
+
+  def __getitem__(self,name):
+    return self.store[(self.namespace,name)]
+
+  def __delitem__(self,name):
+    del self.store[(self.namespace,name)]
+
+  def __contains__(self,name):
+    return (self.namespace,name) in self.store
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def keys(self):
+    return [k[1] for k in self.store.keys() if k[0] == self.namespace]
+
+  def get(self,name,default=None):
+    return self.store.get((self.namespace,name),default)
+
+  def usage(self):
+    '''
+    Returns a list of (name, bytes, location) tuples (see SessionStore.usage).
+    '''
+    return [(k[1],nbytes,location) for (k,nbytes,location) in self.store.usage() if k[0] == self.namespace]
+
+# frame_nbytes function.
+def frame_nbytes(value):
+  '''
+  Returns the memory usage (bytes) of the specified dataframe, including its
+  index and object columns; 0 for other values.
+  '''
+  if hasattr(value,'memory_usage') and hasattr(value,'columns'):
+    return int(value.memory_usage(index=True,deep=True).sum())
+  return 0
+
+# remove_spill_file function.
+def remove_spill_file(path):
+  '''
+  Removes a spill file and, for .npy files, its .json sidecar.
+  '''
+  paths = [path]
+  if results_io.results_format(path) == 'npy':
+    paths.append(results_io.sidecar_path(path))
+  for p in paths:
+    try:
+      os.remove(p)
+    except OSError:
+      pass
@@ -1,34 +1,239 @@
 # stoich_calc.py
 
+import itertools
+import re
+import threading
 import numpy as np
 import pandas as pd
-from mineral_system import MineralSystem
 import util
+import mineral_system
+import instrument
+
+# Species treated as volatiles when normalizing oxides on a volatile-free basis.
+volatile_species = ['H2O','CO2','F','Cl','S','SO3','LOI']
+# Largest number of endmembers handled by calc_endmember_proportions.
+max_endmembers = 12
+# Suffixes of the 1-sigma uncertainty columns of oxides (e.g., 'SiO2 1s').
+sigma_suffixes = [' 1s',' 1sigma',' sigma',' err','_1s','_sigma','_err']
+# Aliases of oxide column headers (without units), used by find_active_columns.
+column_aliases = {'FeOT':'FeO','FeOt':'FeO','FeO*':'FeO','FeO(T)':'FeO','FeOtot':'FeO',
+                  'Fe2O3T':'Fe2O3','Fe2O3t':'Fe2O3','Fe2O3*':'Fe2O3','Fe2O3(T)':'Fe2O3'}
+# Regular expressions for units and tokens of column headers.
+re_header_units = re.compile(r'[\s_]*[(\[]?\s*wt\.?\s*%?\s*[)\]]?\s*$|\s+',re.IGNORECASE)
+re_header_tokens = re.compile(r'[^A-Za-z0-9]+')
+# Cache of resolved active columns, keyed by header, oxides and aliases.
+resolver_cache = util.LRUCache(256)
+# Per-row results caches for calc_stoich_incremental (see RowCache), keyed by
+# mineral system, SRAM library version and active columns.
+row_caches = util.LRUCache(16)
+# Largest number of rows held by a single RowCache.
+max_cached_rows = 2000000
 
 # anhydrous_silicates_stoich function.
 def anhydrous_silicates_stoich(dataset,sram_lib,min_systems):
-  # Prompt user to select mineral system; get active columns.
+  # Prompt user to select mineral system.
   asms = prompt_min_sys(min_systems,False,True)
-  active_cols = find_active_columns(dataset,asms)
-  # Perform stoichiometry calculations.
-  formula_cations = calc_cations_per_formula_unit(dataset,active_cols,asms,sram_lib)
+  # Perform stoichiometry calculations; rows seen before are reused from cache.
+  formula_cations = calc_stoich_incremental(dataset,asms,sram_lib)
   # Report success.
   print('Anhydrous stoichiometric calculations complete.\n')
   return formula_cations
 
 # hydrous_silicates_stoich function.
 def hydrous_silicates_stoich(dataset,sram_lib,min_systems):
-  # Prompt user to select mineral system; get active columns.
+  # Prompt user to select mineral system.
   hsms = prompt_min_sys(min_systems,True,True)
-  active_cols = find_active_columns(dataset,hsms)
-  # Normalize anhydrous oxides.
-  normalized_dataset = normalize_anhydrous_oxides(dataset,active_cols,hsms)
-  # Perform stoichiometry calculations.
-  formula_cations = calc_cations_per_formula_unit(normalized_dataset,active_cols,hsms,sram_lib)
+  # Normalize anhydrous oxides and perform stoichiometry calculations; rows seen
+  # before are reused from cache.
+  formula_cations = calc_stoich_incremental(dataset,hsms,sram_lib)
   # Report success.
   print('Hydrous stoichiometric calculations complete.\n')
   return formula_cations
 
+# calc_stoich function.
+@instrument.instrumented()
+def calc_stoich(dataset,min_sys,sram_lib,hydrous=None,workspace=None):
+  '''
+  Performs stoichiometry calculations for the specified dataset and MineralSystem
+  without prompting the user. If hydrous is True (by default, for hydrous
+  systems), the anhydrous oxides are normalized first. Returns a dataframe of
+  formula cations. A CationWorkspace may be specified for repeated calls (see
+  calc_cations_per_formula_unit).
+  '''
+  if hydrous is None:
+    hydrous = min_sys.isHydrous()
+  active_cols = find_active_columns(dataset,min_sys)
+  if hydrous:
+    # Only the active oxides are copied for normalization.
+    dataset = dataset[list(active_cols.keys())]
+    if instrument.enabled:
+      instrument.record_copy(dataset.memory_usage(index=False).sum())
+    dataset = normalize_anhydrous_oxides(dataset,active_cols,min_sys,inplace=True)
+  return calc_cations_per_formula_unit(dataset,active_cols,min_sys,sram_lib,workspace)
+
+# calc_stoich_bases function.
+@instrument.instrumented()
+def calc_stoich_bases(dataset,min_sys,sram_lib,bases,hydrous=None):
+  '''
+  Performs the calculations of calc_stoich for each of the specified
+  normalization bases at once (see calc_cations_multi_basis). Returns a list of
+  dataframes of formula cations, one per basis.
+  '''
+  if hydrous is None:
+    hydrous = min_sys.isHydrous()
+  active_cols = find_active_columns(dataset,min_sys)
+  if hydrous:
+    dataset = normalize_anhydrous_oxides(dataset[list(active_cols.keys())],active_cols,min_sys,inplace=True)
+  return calc_cations_multi_basis(dataset,active_cols,min_sys,sram_lib,bases)
+
+# stream_stoich function.
+@instrument.instrumented()
+def stream_stoich(path,output_path,min_sys,sram_lib,chunksize=100000,delimiter='\t'):
+  '''
+  Performs stoichiometry calculations for the dataset file at the specified path
+  in chunks of rows, appending the results of each chunk to the output file, so
+  that memory use is bounded by the chunk size rather than the file size. The
+  output is identical to writing the results of calc_stoich for the whole
+  dataset. Returns the number of rows processed. The buffers of a single
+  CationWorkspace are reused for all chunks.
+  '''
+  rows = 0
+  workspace = CationWorkspace()
+  reader = pd.read_csv(path,sep=delimiter,index_col=0,chunksize=chunksize)
+  with open(output_path,'w',newline='') as out:
+    for chunk in reader:
+      results = calc_stoich(chunk,min_sys,sram_lib,workspace=workspace)
+      results.to_csv(out,sep=delimiter,header=(rows == 0))
+      rows += len(results)
+  return rows
+
+# RowCache class.
+class RowCache(object):
+  '''
+  Results of calc_stoich for individual rows, keyed by a 64-bit hash of the
+  row's active oxide values. Hashes are held in pandas Indexes, so that a block
+  of rows is looked up with a single hash table probe per row and chunk. Rows
+  are added as a new chunk, which is merged with the previous one while that is
+  no more than twice its size, so each row is copied O(log n) times and there
+  are O(log n) chunks. Lookups and additions hold a lock, so caches can be
+  shared between threads.
+  '''
+  __slots__ = ['chunks','rows','ncols','hits','misses','lock']
+
+  def __init__(self,ncols):
+    self.chunks = []
+    self.rows = 0
+    self.ncols = ncols
+    self.hits, self.misses = 0, 0
+    self.lock = threading.Lock()
+
+  def lookup(self,hashes):
+    '''
+    Returns a tuple of (values, missing) for the specified row hashes. The lock
+    must be held.
+    '''
+    values = np.full((len(hashes),self.ncols),np.nan)
+    missing = np.ones(len(hashes),bool)
+    for (chunk_hashes,chunk_values) in self.chunks:
+      rows = np.flatnonzero(missing)
+      if len(rows) == 0:
+        break
+      pos = chunk_hashes.get_indexer(hashes[rows])
+      found = pos >= 0
+      values[rows[found]] = chunk_values[pos[found]]
+      missing[rows[found]] = False
+    return values, missing
+
+  def take(self,hashes):
+    '''
+    Returns a tuple of (values, missing) for the specified row hashes, where
+    missing flags the rows that are not in the cache (their values are NaN).
+    '''
+    with self.lock:
+      values, missing = self.lookup(hashes)
+      self.hits += len(hashes) - int(missing.sum())
+    return values, missing
+
+  def add(self,hashes,values):
+    '''
+    Adds the results (values) of rows with the specified unique hashes, skipping
+    those already in the cache. The cache is cleared first if it would exceed
+    max_cached_rows; of a larger block, only the last max_cached_rows rows are kept.
+    '''
+    with self.lock:
+      new = self.lookup(hashes)[1]
+      hashes, values = hashes[new], values[new]
+      self.misses += len(hashes)
+      if self.rows + len(hashes) > max_cached_rows:
+        self.chunks, self.rows = [], 0
+        keep = max(len(hashes) - max_cached_rows,0)
+        hashes, values = hashes[keep:], values[keep:]
+      if len(hashes) == 0:
+        return
+      self.chunks.append((pd.Index(hashes),np.array(values)))
+      self.rows += len(hashes)
+      while len(self.chunks) > 1 and len(self.chunks[-2][0]) <= 2*len(self.chunks[-1][0]):
+        ((h1,v1),(h2,v2)) = self.chunks[-2:]
+        self.chunks[-2:] = [(h1.append(h2),np.concatenate([v1,v2]))]
+
+  def info(self):
+    with self.lock:
+      return {'hits':self.hits,'misses':self.misses,'rows':self.rows,'chunks':len(self.chunks),
+              'bytes':sum(h.nbytes + v.nbytes for (h,v) in self.chunks)}
+
+# calc_stoich_incremental function.
+@instrument.instrumented()
+def calc_stoich_incremental(dataset,min_sys,sram_lib,hydrous=None):
+  '''
+  Performs the calculations of calc_stoich, reusing the results of rows that
+  have been calculated before for the same MineralSystem and SRAM library
+  version, e.g., when a dataset that is appended to is imported again. Rows are
+  matched by a hash of their active oxide values, so only new or changed rows
+  are calculated. Returns a dataframe of formula cations, identical to that of
+  calc_stoich. Nothing is cached for plain dict SRAM libraries (see
+  util.sram_version).
+  '''
+  if util.sram_version(sram_lib) is None:
+    return calc_stoich(dataset,min_sys,sram_lib,hydrous)
+  if hydrous is None:
+    hydrous = min_sys.isHydrous()
+  active_cols = find_active_columns(dataset,min_sys)
+  key = (min_sys.getSystemName(),min_sys.getOxideList(),min_sys.getNormalization(),
+         hydrous,util.sram_version(sram_lib),tuple(active_cols.items()))
+  cnames = results_column_names(active_cols,min_sys)
+  cache = row_caches.get(key)
+  if cache is None:
+    cache = row_caches.setdefault(key,RowCache(len(cnames)))
+  # Hash the active oxide values of each row; look them up in the cache.
+  block = dataset[list(active_cols.keys())]
+  hashes = pd.util.hash_pandas_object(block,index=False).to_numpy()
+  values, missing = cache.take(hashes)
+  # Calculate each new (distinct) row once, and add it to the cache.
+  if missing.any():
+    new_rows = np.flatnonzero(missing)
+    new_hashes = pd.Index(hashes[new_rows])
+    unique = ~new_hashes.duplicated()
+    new_rows, new_hashes = new_rows[unique], new_hashes[unique]
+    computed = calc_stoich(dataset.iloc[new_rows],min_sys,sram_lib,hydrous).to_numpy()
+    cache.add(new_hashes.to_numpy(),computed)
+    values[missing] = computed[new_hashes.get_indexer(hashes[missing])]
+  formula_cations = pd.DataFrame(values,dataset.index,cnames,copy=False)
+  set_results_metadata(formula_cations,min_sys,sram_lib)
+  return formula_cations
+
+# row_cache_info function.
+def row_cache_info():
+  '''
+  Returns a list of statistics (hits, misses, rows and bytes) of the per-row
+  results caches, with the mineral system name and SRAM library version of each.
+  '''
+  stats = []
+  for (key,cache) in row_caches.items():
+    info = {'system':key[0],'sram_version':key[4]}
+    info.update(cache.info())
+    stats.append(info)
+  return stats
+
 # --------------------------------------------------------------------------------
 # Common functions.
 # --------------------------------------------------------------------------------
@@ -45,26 +250,101 @@ def prompt_min_sys(min_systems,hydrous,silicate):
   sms = filtered_systems[syslist[idx]]
   print('You chose the {:} mineral system.'.format(sms.getSystemName()))
   print('The number of anions per formula unit is: {:}'.format(sms.getAnionsPerFormulaUnit()))
+  if sms.getNormalization()[0] != 'anions':
+    print('The formula is normalized to: {:}'.format(mineral_system.format_basis(sms.getNormalization())))
   return sms
 
 # find_active_columns function.
-def find_active_columns(dataset,mineral_sys):
+@instrument.instrumented()
+def find_active_columns(dataset,mineral_sys,aliases=None):
   '''
   Returns a map of the column names (keys) in the specified dataset that contain
-  the oxides (values) in the specified MineralSystem.
-  '''
-  # Gather list of oxides that exist in the dataset, and in the selected mineral system.
-  cols = list(dataset.columns)
-  active_cols = {}
-  # Outer for loop; traverse list of oxides.
-  for ox in mineral_sys.getOxideList():
-    # Inner for loop; traverse remaining columns in dataset.
-    for cname in cols:
-      if ox in cname:
-        active_cols[cname] = ox
-        cols.remove(cname)
-        break # Break out of the inner loop.
-  return active_cols
+  the oxides (values) in the specified MineralSystem, in the order of the oxides.
+
+  Columns are resolved with resolve_columns, using the specified alias table
+  (column_aliases by default). Results are cached per dataset header, so that
+  repeated calculations on datasets with the same columns skip resolution.
+  '''
+  if aliases is None:
+    aliases = column_aliases
+  oxides = mineral_sys.getOxideList()
+  key = (tuple(dataset.columns),oxides,tuple(sorted(aliases.items())))
+  active_cols = resolver_cache.get(key)
+  if active_cols is None:
+    active_cols = resolve_columns(key[0],oxides,aliases)
+    resolver_cache.put(key,active_cols)
+  return dict(active_cols)
+
+# normalize_header function.
+def normalize_header(header):
+  '''
+  Returns the specified column header with whitespace and units (e.g., 'wt%',
+  '(wt.%)', '_wt') removed, for matching against oxides and aliases.
+  '''
+  return re_header_units.sub('',str(header)).strip()
+
+# resolve_columns function.
+def resolve_columns(columns,oxides,aliases):
+  '''
+  Resolves the specified oxides to the specified column headers. Each oxide is
+  resolved to at most one column, and each column to at most one oxide. The
+  headers are indexed once, and matches are made in order of precedence (over
+  all oxides) by: exact header, header without wt% units, alias (see
+  column_aliases) and case-insensitive header without units. Headers that only
+  contain an oxide among other words or units (e.g., 'NiO ppm' or 'Std SiO2')
+  are not resolved, and a warning lists them for the oxides left unresolved.
+  Uncertainty columns (see sigma_suffixes) are never resolved. Returns a map of
+  column names to oxides, in oxide order.
+  '''
+  # Build an index of the headers for each level of precedence.
+  lower_aliases = {k.lower():v for (k,v) in aliases.items()}
+  levels = [{},{},{},{}]
+  tokens = {}
+  for cname in columns:
+    if any(str(cname).endswith(suffix) for suffix in sigma_suffixes):
+      continue
+    norm = normalize_header(cname)
+    keys = [cname,norm,aliases.get(norm,lower_aliases.get(norm.lower())),norm.lower()]
+    for (level,k) in zip(levels,keys):
+      if k is not None:
+        level.setdefault(k,[]).append(cname)
+    for token in re_header_tokens.split(str(cname)):
+      tokens.setdefault(token,[]).append(cname)
+  # Resolve oxides, claiming columns by order of precedence.
+  resolved, used = {}, set()
+  for (n,level) in enumerate(levels):
+    for ox in oxides:
+      if ox in resolved:
+        continue
+      for cname in level.get(ox.lower() if n == 3 else ox,[]):
+        if cname not in used:
+          resolved[ox] = cname
+          used.add(cname)
+          break
+  # Report headers that mention an unresolved oxide but are not wt% columns.
+  skipped = ['{!r} ({:})'.format(cname,ox) for ox in oxides if ox not in resolved
+             for cname in tokens.get(ox,[]) if cname not in used]
+  if skipped:
+    print('WARNING: Columns not used as oxide wt%: {:}'.format(', '.join(skipped)))
+  return {resolved[ox]:ox for ox in oxides if ox in resolved}
+
+# results_column_names function.
+def results_column_names(active_cols,min_sys,basis=None):
+  '''
+  Returns the list of column names used for final results, i.e., one
+  '<cation>/<apfu> <anion>' column per active column, followed by 'Total'.
+  For normalization bases (by default, MineralSystem.getNormalization) other
+  than anions, the columns are named '<cation>/<target> cations' or
+  '<cation>/<target> charge'.
+  '''
+  (kind,target,excluded) = min_sys.getNormalization() if basis is None else basis
+  cnames = []
+  oxides, elements = min_sys.getOxideList(), min_sys.getOxideElements()
+  for ox in active_cols.values():
+    (cation,anion) = elements[oxides.index(ox)]
+    cnames.append('{:}/{:g} {:}'.format(cation,target,anion if kind == 'anions' else kind))
+  cnames.append('Total')
+  return cnames
 
 # new_results_dataframe function.
 def new_results_dataframe(dataset,active_cols,min_sys,intermediate=True):
@@ -81,46 +361,657 @@ def new_results_dataframe(dataset,active_cols,min_sys,intermediate=True):
   data.fill(np.nan)
   # Modify column names if not an intermediate structure.
   if not intermediate:
-    for cni, colname in enumerate(cnames):
-      ecounts = util.parse_compound(active_cols[colname])
-      elems = list(ecounts.keys())
-      cnames[cni] = '{:}/{:} {:}'.format(elems[0],min_sys.getAnionsPerFormulaUnit(),elems[1])
+    cnames = results_column_names(active_cols,min_sys)
     # Add 'Total' column.
-    cnames.append('Total')
     data = np.hstack([data,np.zeros((len(rnames),1))])
   # Construct and return new dataframe.
   return pd.DataFrame(data,rnames,cnames)
 
 # normalize_anhydrous_oxides function.
-def normalize_anhydrous_oxides(dataset,active_cols,min_sys):
+@instrument.instrumented()
+def normalize_anhydrous_oxides(dataset,active_cols,min_sys,target=100.0,inplace=False):
   '''
   Normalizes the anhydrous oxides in the specified dataset. Returns a copy of the
   specified dataset with the anhydrous oxides normalized to 100.
+
+  All analyses are normalized at once. Non-positive and missing values are
+  excluded from the sums and left unchanged, and analyses without any data are
+  left unchanged (a single warning lists them).
+
+  Arguments:
+  - target  - The normalization target: 100.0 by default, any other custom sum,
+              or 'volatile-free' to normalize only the non-volatile oxides
+              (see volatile_species) to 100, leaving volatiles unchanged.
+  - inplace - If True, the active columns of the specified dataset are
+              overwritten and the dataset itself is returned, avoiding a copy
+              of the full dataset.
   '''
-  normalized_dataset = dataset.copy()
-  # Collect column indices.
-  col_indices = []
-  for colname in active_cols.keys():
-    col_indices.append(list(normalized_dataset.columns).index(colname))
-  # Normalize one analysis at a time.
-  for r in range(len(normalized_dataset)):
-    temp_sum = 0.0
-    for cidx in col_indices:
-      if normalized_dataset.iloc[r,cidx] > 0.0: # This makes sure the avoid empty values.
-        temp_sum += normalized_dataset.iloc[r,cidx]
-    if temp_sum > 0.0:
-      norm_factor = 100.0/temp_sum
-    else: 
-      print('WARNING: No data for analysis: {:}'.format(normalized_dataset.index[r]))
-    for cidx in col_indices:
-      normalized_dataset.iloc[r,cidx] *= norm_factor
+  # Determine which active columns are normalized, and to what sum.
+  cols = list(active_cols.keys())
+  if isinstance(target,str):
+    if target != 'volatile-free':
+      raise ValueError('Unknown normalization target: {:}'.format(target))
+    norm_mask = np.array([active_cols[c] not in volatile_species for c in cols],dtype=bool)
+    target_sum = 100.0
+  else:
+    norm_mask = np.ones(len(cols),dtype=bool)
+    target_sum = float(target)
+  # Normalize the active oxide block in a single pass.
+  block = dataset[cols].to_numpy(dtype=float)
+  if instrument.enabled:
+    instrument.record_copy(block.nbytes)
+  block, empty = normalize_kernel(block,norm_mask,target_sum)
+  warn_empty_analyses(dataset.index,empty)
+  # Store the normalized oxides.
+  normalized_dataset = dataset if inplace else dataset.copy()
+  if instrument.enabled and not inplace:
+    instrument.record_copy(dataset.memory_usage(index=False).sum())
+  normalized_dataset[cols] = block
   return normalized_dataset
 
+# normalize_kernel function.
+def normalize_kernel(block,norm_mask,target_sum):
+  '''
+  Vectorized core of normalize_anhydrous_oxides. Scales the positive values of
+  the oxides flagged in norm_mask in each row of the specified block so that
+  they sum to target_sum. Returns a tuple of (normalized block, empty), where
+  empty flags the rows without any data (which are left unchanged).
+  '''
+  valid = (block > 0.0) & norm_mask
+  sums = np.where(valid,block,0.0).sum(axis=1)
+  empty = ~(sums > 0.0)
+  with np.errstate(divide='ignore'):
+    factors = np.where(empty,1.0,target_sum/sums)
+  return np.where(valid,block*factors[:,np.newaxis],block), empty
+
+# warn_empty_analyses function.
+def warn_empty_analyses(index,empty):
+  '''
+  Prints a single warning listing (up to 10 of) the analyses flagged in empty.
+  '''
+  if empty.any():
+    names = [str(name) for name in index[empty][:10]]
+    if empty.sum() > len(names):
+      names.append('...')
+    print('WARNING: No data for {:} analyses: {:}'.format(empty.sum(),', '.join(names)))
+
 # calc_cations_per_formula_unit function.
-def calc_cations_per_formula_unit(dataset,active_cols,min_sys,sram_lib):
+@instrument.instrumented()
+def calc_cations_per_formula_unit(dataset,active_cols,min_sys,sram_lib,workspace=None):
+  '''
+  Computes the number of cations per formula unit for the specified dataset
+  and MineralSystem. Returns a dataframe of results.
+
+  All analyses are processed at once using the oxide coefficient matrix of the
+  MineralSystem (see cations_kernel), normalized on its basis (see
+  MineralSystem.getNormalization); on the anion basis, results match those of
+  calc_cations_per_formula_unit_reference.
+
+  If a CationWorkspace is specified, the oxide data and intermediate arrays are
+  held in its buffers, so that repeated calls on similar batches do not allocate
+  them again; only the results array is allocated, and it is wrapped as the
+  results dataframe without a copy.
+  '''
+  coefficients, target = basis_coefficients(active_cols,min_sys,sram_lib)
+  cnames = results_column_names(active_cols,min_sys)
+  if workspace is None:
+    # Gather oxide data for the active columns, perform calculations and wrap the results.
+    data = dataset[list(active_cols.keys())].to_numpy(dtype=float)
+    formula, totals = cations_kernel(data,coefficients,target)
+    formula_cations = pd.DataFrame(np.column_stack([formula,totals]),dataset.index,cnames)
+  else:
+    data = workspace.load(dataset,list(active_cols.keys()))
+    out = np.empty((len(dataset),len(cnames)),order='F')
+    cations_kernel(data,coefficients,target,workspace,out)
+    formula_cations = pd.DataFrame(out,dataset.index,cnames,copy=False)
+  if instrument.enabled:
+    instrument.record_copy(data.nbytes)
+    instrument.record_copy(formula_cations.memory_usage(index=False).sum())
+  set_results_metadata(formula_cations,min_sys,sram_lib)
+  return formula_cations
+
+# calc_cations_multi_basis function.
+@instrument.instrumented()
+def calc_cations_multi_basis(dataset,active_cols,min_sys,sram_lib,bases):
+  '''
+  Computes the number of cations per formula unit on each of the specified
+  normalization bases (tuples, or text such as 'cations 8 exclude Na, K'; see
+  mineral_system.parse_basis) in a single batched pass over the oxide data: the
+  coefficient matrices of all bases are stacked and evaluated by cations_kernel
+  at once. Returns a list of dataframes, one per basis, with the columns and
+  metadata of calc_cations_per_formula_unit on that basis (and equal values, up
+  to rounding).
+  '''
+  bases = [mineral_system.parse_basis(basis) for basis in bases]
+  if not bases:
+    raise ValueError('No normalization bases specified.')
+  stacked = [basis_coefficients(active_cols,min_sys,sram_lib,basis) for basis in bases]
+  coefficients = np.stack([c for (c,target) in stacked])
+  targets = np.array([target for (c,target) in stacked],dtype=float)
+  data = dataset[list(active_cols.keys())].to_numpy(dtype=float)
+  formula, totals = cations_kernel(data[np.newaxis],coefficients[:,np.newaxis],targets[:,np.newaxis])
+  results = []
+  for (b,basis) in enumerate(bases):
+    formula_cations = pd.DataFrame(np.column_stack([formula[b],totals[b]]),dataset.index,
+                                   results_column_names(active_cols,min_sys,basis),copy=False)
+    set_results_metadata(formula_cations,min_sys,sram_lib,basis)
+    results.append(formula_cations)
+  return results
+
+# set_results_metadata function.
+def set_results_metadata(results,min_sys,sram_lib,basis=None):
+  '''
+  Records the MineralSystem, anions per formula unit, normalization basis (by
+  default, that of the MineralSystem) and SRAM library version used for the
+  specified results dataframe in its attrs, so that they are carried along when
+  the results are exported.
+  '''
+  results.attrs['mineral_system'] = min_sys.getSystemName()
+  results.attrs['anions_per_formula_unit'] = min_sys.getAnionsPerFormulaUnit()
+  results.attrs['normalization'] = mineral_system.format_basis(basis or min_sys.getNormalization())
+  results.attrs['sram_version'] = util.sram_digest(sram_lib)
+
+# active_coefficients function.
+def active_coefficients(active_cols,min_sys,sram_lib):
+  '''
+  Returns the rows of the MineralSystem coefficient matrix that correspond to
+  the oxides in the specified active columns map, in column order.
+  '''
+  oxides = min_sys.getOxideList()
+  rows = [oxides.index(ox) for ox in active_cols.values()]
+  return min_sys.getCoefficientMatrix(sram_lib)[rows]
+
+# basis_coefficients function.
+def basis_coefficients(active_cols,min_sys,sram_lib,basis=None):
+  '''
+  Returns a tuple of (coefficients, target) for the specified normalization
+  basis (by default, that of the MineralSystem): the active_coefficients rows
+  with the normalization weights of the basis (see
+  MineralSystem.getBasisWeights) in place of the anion counts, and the target
+  sum of the basis, as arguments for cations_kernel.
+  '''
+  coefficients = active_coefficients(active_cols,min_sys,sram_lib)
+  basis = min_sys.getNormalization() if basis is None else basis
+  if basis[0] != 'anions':
+    oxides = min_sys.getOxideList()
+    rows = [oxides.index(ox) for ox in active_cols.values()]
+    coefficients = coefficients.copy()
+    coefficients[:,1] = min_sys.getBasisWeights(basis)[rows]
+  return coefficients, basis[1]
+
+# cations_kernel function.
+def cations_kernel(data,coefficients,apfu,workspace=None,out=None):
+  '''
+  Vectorized core of the cations per formula unit calculation.
+
+  Arguments:
+  - data         - Array of oxide wt% values, with oxides along the last axis.
+  - coefficients - Array of (cation count, anion count, molecular weight) rows
+                   for each oxide, e.g., from MineralSystem.getCoefficientMatrix.
+                   The anion counts may be replaced by the weights of another
+                   normalization basis (see basis_coefficients).
+  - apfu         - The number of anions per formula unit (or the target sum of
+                   the normalization basis).
+  - workspace    - A CationWorkspace for the intermediate arrays (2-D data only).
+  - out          - Array of shape (rows, oxides + 1) that receives the formula
+                   cations and, in the last column, the totals (with workspace).
+
+  Leading axes of the arguments are broadcast against each other; e.g., data of
+  shape (1, rows, oxides), coefficients of shape (systems, 1, oxides, 3) and apfu
+  of shape (systems, 1) evaluate several mineral systems at once.
+
+  Returns a tuple of (formula_cations, totals) (views of out, with workspace).
+  Non-positive and missing values are excluded from the anion sums, and yield
+  NaN formula cations; analyses without any data yield NaN formula cations and
+  a total of zero.
+  '''
+  if workspace is not None:
+    return workspace_cations_kernel(data,coefficients,apfu,workspace,out)
+  with np.errstate(divide='ignore',invalid='ignore'):
+    # Molecular, anion and cation proportions.
+    molecular_props = data/coefficients[...,2]
+    anion_props = molecular_props*coefficients[...,1]
+    cation_props = molecular_props*coefficients[...,0]
+    # Conversion factors from anions.
+    anion_sums = np.where(anion_props > 0.0,anion_props,0.0).sum(axis=-1)
+    factors = apfu/anion_sums
+    # Number of cations and totals.
+    formula_cations = np.where(cation_props > 0.0,cation_props*factors[...,np.newaxis],np.nan)
+  totals = np.nansum(formula_cations,axis=-1)
+  return formula_cations, totals
+
+# workspace_cations_kernel function.
+def workspace_cations_kernel(data,coefficients,apfu,workspace,out=None):
+  '''
+  In-place variant of cations_kernel for 2-D data, using the buffers of the
+  specified CationWorkspace for intermediate arrays and writing the formula
+  cations and totals into out (allocated if not given). Each step performs the
+  same floating-point operations as cations_kernel, so results are identical.
+  '''
+  rows, cols = data.shape
+  if out is None:
+    out = np.empty((rows,cols + 1),order='F')
+  props, scratch, sums, mask = workspace.buffers(rows,cols)
+  formula, totals = out[:,:cols], out[:,cols]
+  with np.errstate(divide='ignore',invalid='ignore'):
+    # Molecular and anion proportions; anion sums over positive values.
+    np.divide(data,coefficients[:,2],out=props)
+    np.multiply(props,coefficients[:,1],out=scratch)
+    np.greater(scratch,0.0,out=mask)
+    np.logical_not(mask,out=mask)
+    np.copyto(scratch,0.0,where=mask)
+    np.sum(scratch,axis=-1,out=sums)
+    # Conversion factors from anions (in place of the sums).
+    np.divide(apfu,sums,out=sums)
+    # Cation proportions, and the number of cations where they are positive.
+    np.multiply(props,coefficients[:,0],out=props)
+    np.multiply(props,sums[:,np.newaxis],out=formula)
+    np.greater(props,0.0,out=mask)
+    np.logical_not(mask,out=mask)
+    np.copyto(formula,np.nan,where=mask)
+  # Totals, ignoring NaN (as np.nansum).
+  np.copyto(scratch,formula)
+  np.isnan(scratch,out=mask)
+  np.copyto(scratch,0.0,where=mask)
+  np.sum(scratch,axis=-1,out=totals)
+  return formula, totals
+
+# CationWorkspace class.
+class CationWorkspace(object):
+  '''
+  Reusable buffers for calc_cations_per_formula_unit and cations_kernel, sized
+  to (rows, oxides). Buffers grow only when a larger batch arrives; smaller
+  batches use views of them. Buffers are column-major, like the blocks of a
+  dataframe, so that results match those computed without a workspace.
+
+  A workspace must not be used by more than one thread at a time.
+  '''
+  __slots__ = ['rows','cols','data','props','scratch','sums','mask','allocations']
+
+  def __init__(self,rows=0,cols=0):
+    self.rows, self.cols = 0, 0
+    self.data = self.props = self.scratch = self.sums = self.mask = None
+    self.allocations = 0
+    self.reserve(rows,cols)
+
+  def reserve(self,rows,cols):
+    '''
+    Grows the buffers, if needed, to hold at least rows x cols values.
+    '''
+    if rows <= self.rows and cols <= self.cols and self.data is not None:
+      return
+    self.rows, self.cols = max(rows,self.rows), max(cols,self.cols)
+    shape = (self.rows,self.cols)
+    self.data = np.empty(shape,order='F')
+    self.props = np.empty(shape,order='F')
+    self.scratch = np.empty(shape,order='F')
+    self.mask = np.empty(shape,dtype=bool,order='F')
+    self.sums = np.empty(self.rows)
+    self.allocations += 1
+
+  def buffers(self,rows,cols):
+    '''
+    Returns views (props, scratch, sums, mask) of the intermediate buffers for
+    a batch of rows x cols values, growing the buffers if needed.
+    '''
+    self.reserve(rows,cols)
+    return (self.props[:rows,:cols],self.scratch[:rows,:cols],self.sums[:rows],self.mask[:rows,:cols])
+
+  def load(self,dataset,columns):
+    '''
+    Copies the specified columns of the dataset (as floats) into the data buffer,
+    and returns the view of the buffer holding them.
+    '''
+    rows, cols = len(dataset), len(columns)
+    self.reserve(rows,cols)
+    data = self.data[:rows,:cols]
+    for (j,colname) in enumerate(columns):
+      data[:,j] = dataset[colname].to_numpy(dtype=float)
+    return data
+
+  def nbytes(self):
+    '''
+    Returns the memory footprint (bytes) of the buffers.
+    '''
+    if self.data is None:
+      return 0
+    return self.data.nbytes + self.props.nbytes + self.scratch.nbytes + self.mask.nbytes + self.sums.nbytes
+
+  def info(self):
+    '''
+    Returns a dictionary with the capacity, footprint and number of (re)allocations.
+    '''
+    return {'rows':self.rows,'columns':self.cols,'bytes':self.nbytes(),'allocations':self.allocations}
+
+# classify_mineral_systems function.
+@instrument.instrumented()
+def classify_mineral_systems(dataset,min_systems,sram_lib,block_rows=50000):
+  '''
+  Evaluates every MineralSystem in the specified dictionary for every analysis
+  in the specified dataset in one batched computation, and ranks the systems per
+  analysis by their stoichiometric misfit, i.e., the relative deviation of the
+  total cations per formula unit from the ideal number of cations (see
+  MineralSystem.getCationsPerFormulaUnit).
+
+  Returns a dataframe with 'Total', 'Misfit' and 'Rank' columns for each system,
+  followed by the 'Best Fit' system name and its 'Best Misfit'. Systems without
+  an ideal number of cations or without active columns are not ranked. Since
+  formula cations do not depend on the scale of the oxide data, hydrous systems
+  are evaluated without normalization. Rows are processed in blocks of
+  block_rows to bound memory use.
+  '''
+  systems = list(min_systems.values())
+  if not systems:
+    raise ValueError('No mineral systems to evaluate.')
+  names = [ms.getSystemName() for ms in systems]
+  # Gather the active columns of all systems, and stack their coefficients.
+  system_cols = [find_active_columns(dataset,ms) for ms in systems]
+  columns = list(dict.fromkeys(c for active_cols in system_cols for c in active_cols))
+  coefficients = np.zeros((len(systems),len(columns),3))
+  coefficients[...,2] = 1.0 # Inactive columns contribute no cations or anions.
+  for (s,active_cols) in enumerate(system_cols):
+    if active_cols:
+      idx = [columns.index(c) for c in active_cols]
+      coefficients[s,idx] = active_coefficients(active_cols,systems[s],sram_lib)
+  apfu = np.array([ms.getAnionsPerFormulaUnit() for ms in systems],dtype=float)
+  ideal = np.array([ms.getCationsPerFormulaUnit() for ms in systems],dtype=float)
+  # Compute total cations for all systems and analyses.
+  data = dataset[columns].to_numpy(dtype=float)
+  totals = np.empty((len(systems),len(data)))
+  for start in range(0,len(data),block_rows):
+    block = data[np.newaxis,start:start + block_rows]
+    totals[:,start:start + block_rows] = cations_kernel(block,coefficients[:,np.newaxis],apfu[:,np.newaxis])[1]
+  # Rank systems by misfit.
+  with np.errstate(invalid='ignore'):
+    misfits = np.where(totals > 0.0,np.abs(totals - ideal[:,np.newaxis])/ideal[:,np.newaxis],np.nan)
+  ranked = np.where(np.isnan(misfits),np.inf,misfits)
+  order = np.argsort(ranked,axis=0,kind='stable')
+  ranks = np.empty_like(order)
+  np.put_along_axis(ranks,order,np.arange(1,len(systems) + 1)[:,np.newaxis],axis=0)
+  ranks = np.where(np.isnan(misfits),np.nan,ranks)
+  best_misfits = ranked.min(axis=0)
+  has_fit = np.isfinite(best_misfits)
+  # Assemble results.
+  classification = pd.DataFrame(index=dataset.index)
+  for (s,name) in enumerate(names):
+    classification['{:} Total'.format(name)] = totals[s]
+    classification['{:} Misfit'.format(name)] = misfits[s]
+    classification['{:} Rank'.format(name)] = ranks[s]
+  best_names = np.array(names + [None],dtype=object)
+  classification['Best Fit'] = best_names[np.where(has_fit,order[0],len(names))]
+  classification['Best Misfit'] = np.where(has_fit,best_misfits,np.nan)
+  return classification
+
+# formula_element function.
+def formula_element(colname):
+  '''
+  Returns the cation of the specified results column name (e.g., 'Si' for the
+  'Si/4 O' column), or None for other columns such as 'Total'.
+  '''
+  return colname.split('/')[0] if '/' in colname else None
+
+# results_cation_matrix function.
+def results_cation_matrix(formula_cations,elements):
+  '''
+  Returns an array with the cations per formula unit of each of the specified
+  elements (columns) for each analysis (rows) in the specified results. Columns
+  of the same cation are summed, and missing values count as zero.
+  '''
+  cations = np.zeros((len(formula_cations),len(elements)))
+  for colname in formula_cations.columns:
+    elem = formula_element(colname)
+    if elem in elements:
+      cations[:,elements.index(elem)] += np.nan_to_num(formula_cations[colname].to_numpy(dtype=float))
+  return cations
+
+# calc_endmember_proportions function.
+@instrument.instrumented()
+def calc_endmember_proportions(formula_cations,min_sys,tol=1e-9):
+  '''
+  Computes the endmember proportions of the MineralSystem for each analysis in
+  the specified formula cations results (from calc_cations_per_formula_unit).
+  Returns a copy of the results with an 'X(<endmember>)' column for each
+  endmember and an 'Endmember Residual' column.
+
+  The proportions are the non-negative, sum-to-one least-squares fit of the
+  endmember cation compositions (see MineralSystem.getEndmemberComposition) to
+  the cations of each analysis; cations that do not occur in any endmember are
+  not fitted. The fit is solved for all analyses at once by solving the
+  equality-constrained problem for every subset of endmembers and keeping the
+  best feasible solution per analysis.
+  '''
+  composition, elements = min_sys.getEndmemberComposition()
+  nem = len(composition)
+  if nem == 0 or nem > max_endmembers:
+    raise ValueError('Cannot fit {:} endmembers for the {:} mineral system.'.format(nem,min_sys.getSystemName()))
+  cations = results_cation_matrix(formula_cations,elements)
+  best_props = np.zeros((len(cations),nem))
+  best_resid = np.full(len(cations),np.inf)
+  for k in range(1,nem + 1):
+    for subset in itertools.combinations(range(nem),k):
+      idx = list(subset)
+      sub = composition[idx]
+      # KKT system of the sum-to-one least-squares problem, shared by all analyses.
+      kkt = np.zeros((k + 1,k + 1))
+      kkt[:k,:k] = 2.0*sub @ sub.T
+      kkt[:k,k], kkt[k,:k] = 1.0, 1.0
+      rhs = np.hstack([2.0*cations @ sub.T,np.ones((len(cations),1))])
+      props = (rhs @ np.linalg.pinv(kkt))[:,:k]
+      feasible = (props >= -tol).all(axis=1)
+      props = np.clip(props,0.0,None)
+      resid = np.sqrt(((props @ sub - cations)**2).sum(axis=1))
+      better = feasible & (resid < best_resid)
+      best_props[better] = 0.0
+      best_props[np.ix_(better,idx)] = props[better]
+      best_resid[better] = resid[better]
+  # Analyses without data have no proportions.
+  empty = ~(formula_cations['Total'].to_numpy(dtype=float) > 0.0)
+  best_props[empty], best_resid[empty] = np.nan, np.nan
+  proportions = formula_cations.copy()
+  for (j,em) in enumerate(min_sys.getEndmemberList()):
+    proportions['X({:})'.format(em)] = best_props[:,j]
+  proportions['Endmember Residual'] = best_resid
+  return proportions
+
+# calc_fe3_charge_balance function.
+@instrument.instrumented()
+def calc_fe3_charge_balance(formula_cations,min_sys,cpfu=None):
+  '''
+  Splits the total iron in the specified formula cations results (from
+  calc_cations_per_formula_unit, with all Fe as Fe2+) into Fe2+ and Fe3+ by
+  charge balance (Droop, 1987), for all analyses at once:
+
+    F = 2X(1 - T/S)
+
+  where X is the number of anions per formula unit, T the ideal number of
+  cations per formula unit (cpfu, or MineralSystem.getCationsPerFormulaUnit)
+  and S the observed total cations. Where F is positive, the formula is
+  normalized to T cations and F is the number of Fe3+ cations, clamped to the
+  total Fe; otherwise all Fe is Fe2+ and the formula is unchanged.
+
+  Returns a copy of the results in which the Fe columns are replaced by
+  'Fe2+' and 'Fe3+' columns. The results must be normalized to anions, with all
+  Fe computed as FeO; a ValueError is raised for mineral systems with other Fe
+  oxides (e.g., Fe2O3), for which the equation does not hold.
+  '''
+  if not formula_cations.attrs.get('normalization','anions').startswith('anions'):
+    raise ValueError('Charge balance requires results normalized to anions, not: {:}'.format(
+                     formula_cations.attrs['normalization']))
+  apfu = min_sys.getAnionsPerFormulaUnit()
+  if cpfu is None:
+    cpfu = min_sys.getCationsPerFormulaUnit()
+  if cpfu is None:
+    raise ValueError('No ideal cations per formula unit for the {:} mineral system.'.format(min_sys.getSystemName()))
+  fe_oxides = [ox for (ox,(cation,anion)) in zip(min_sys.getOxideList(),min_sys.getOxideElements()) if cation == 'Fe']
+  if fe_oxides and fe_oxides != ['FeO']:
+    raise ValueError('Charge balance requires all Fe as FeO, but the {:} mineral system lists: {:}'.format(
+                     min_sys.getSystemName(),', '.join(fe_oxides)))
+  fe_cols = [c for c in formula_cations.columns if formula_element(c) == 'Fe']
+  if not fe_cols:
+    raise ValueError('No Fe columns in the results.')
+  # Compute Fe3+ and the normalization factors.
+  total_fe = results_cation_matrix(formula_cations,['Fe'])[:,0]
+  totals = formula_cations['Total'].to_numpy(dtype=float)
+  with np.errstate(divide='ignore'):
+    fe3 = 2.0*apfu*(1.0 - cpfu/totals)
+    scale = np.where(fe3 > 0.0,cpfu/totals,1.0)
+  total_fe = total_fe*scale
+  fe3 = np.clip(fe3,0.0,total_fe)
+  has_fe = total_fe > 0.0
+  # Assemble results, with Fe2+ and Fe3+ in place of the first Fe column.
+  balanced = pd.DataFrame(index=formula_cations.index)
+  for colname in formula_cations.columns:
+    if colname == fe_cols[0]:
+      suffix = colname[len('Fe'):]
+      balanced['Fe2+' + suffix] = np.where(has_fe,total_fe - fe3,np.nan)
+      balanced['Fe3+' + suffix] = np.where(has_fe,fe3,np.nan)
+    elif colname not in fe_cols:
+      balanced[colname] = formula_cations[colname].to_numpy(dtype=float)*scale
+  balanced.attrs.update(formula_cations.attrs)
+  return balanced
+
+# calc_site_allocation function.
+@instrument.instrumented()
+def calc_site_allocation(formula_cations,min_sys):
+  '''
+  Allocates the cations in the specified formula cations results (from
+  calc_cations_per_formula_unit or calc_fe3_charge_balance) to the sites of the
+  MineralSystem (see MineralSystem.getSiteList), for all analyses at once.
+
+  Sites are filled in order, each with its elements in order of priority up to
+  the site multiplicity: the cumulative sums of the remaining cations, clipped
+  to the multiplicity, give the filled amounts, whose differences are the site
+  occupancies. Cations allocated to a site are not available to later sites.
+  Elements are matched by the cation of the results columns (e.g., 'Fe2+' and
+  'Fe3+' after charge balance).
+
+  Returns a copy of the results with a '<element>(<site>)' occupancy column for
+  each element and a 'Vacancy(<site>)' column for each site, followed by an
+  'Unallocated' column with the cations left over. Analyses without data have
+  no occupancies.
+  '''
+  sites = min_sys.getSiteList()
+  if not sites:
+    raise ValueError('No site rules for the {:} mineral system.'.format(min_sys.getSystemName()))
+  elements = list(dict.fromkeys(e for (site,mult,site_elements) in sites for e in site_elements))
+  remaining = results_cation_matrix(formula_cations,elements)
+  totals = formula_cations['Total'].to_numpy(dtype=float)
+  empty = ~(totals > 0.0)
+  allocated = formula_cations.copy()
+  allocated_sum = np.zeros(len(allocated))
+  for (site,mult,site_elements) in sites:
+    idx = [elements.index(e) for e in site_elements]
+    filled = np.clip(np.cumsum(remaining[:,idx],axis=1),0.0,mult)
+    occupancy = np.diff(filled,axis=1,prepend=0.0)
+    remaining[:,idx] -= occupancy
+    allocated_sum += filled[:,-1]
+    occupancy[empty] = np.nan
+    for (j,elem) in enumerate(site_elements):
+      allocated['{:}({:})'.format(elem,site)] = occupancy[:,j]
+    allocated['Vacancy({:})'.format(site)] = np.where(empty,np.nan,mult - filled[:,-1])
+  allocated['Unallocated'] = np.where(empty,np.nan,totals - allocated_sum)
+  return allocated
+
+# find_sigma_columns function.
+def find_sigma_columns(dataset,active_cols):
+  '''
+  Returns a map of the active columns (keys) to the columns in the specified
+  dataset that hold their 1-sigma uncertainties (values), as identified by the
+  sigma_suffixes. Active columns without an uncertainty column are omitted.
+  '''
+  sigma_cols = {}
+  for colname in active_cols.keys():
+    for suffix in sigma_suffixes:
+      if colname + suffix in dataset.columns:
+        sigma_cols[colname] = colname + suffix
+        break
+  return sigma_cols
+
+# calc_cations_uncertainty function.
+@instrument.instrumented()
+def calc_cations_uncertainty(dataset,active_cols,min_sys,sram_lib,draws=1000,sigma_cols=None,
+                             seed=None,max_block_bytes=2**28):
+  '''
+  Estimates the uncertainty of the cations per formula unit by Monte Carlo
+  propagation. Each of the specified number of draws perturbs the atomic weights
+  of the elements by their SRAM uncertainties, and the oxide wt% values by their
+  1-sigma uncertainties (sigma_cols, a map of active columns to uncertainty
+  columns; found with find_sigma_columns by default), all normally distributed.
+
+  All draws are evaluated with the batched cation kernel, in blocks of draws and
+  rows holding at most about max_block_bytes of intermediate arrays. The seed
+  initializes the random number generators: the atomic weights and each draw
+  have their own stream (see numpy.random.SeedSequence.spawn), consumed in row
+  order, so that results are reproducible and do not depend on the block sizes
+  (up to rounding of the sums).
+
+  Returns a tuple of (mean, std) dataframes, with the same columns as the
+  results of calc_cations_per_formula_unit. Draws that yield no value for an
+  oxide (e.g., a value perturbed below zero) are excluded for that oxide.
+  '''
+  seeds = np.random.SeedSequence(seed).spawn(draws + 1)
+  rng = np.random.default_rng(seeds[0])
+  draw_rngs = [np.random.default_rng(s) for s in seeds[1:]]
+  cols = list(active_cols.keys())
+  if sigma_cols is None:
+    sigma_cols = find_sigma_columns(dataset,active_cols)
+  # Oxide data, uncertainties and nominal results.
+  data = dataset[cols].to_numpy(dtype=float)
+  sigmas = np.zeros_like(data)
+  for (j,colname) in enumerate(cols):
+    if colname in sigma_cols:
+      sigmas[:,j] = np.nan_to_num(dataset[sigma_cols[colname]].to_numpy(dtype=float))
+  coefficients, apfu = basis_coefficients(active_cols,min_sys,sram_lib)
+  nominal = np.column_stack(cations_kernel(data,coefficients,apfu))
+  # Atomic weights of the elements in each draw.
+  counts, elements = util.parse_many(list(active_cols.values()))
+  weights = np.array([sram_lib[e]['SRAM'].get('value',np.nan) for e in elements])
+  weight_sigmas = np.array([sram_lib[e]['SRAM'].get('uncertainty',0.0) for e in elements])
+  draw_weights = weights + weight_sigmas*rng.standard_normal((draws,len(elements)))
+  # Choose block sizes from the memory budget (about eight arrays of block size).
+  nrows, ncols = data.shape
+  row_block = max(1,min(nrows,max_block_bytes//(8*8*(ncols + 1))))
+  draw_block = max(1,min(draws,max_block_bytes//(8*8*(ncols + 1)*row_block)))
+  # Accumulate deviations from the nominal results over all draws.
+  count = np.zeros_like(nominal)
+  dsum = np.zeros_like(nominal)
+  dsum2 = np.zeros_like(nominal)
+  for d0 in range(0,draws,draw_block):
+    block_weights = draw_weights[d0:d0 + draw_block]
+    block_coefficients = np.repeat(coefficients[np.newaxis],len(block_weights),axis=0)
+    block_coefficients[...,2] = block_weights @ counts.T
+    for r0 in range(0,nrows,row_block):
+      rows = slice(r0,r0 + row_block)
+      noise = np.empty((len(block_weights),) + data[rows].shape)
+      for (i,draw_rng) in enumerate(draw_rngs[d0:d0 + draw_block]):
+        noise[i] = draw_rng.standard_normal(data[rows].shape)
+      block = data[rows] + sigmas[rows]*noise
+      formula, totals = cations_kernel(block,block_coefficients[:,np.newaxis],apfu)
+      dev = np.concatenate([formula,totals[...,np.newaxis]],axis=-1) - nominal[rows]
+      valid = ~np.isnan(dev)
+      dev = np.where(valid,dev,0.0)
+      count[rows] += valid.sum(axis=0)
+      dsum[rows] += dev.sum(axis=0)
+      dsum2[rows] += (dev**2).sum(axis=0)
+  with np.errstate(divide='ignore',invalid='ignore'):
+    mean = np.where(count > 0,nominal + dsum/count,np.nan)
+    var = np.where(count > 1,(dsum2 - dsum**2/count)/(count - 1),np.nan)
+  cnames = results_column_names(active_cols,min_sys)
+  mean = pd.DataFrame(mean,dataset.index,cnames)
+  std = pd.DataFrame(np.sqrt(np.clip(var,0.0,None)),dataset.index,cnames)
+  for results in [mean,std]:
+    set_results_metadata(results,min_sys,sram_lib)
+  return mean, std
+
+# calc_cations_per_formula_unit_reference function.
+@instrument.instrumented()
+def calc_cations_per_formula_unit_reference(dataset,active_cols,min_sys,sram_lib):
   '''
   Computes the number of cations per formula unit for the specified dataset
   and MineralSystem. Returns a dataframe of results.
+
+  This is the original row-by-row implementation, kept as a reference for
+  checking the vectorized calc_cations_per_formula_unit function.
   '''
   # Prepare data structures.
   molecular_props = new_results_dataframe(dataset,active_cols,min_sys)
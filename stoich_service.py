@@ -0,0 +1,346 @@
+# Stoichometry
+# stoich_service.py
+#
+# This file contains a local, long-running HTTP/JSON service for stoichiometry
+# calculations. The SRAM library, mineral systems and compiled formulas are
+# loaded once and kept warm in a pool of worker processes, so that pipeline steps
+# do not pay the startup cost of the interactive program for every dataset.
+#
+# Endpoints:
+#   GET  /health     Service status.
+#   GET  /systems    Names of the loaded mineral systems.
+#   POST /calculate  Formula cations for a batch of analyses, e.g.,
+#                    {"system": "Olivine", "columns": ["SiO2", "FeO", "MgO"],
+#                     "index": ["a1", "a2"], "rows": [[40.1, 9.8, 49.5], [...]]}
+#                    Rows may also be given as objects (oxide: wt%), in which
+#                    case "columns" is omitted. The response is streamed as JSON
+#                    lines: the results columns, one object per chunk of rows
+#                    (index and data, with null for missing values), and a final
+#                    object with the number of rows and the request timing.
+#
+# The service only listens on localhost by default and needs no network access.
+#
+# Usage:
+#   python stoich_service.py [--host HOST] [--port PORT] [--workers N]
+#                            [--max-concurrent N] [--chunk-rows N] [--minsys-dir DIR]
+#
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import os
+import time
+import pandas as pd
+import util
+import batch
+import stoich_calc
+import stoichiometry
+
+# Service defaults.
+def_host = '127.0.0.1'
+def_port = 8765
+def_max_concurrent = 4
+def_chunk_rows = 10000
+max_body_bytes = 256*2**20
+header_timeout = 30.0
+reasons = {200:'OK',400:'Bad Request',404:'Not Found',405:'Method Not Allowed',411:'Length Required',
+           413:'Payload Too Large',500:'Internal Server Error'}
+
+# ServiceError class.
+class ServiceError(Exception):
+  '''
+  An error reported to the client with the specified HTTP status.
+  '''
+  def __init__(self,status,message):
+    super().__init__(message)
+    self.status = status
+
+# warm_worker function.
+def warm_worker():
+  '''
+  Returns once the worker process has loaded its resources (see batch.init_worker)
+  and performed a one-row calculation for each mineral system, so the first
+  request does not pay for compiling formulas or filling the workspace.
+  '''
+  for min_sys in batch.worker_min_systems.values():
+    oxides = min_sys.getOxideList()
+    stoich_calc.calc_stoich(pd.DataFrame([[1.0]*len(oxides)],columns=oxides),min_sys,batch.worker_sram_lib,
+                            workspace=batch.worker_workspace)
+  return len(batch.worker_min_systems)
+
+# calc_chunk function.
+def calc_chunk(system_name,columns,index,rows):
+  '''
+  Performs stoichiometry calculations in a worker process for a chunk of rows
+  (lists of values for the specified columns). Returns a tuple of (columns,
+  index, data) of the results, with None for missing values.
+  '''
+  dataset = pd.DataFrame(rows,index,columns).apply(pd.to_numeric,errors='coerce')
+  results = stoich_calc.calc_stoich(dataset,batch.worker_min_systems[system_name],batch.worker_sram_lib,
+                                    workspace=batch.worker_workspace)
+  data = [[None if math.isnan(v) else v for v in row] for row in results.to_numpy().tolist()]
+  return list(results.columns), results.index.tolist(), data
+
+# parse_calculation function.
+def parse_calculation(body,min_systems):
+  '''
+  Validates the specified /calculate request body (a dict). Returns a tuple of
+  (system name, columns, index, rows), raising a ServiceError if it is invalid
+  or if none of its columns contain an oxide of the mineral system.
+  '''
+  if not isinstance(body,dict):
+    raise ServiceError(400,'Request body must be a JSON object.')
+  system_name = body.get('system')
+  if system_name not in min_systems:
+    raise ServiceError(400,'Unknown mineral system: {:}'.format(system_name))
+  rows = body.get('rows')
+  if not isinstance(rows,list):
+    raise ServiceError(400,'"rows" must be a list.')
+  columns = body.get('columns')
+  if rows and all(isinstance(row,dict) for row in rows):
+    # Rows given as objects: use the union of their keys, in order of appearance.
+    columns = list(dict.fromkeys(k for row in rows for k in row))
+    rows = [[row.get(c) for c in columns] for row in rows]
+  elif not all(isinstance(row,list) for row in rows):
+    raise ServiceError(400,'Rows must be all objects or all lists of values.')
+  elif columns is None and not rows:
+    columns = []
+  elif not isinstance(columns,list) or not all(isinstance(c,str) for c in columns):
+    raise ServiceError(400,'"columns" must be a list of names for rows of values.')
+  if any(len(row) != len(columns) for row in rows):
+    raise ServiceError(400,'Every row must have one value per column.')
+  min_sys = min_systems[system_name]
+  if rows and not stoich_calc.find_active_columns(pd.DataFrame(columns=columns),min_sys):
+    raise ServiceError(400,'No {:} oxide columns found (expected some of {:}).'.format(
+                       system_name,', '.join(min_sys.getOxideList())))
+  index = body.get('index')
+  if index is None:
+    index = list(range(len(rows)))
+  elif not isinstance(index,list) or len(index) != len(rows):
+    raise ServiceError(400,'"index" must have one label per row.')
+  return system_name, columns, index, rows
+
+# StoichService class.
+class StoichService(object):
+  '''
+  The stoichiometry calculation service. Calculations run in a pool of worker
+  processes that load the SRAM library and mineral systems once, and at most
+  max_concurrent requests are calculated at a time (others wait their turn).
+  '''
+  def __init__(self,workers=None,max_concurrent=def_max_concurrent,chunk_rows=def_chunk_rows):
+    self.workers = workers or os.cpu_count()
+    self.max_concurrent = max_concurrent
+    self.chunk_rows = chunk_rows
+    self.min_systems = None
+    self.pool = None
+    self.semaphore = None
+    self.started = None
+    self.requests = 0
+
+  async def start(self,host=def_host,port=def_port):
+    '''
+    Loads resources, starts and warms the worker pool, and returns the server.
+    '''
+    paths = stoichiometry.stoich_engine.paths
+    self.min_systems = stoichiometry.get_min_systems()
+    self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,initializer=batch.init_worker,
+                                                       initargs=(paths['nist'],paths['patch'],paths['snapshot'],
+                                                                 paths['minsys_dir']))
+    self.semaphore = asyncio.Semaphore(self.max_concurrent)
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(self.pool,warm_worker) for i in range(self.workers)])
+    self.started = time.time()
+    return await asyncio.start_server(self.handle,host,port)
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.shutdown()
+
+  async def handle(self,reader,writer):
+    '''
+    Handles a single HTTP request on the specified connection.
+    '''
+    start = time.perf_counter()
+    method, path, status, rows = '-', '-', 500, 0
+    try:
+      try:
+        method, path, body = await asyncio.wait_for(read_request(reader),header_timeout)
+        if path == '/health' and method == 'GET':
+          status = await send_json(writer,200,{'status':'ok','systems':len(self.min_systems),
+                                               'requests':self.requests,'uptime':time.time() - self.started})
+        elif path == '/systems' and method == 'GET':
+          status = await send_json(writer,200,{'systems':sorted(self.min_systems.keys())})
+        elif path == '/calculate':
+          if method != 'POST':
+            raise ServiceError(405,'Use POST for /calculate.')
+          try:
+            # Parse in the default executor: a large body would block every other connection.
+            request = await asyncio.get_running_loop().run_in_executor(None,parse_json,body)
+          except ValueError as e:
+            raise ServiceError(400,'Invalid JSON: {:}'.format(e))
+          rows = len(request.get('rows') or []) if isinstance(request,dict) else 0
+          status = await self.calculate(writer,request,start)
+        else:
+          raise ServiceError(404,'Unknown endpoint: {:} {:}'.format(method,path))
+      except ServiceError as e:
+        status = await send_json(writer,e.status,{'error':str(e)})
+      except asyncio.TimeoutError:
+        status = await send_json(writer,400,{'error':'Timed out reading request.'})
+    except (ConnectionError,asyncio.IncompleteReadError):
+      pass
+    except Exception as e:
+      status = 500
+      try:
+        await send_json(writer,500,{'error':'{:}: {:}'.format(type(e).__name__,e)})
+      except ConnectionError:
+        pass
+    finally:
+      self.requests += 1
+      writer.close()
+      print('{:} {:} {:} ({:} rows, {:.3f} s)'.format(method,path,status,rows,time.perf_counter() - start))
+
+  async def calculate(self,writer,request,start):
+    '''
+    Performs a /calculate request, streaming results as chunks complete.
+    Returns the HTTP status.
+    '''
+    system_name, columns, index, rows = parse_calculation(request,self.min_systems)
+    loop = asyncio.get_running_loop()
+    async with self.semaphore:
+      queued = time.perf_counter()
+      # Submit all chunks at once, and stream them back in order.
+      futures = [loop.run_in_executor(self.pool,calc_chunk,system_name,columns,index[i:i+self.chunk_rows],
+                                      rows[i:i+self.chunk_rows])
+                 for i in range(0,len(rows),self.chunk_rows)]
+      try:
+        await start_chunked(writer,200)
+        if not futures:
+          # Compute the (empty) results columns for an empty request.
+          futures = [loop.run_in_executor(self.pool,calc_chunk,system_name,columns,[],[])]
+        for (i,future) in enumerate(futures):
+          res_columns, res_index, data = await future
+          if i == 0:
+            await write_chunk(writer,{'columns':res_columns})
+          if data:
+            await write_chunk(writer,{'index':res_index,'data':data})
+        done = time.perf_counter()
+        await write_chunk(writer,{'rows':len(rows),'timing':{'queued_seconds':queued - start,
+                                  'calc_seconds':done - queued,'total_seconds':done - start}})
+      except Exception as e:
+        # Headers are sent; report the error in the stream.
+        await write_chunk(writer,{'error':'{:}: {:}'.format(type(e).__name__,e)})
+        for future in futures:
+          future.cancel()
+      await end_chunked(writer)
+    return 200
+
+# read_request function.
+async def read_request(reader):
+  '''
+  Reads an HTTP request. Returns a tuple of (method, path, body).
+  '''
+  line = await reader.readline()
+  parts = line.decode('latin-1').split()
+  if len(parts) != 3:
+    raise ServiceError(400,'Malformed request line.')
+  method, path = parts[0].upper(), parts[1].split('?')[0]
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n',b'\n',b''):
+      break
+    (name,sep,value) = line.decode('latin-1').partition(':')
+    headers[name.strip().lower()] = value.strip()
+  body = b''
+  if method == 'POST':
+    if 'content-length' not in headers:
+      raise ServiceError(411,'Content-Length is required.')
+    length = headers['content-length']
+    if not (length.isascii() and length.isdigit()):
+      raise ServiceError(400,'Invalid Content-Length: {:}'.format(length))
+    length = int(length)
+    if length > max_body_bytes:
+      raise ServiceError(413,'Request body exceeds {:} bytes.'.format(max_body_bytes))
+    body = await reader.readexactly(length)
+  return method, path, body
+
+# parse_json function.
+def parse_json(body):
+  '''
+  Returns the object in the specified UTF-8 JSON request body, raising a
+  ValueError if it is invalid.
+  '''
+  return json.loads(body.decode('utf-8'))
+
+# send_json function.
+async def send_json(writer,status,obj):
+  '''
+  Sends a complete JSON response. Returns the status.
+  '''
+  body = json.dumps(obj).encode('utf-8')
+  writer.write('HTTP/1.1 {:} {:}\r\nContent-Type: application/json\r\nContent-Length: {:}\r\n'
+               'Connection: close\r\n\r\n'.format(status,reasons[status],len(body)).encode('latin-1') + body)
+  await writer.drain()
+  return status
+
+# start_chunked function.
+async def start_chunked(writer,status):
+  '''
+  Sends the headers of a streamed (chunked) JSON lines response.
+  '''
+  writer.write('HTTP/1.1 {:} {:}\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n'
+               'Connection: close\r\n\r\n'.format(status,reasons[status]).encode('latin-1'))
+  await writer.drain()
+
+# write_chunk function.
+async def write_chunk(writer,obj):
+  '''
+  Sends the specified object as a JSON line in its own chunk.
+  '''
+  data = (json.dumps(obj) + '\n').encode('utf-8')
+  writer.write('{:x}\r\n'.format(len(data)).encode('latin-1') + data + b'\r\n')
+  await writer.drain()
+
+# end_chunked function.
+async def end_chunked(writer):
+  writer.write(b'0\r\n\r\n')
+  await writer.drain()
+
+# serve function.
+async def serve(host=def_host,port=def_port,workers=None,max_concurrent=def_max_concurrent,
+                chunk_rows=def_chunk_rows):
+  '''
+  Runs the service until it is cancelled.
+  '''
+  service = StoichService(workers,max_concurrent,chunk_rows)
+  try:
+    server = await service.start(host,port)
+    print('Stoichiometry service listening on http://{:}:{:} ({:} mineral systems).'.format(
+          host,port,len(service.min_systems)))
+    async with server:
+      await server.serve_forever()
+  finally:
+    service.close()
+
+# main function.
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Local stoichiometry calculation service.')
+  parser.add_argument('--host',default=def_host,help='address to listen on (default: localhost)')
+  parser.add_argument('--port',type=int,default=def_port)
+  parser.add_argument('--workers',type=int,help='number of worker processes (default: CPU count)')
+  parser.add_argument('--max-concurrent',type=int,default=def_max_concurrent,
+                      help='requests calculated at the same time; others wait')
+  parser.add_argument('--chunk-rows',type=int,default=def_chunk_rows,help='rows per streamed chunk')
+  parser.add_argument('--minsys-dir',help='directory of .minsys files')
+  args = parser.parse_args(argv)
+  stoichiometry.set_resource_paths(minsys_dir=args.minsys_dir)
+  try:
+    asyncio.run(serve(args.host,args.port,args.workers,args.max_concurrent,args.chunk_rows))
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+if __name__ == '__main__':
+  raise SystemExit(main())
@@ -11,20 +11,25 @@
 #
 
 import util
-import pandas as pd
 import os
-import stoich_calc
+import engine
+import instrument
+# The calculation, batch and storage modules (and pandas) are imported by the
+# functions that use them, so that importing this module stays fast.
 
 # Define global variables.
 def_prefs_path = 'resources/stoichiometry.prefs'
 prefs = {}
-def_sram_nist_path = 'resources/AtomicWeights_IsotopicCompositions_NIST_4.1.txt'
-def_sram_patch_path = 'resources/SelectedGeologicAtomicWeights.txt'
-def_minsys_dir = 'resources/mineral_systems'
-sram_lib = {}
+def_sram_nist_path = engine.def_sram_nist_path
+def_sram_patch_path = engine.def_sram_patch_path
+def_sram_snapshot_path = engine.def_sram_snapshot_path
+def_minsys_dir = engine.def_minsys_dir
+# Datasets and results of the session, sharing a memory budget (see run_startup_tasks).
+session = None
 datasets = {}
 results = {}
-min_systems = {}
+# Engine performing the calculations; it loads its resources on first use.
+stoich_engine = engine.StoichiometryEngine()
 
 # start function.
 def start(prefs_path=def_prefs_path,sram_nist=def_sram_nist_path,
@@ -55,30 +60,35 @@ def start(prefs_path=def_prefs_path,sram_nist=def_sram_nist_path,
         print('Import dataset aborted.\n')
     elif choice == 1:
       # Remove dataset.
-      print('Removal functionality coming soon...\n')
+      remove_dataset()
     elif choice == 2:
       # Export results.
+      import results_io
       results_list = list(results.keys())
       selection = util.prompt_options('Specify results to export', results_list)
       res_name = results_list[selection]
-      target = os.path.join(prefs['wdir'], res_name + '.stoichres')
+      # Prompt user for the file format.
+      exts = [ext for (ext,fmt) in results_io.formats.items() if fmt in results_io.available_formats()]
+      ext = exts[util.prompt_options('Specify export format', exts)]
+      target = os.path.join(prefs['wdir'], res_name + ext)
       ok2save = False
       if os.path.isfile(target):
-        print('Warning: there is already a file named {:} in the working directory.'.format(res_name + '.stoichres'))
+        print('Warning: there is already a file named {:} in the working directory.'.format(res_name + ext))
         yesno = input('Would you like to overwrite the file? (y/n) >> ')
         if yesno == 'y':
           ok2save = True
       else:
         ok2save = True
       if ok2save:
-        results[res_name].to_csv(target,prefs['delimiter'])
+        results_io.export_results(results[res_name],target,prefs['delimiter'])
     elif choice == 3:
       # Manual calculation options.
       print('Manual stoichiometry calculations:')
       manual_calc()
     elif choice == 4:
       # Auto calculation options.
-      print('Auto calculation options coming soon...\n')
+      print('Auto stoichiometry calculations:')
+      auto_calc()
     elif choice == 5:
       # Edit preferences.
       edit_prefs_main(prefs_path)
@@ -90,10 +100,35 @@ def start(prefs_path=def_prefs_path,sram_nist=def_sram_nist_path,
   print('Thank you, come again soon!')
   print('-'*80); print('/\\'*40); print('\\/'*40); print('-'*80)
   
+# remove_dataset function.
+def remove_dataset():
+  '''
+  Prompts the user to select a dataset to remove from the session, optionally
+  along with its results, and reports the memory usage of the session.
+  '''
+  # Get access to global variables.
+  global datasets, results
+  if len(datasets) == 0:
+    print('There are no datasets loaded.\n')
+    return
+  usage = datasets.usage()
+  labels = ['{:} ({:.2f} MB, {:})'.format(name,nbytes/2**20,location) for (name,nbytes,location) in usage]
+  name = usage[util.prompt_options('Specify dataset to remove',labels)][0]
+  del datasets[name]
+  print('Dataset removed: {:}'.format(name))
+  res_names = [k for k in results.keys() if k in [name,name + ' classification']]
+  if res_names:
+    yesno = input('Would you like to remove its results as well? (y/n) >> ')
+    if yesno == 'y':
+      for k in res_names:
+        del results[k]
+      print('Results removed.')
+  print(session.report() + '\n')
+
 # manual_calc function. 
 def manual_calc():
   # Get access to global variables.
-  global prefs, datasets, results, min_systems
+  global prefs, datasets, results
   # Select active dataset.
   activeKey = None
   if len(datasets) == 0:
@@ -107,55 +142,112 @@ def manual_calc():
     idx = util.prompt_options('Please select a dataset to process',list(datasets.keys()))
     activeKey = list(datasets.keys())[idx]
   active = datasets[activeKey]
+  import stoich_calc
   # Prepare to show manual calculation options.
-  manual_opts = ['Anhydrous silicates', 'Hydrous silicates','Non-silicates', 'Return to: Main Menu']
+  manual_opts = ['Anhydrous silicates', 'Hydrous silicates','Non-silicates',
+                 'Classify (all mineral systems)', 'Return to: Main Menu']
   keep_going = True
   while keep_going == True:
     # Show manual calculation options menu.
     choice = util.prompt_options('Manual Calculation options for: {:}'.format(activeKey), manual_opts)
     # Perform requested action.
     if choice == 0:
-      # Anhydrous silicates.
-      results[activeKey] = stoich_calc.anhydrous_silicates_stoich(active, sram_lib, min_systems)
+      # Anhydrous silicates; rows calculated before are reused.
+      asms = stoich_calc.prompt_min_sys(stoich_engine.min_systems,False,True)
+      results[activeKey] = stoich_engine.compute(active,asms,hydrous=False,incremental=True)
+      print('Anhydrous stoichiometric calculations complete.\n')
     elif choice == 1:
-      # Hydrous silicates.
-      results[activeKey] = stoich_calc.hydrous_silicates_stoich(active, sram_lib, min_systems)
+      # Hydrous silicates (anhydrous oxides are normalized first).
+      hsms = stoich_calc.prompt_min_sys(stoich_engine.min_systems,True,True)
+      results[activeKey] = stoich_engine.compute(active,hsms,hydrous=True,incremental=True)
+      print('Hydrous stoichiometric calculations complete.\n')
     elif choice == 2:
       # Non-silicates.
       print('Non-silicates options coming soon...\n')
     elif choice == 3:
+      # Evaluate all mineral systems and rank them by fit.
+      results[activeKey + ' classification'] = stoich_engine.classify(active)
+      print('Mineral system classification complete.\n')
+    elif choice == 4:
       # Return to Main Menu.
       keep_going = False
 
 # auto_calc function.
-
-
+def auto_calc():
+  '''
+  Runs batch stoichiometry calculations for all datasets in the working directory
+  that match a file name pattern, using a single mineral system.
+  '''
+  # Get access to global variables.
+  global prefs
+  min_systems = stoich_engine.min_systems
+  if len(min_systems) == 0:
+    print('There are no mineral systems loaded.\n')
+    return
+  # Prompt user for file pattern and mineral system.
+  pattern = input('Specify files to process (e.g., *.txt): ')
+  syslist = list(min_systems.keys())
+  idx = util.prompt_options('Please select a mineral system',syslist)
+  import batch
+  batch.run_batch([os.path.join(prefs['wdir'],pattern)],syslist[idx],delimiter=prefs['delimiter'],
+                  nist=stoich_engine.paths['nist'],patch=stoich_engine.paths['patch'],
+                  snapshot=stoich_engine.paths['snapshot'],minsys_dir=stoich_engine.paths['minsys_dir'])
 
 # run_startup_tasks function.
+@instrument.instrumented()
 def run_startup_tasks(prefs_path,nist,patch,minsys_dir):
+  import session_store
   # Get access to global variables; clear them on startup.
-  global prefs, sram_lib, datasets, min_systems
-  prefs, sram_lib, datasets, min_systems = {}, {}, {}, {}
+  global prefs, session, datasets, results
+  prefs = {}
   # Initialize/load preferences.
   prefs = init_prefs(prefs_path)
   print('Preferences loaded.')
-  # Load and patch library of standard relative atomic weights (SRAMs).
-  sram_lib = util.load_atomic_weights(nist)
-  patch = util.load_atomic_weights(patch)
-  sram_lib = util.update_sram_lib(sram_lib,patch)
-  print('Standard relative atomic mass library loaded.')
-  # Load mineral systems.
-  min_systems = util.load_mineral_systems(minsys_dir)
-  if min_systems is not None and len(min_systems) > 0:
-    print('Mineral systems loaded (N = {:}).'.format(len(min_systems)))
-  else:
-    print('Warning: no mineral systems were loaded.')
+  # Datasets and results are kept in a memory-bounded session store.
+  if session is not None:
+    session.close()
+  session = session_store.SessionStore(int(prefs['memory_budget_mb']*2**20))
+  datasets = session_store.SessionView(session,'datasets')
+  results = session_store.SessionView(session,'results')
+  # The SRAM library and mineral systems are loaded on first use.
+  set_resource_paths(nist,patch,def_sram_snapshot_path,minsys_dir)
   print('')
 
+# set_resource_paths function.
+def set_resource_paths(nist=None,patch=None,snapshot=None,minsys_dir=None):
+  '''
+  Replaces the engine with one that loads the SRAM library files and mineral
+  systems from the specified paths (those not specified are left unchanged).
+  '''
+  global stoich_engine
+  paths = dict(stoich_engine.paths)
+  for (key,path) in [('nist',nist),('patch',patch),('snapshot',snapshot),('minsys_dir',minsys_dir)]:
+    if path is not None:
+      paths[key] = path
+  stoich_engine = engine.StoichiometryEngine(**paths)
+
+# get_sram_lib function.
+def get_sram_lib():
+  '''
+  Returns the library of standard relative atomic weights (SRAMs) of the engine,
+  loading it on first use.
+  '''
+  return stoich_engine.sram_lib
+
+# get_min_systems function.
+def get_min_systems():
+  '''
+  Returns the registry of mineral systems of the engine, loading it on first use.
+  '''
+  return stoich_engine.min_systems
+
 # run_shutdown_tasks function.
 def run_shutdown_tasks(prefs_path):
   # Get access to global variables.
   global prefs
+  # Remove spilled datasets and results.
+  if session is not None:
+    session.close()
   # Autosave preferences if possible.
   if prefs['autosave_prefs']:
     util.write_dict(prefs,os.path.abspath(prefs_path))
@@ -170,10 +262,12 @@ def init_prefs(prefs_path):
 
   Returns a dictionary of preferences.
   '''
+  import session_store
   # Define default preferences.
   dprefs = {'wdir':os.path.abspath('.'),
             'autosave_prefs':True,
-            'delimiter':'\t'}
+            'delimiter':'\t',
+            'memory_budget_mb':session_store.def_budget/2**20}
   # Check for preferences file; load it if it exists.
   lprefs = {}
   if os.path.isfile(prefs_path):
@@ -231,6 +325,7 @@ def edit_prefs_general():
     general_edit_opts = ['Autosave preferences = {:} (toggle value)'.format(prefs['autosave_prefs']),
                          'Working directory = {:} (edit)'.format(prefs['wdir']),
                          'File delimiter = {:} (choose)'.format(dels[prefs['delimiter']]),
+                         'Memory budget = {:} MB (edit)'.format(prefs['memory_budget_mb']),
                          'Return to: Edit Preferences - Main Menu']
     choice = util.prompt_options('Edit General Preferences',general_edit_opts)
     # Handle user selection.
@@ -260,6 +355,18 @@ def edit_prefs_general():
       idx = util.prompt_options('Select file delimiter',list(dels.values()))
       prefs['delimiter'] = list(dels.keys())[idx]
     elif choice == 3:
+      # Edit memory budget of datasets and results.
+      try:
+        budget = float(input('Enter new memory budget (MB): '))
+      except ValueError:
+        budget = -1.0
+      if budget > 0:
+        prefs['memory_budget_mb'] = budget
+        session.budget = int(budget*2**20)
+        session.enforce_budget()
+      else:
+        print('Invalid memory budget; it was not changed.\n')
+    elif choice == 4:
       # Return to Main Menu.
       keep_going = False
   print('Rock on! Returning to main preferences editor menu.\n')
@@ -0,0 +1,86 @@
+# Stoichometry
+# tests/conftest.py
+#
+# Shared fixtures for the test suite: the SRAM library from the resources
+# directory, a directory of mineral system definitions, and synthetic datasets.
+#
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,repo_dir)
+
+import util
+
+# Mineral system definitions used by the tests.
+minsys_definitions = {
+  'olivine':['System Name = Olivine','Hydrous = False','Silicate = True',
+             'Oxides = SiO2, TiO2, Al2O3, FeO, MnO, MgO, CaO, NiO','Anions = O',
+             'Anions per formula unit = 4','Endmembers = Mg2SiO4; Fe2SiO4'],
+  'pyroxene':['System Name = Pyroxene','Hydrous = False','Silicate = True',
+              'Oxides = SiO2, TiO2, Al2O3, Cr2O3, FeO, MnO, MgO, CaO, Na2O','Anions = O',
+              'Anions per formula unit = 6','Endmembers = Mg2Si2O6; Fe2Si2O6; Ca2Si2O6',
+              'Sites = T(2): Si, Al; M1(1): Al, Ti, Cr, Mg, Fe; M2(1): Mg, Fe, Mn, Ca, Na'],
+  'amphibole':['System Name = Amphibole','Hydrous = True','Silicate = True',
+               'Oxides = SiO2, TiO2, Al2O3, FeO, MnO, MgO, CaO, Na2O, K2O','Anions = O',
+               'Anions per formula unit = 23','Endmembers = Ca2Mg5Si8O22(OH)2; Ca2Fe5Si8O22(OH)2',
+               'Sites = T(8): Si, Al; C(5): Al, Ti, Fe, Mn, Mg; B(2): Mg, Fe, Mn, Ca, Na; A(1): Na, K'],
+  'spinel':['System Name = Spinel','Hydrous = False','Silicate = False',
+            'Oxides = SiO2, TiO2, Al2O3, Cr2O3, FeO, MnO, MgO','Anions = O',
+            'Anions per formula unit = 4','Endmembers = MgAl2O4; FeAl2O4; Fe3O4'],
+  'garnet':['System Name = Garnet','Hydrous = False','Silicate = True',
+            'Oxides = SiO2, TiO2, Al2O3, Cr2O3, FeO, MnO, MgO, CaO','Anions = O',
+            'Anions per formula unit = 12','Endmembers = Mg3Al2Si3O12; Fe3Al2Si3O12; Ca3Fe2Si3O12'],
+  'chromite':['System Name = Chromite','Hydrous = False','Silicate = False',
+              'Oxides = TiO2, Al2O3, Cr2O3, FeO, MnO, MgO','Anions = O',
+              'Anions per formula unit = 4','Endmembers = FeCr2O4; MgCr2O4','Normalization = cations 3'],
+  'hematite':['System Name = Hematite','Hydrous = False','Silicate = False',
+              'Oxides = TiO2, Al2O3, Fe2O3, MgO','Anions = O',
+              'Anions per formula unit = 3','Endmembers = Fe2O3'],
+}
+
+# Oxide columns of the synthetic datasets.
+dataset_oxides = ['SiO2','TiO2','Al2O3','Cr2O3','FeO','MnO','MgO','CaO','NiO','Na2O','K2O']
+
+@pytest.fixture(scope='session')
+def sram_lib():
+  resources = os.path.join(repo_dir,'resources')
+  return util.load_sram_library(os.path.join(resources,'AtomicWeights_IsotopicCompositions_NIST_4.1.txt'),
+                                os.path.join(resources,'SelectedGeologicAtomicWeights.txt'))
+
+@pytest.fixture(scope='session')
+def minsys_dir(tmp_path_factory):
+  path = tmp_path_factory.mktemp('mineral_systems')
+  for (name,lines) in minsys_definitions.items():
+    (path/'{:}.minsys'.format(name)).write_text('\n'.join(lines) + '\n')
+  return str(path)
+
+@pytest.fixture(scope='session')
+def min_systems(minsys_dir):
+  return util.load_mineral_systems(minsys_dir)
+
+def make_dataset(rows=200,seed=0):
+  '''
+  Returns a synthetic dataset of oxide wt% values, with missing, zero and
+  negative values, analyses without any data and a text column.
+  '''
+  rng = np.random.default_rng(seed)
+  dataset = pd.DataFrame(rng.uniform(0.0,50.0,(rows,len(dataset_oxides))),
+                         ['a{:}'.format(i) for i in range(rows)],dataset_oxides)
+  dataset.iloc[::7,4] = np.nan
+  dataset.iloc[::5,2] = 0.0
+  dataset.iloc[::11,5] = -1.0
+  dataset.iloc[3] = np.nan
+  dataset['Comment'] = 'synthetic'
+  return dataset
+
+def oxide_dataset(sram_lib,analyses):
+  '''
+  Returns a dataset of oxide wt% values from a list of dicts of oxide moles.
+  '''
+  rows = [{ox:moles*util.molecular_weight(ox,sram_lib) for (ox,moles) in analysis.items()} for analysis in analyses]
+  return pd.DataFrame(rows,['a{:}'.format(i) for i in range(len(rows))]).fillna(0.0)
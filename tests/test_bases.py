@@ -0,0 +1,55 @@
+# Stoichometry
+# tests/test_bases.py
+#
+# Tests of normalization bases: formula totals on the anion, cation and charge
+# bases, and batched multi-basis results against single-basis calculations.
+#
+
+import numpy as np
+import pandas as pd
+
+import stoich_calc
+from conftest import make_dataset
+
+# (cations, oxygens) per formula unit of the chromite oxides.
+oxide_formulas = {'TiO2':(1,2),'Al2O3':(2,3),'Cr2O3':(2,3),'FeO':(1,1),'MnO':(1,1),'MgO':(1,1)}
+
+def weighted_totals(formula_cations,weights):
+  '''
+  Returns the sums of the formula cations (excluding the total) weighted by the
+  specified per-column weights, for the analyses with data.
+  '''
+  values = formula_cations.drop(columns='Total')
+  values = values[formula_cations['Total'] > 0]
+  return (values*weights).sum(axis=1).to_numpy()
+
+def test_basis_totals(min_systems,sram_lib):
+  min_sys = min_systems['Chromite']
+  dataset = make_dataset(100)
+  anions, cations, charge = stoich_calc.calc_stoich_bases(dataset,min_sys,sram_lib,
+                                                          ['anions 4','cations 3','charge 8'])
+  oxygens = np.array([o/c for (c,o) in oxide_formulas.values()])
+  np.testing.assert_allclose(weighted_totals(anions,oxygens),4.0)
+  np.testing.assert_allclose(weighted_totals(cations,1.0),3.0)
+  np.testing.assert_allclose(weighted_totals(charge,2*oxygens),8.0)
+  assert cations.attrs['normalization'] == 'cations 3'
+
+def test_cation_basis_system(min_systems,sram_lib):
+  # The chromite system is normalized to 3 cations by its definition.
+  results = stoich_calc.calc_stoich(make_dataset(100),min_systems['Chromite'],sram_lib)
+  totals = results['Total'][results['Total'] > 0]
+  np.testing.assert_allclose(totals,3.0)
+  assert list(results.columns[:2]) == ['Ti/3 cations','Al/3 cations']
+
+def test_multi_basis_matches_single_basis(min_systems,sram_lib):
+  dataset = make_dataset(200,seed=3)
+  # On the system's own (anion) basis, results are identical to calc_stoich.
+  for name in ['Olivine','Amphibole','Spinel']:
+    min_sys = min_systems[name]
+    multi = stoich_calc.calc_stoich_bases(dataset,min_sys,sram_lib,
+                                          [min_sys.getNormalization(),'cations 3'])
+    assert multi[0].equals(stoich_calc.calc_stoich(dataset,min_sys,sram_lib))
+  # The chromite system's basis given among others.
+  multi = stoich_calc.calc_stoich_bases(dataset,min_systems['Chromite'],sram_lib,['anions 4','cations 3'])
+  pd.testing.assert_frame_equal(multi[1],stoich_calc.calc_stoich(dataset,min_systems['Chromite'],sram_lib),
+                                check_exact=False,rtol=1e-12)
@@ -0,0 +1,60 @@
+# Stoichometry
+# tests/test_batch.py
+#
+# Tests of headless batch processing of dataset files.
+#
+
+import os
+import pandas as pd
+
+import batch
+import engine
+import stoich_calc
+from conftest import make_dataset, repo_dir
+
+def run(tmp_path,minsys_dir,inputs,**kwargs):
+  return batch.run_batch(inputs,'Olivine',workers=2,minsys_dir=minsys_dir,verbose=False,
+                         nist=os.path.join(repo_dir,engine.def_sram_nist_path),
+                         patch=os.path.join(repo_dir,engine.def_sram_patch_path),
+                         snapshot=str(tmp_path/'sram_lib.snapshot'),**kwargs)
+
+def errors(report):
+  return {os.path.basename(f['input']):f['error'] for f in report['files']}
+
+def test_batch_results(tmp_path,minsys_dir,min_systems,sram_lib):
+  data_dir = tmp_path/'data'
+  data_dir.mkdir()
+  dataset = make_dataset(50)
+  dataset.to_csv(data_dir/'good.txt',sep='\t')
+  for chunksize in [None,16]:
+    report = run(tmp_path,minsys_dir,[str(data_dir)],chunksize=chunksize)
+    assert (report['processed'],report['failed'],report['rows']) == (1,0,50)
+    written = pd.read_csv(batch.results_path(str(data_dir/'good.txt')),sep='\t',index_col=0)
+    expected = stoich_calc.calc_stoich(dataset,min_systems['Olivine'],sram_lib)
+    pd.testing.assert_frame_equal(written,expected,check_exact=False,check_names=False)
+
+def test_files_without_oxides_fail(tmp_path,minsys_dir):
+  data_dir = tmp_path/'data'
+  data_dir.mkdir()
+  (data_dir/'garbage.txt').write_bytes(b'\x00\x01 not a dataset \xff\n\x02\x03\n')
+  pd.DataFrame({'X':[1.0],'Y':[2.0]}).to_csv(data_dir/'other.txt',sep='\t')
+  for chunksize in [None,16]:
+    report = run(tmp_path,minsys_dir,[str(data_dir)],chunksize=chunksize)
+    assert (report['processed'],report['failed']) == (0,2)
+    assert errors(report)['other.txt'].startswith('ValueError: No Olivine oxide columns found')
+    assert errors(report)['garbage.txt'] is not None
+
+def test_output_collisions_fail(tmp_path,minsys_dir):
+  for name in ['a','b']:
+    (tmp_path/name).mkdir()
+    make_dataset(10).to_csv(tmp_path/name/'x.txt',sep='\t')
+  make_dataset(10).to_csv(tmp_path/'a'/'x.csv',sep='\t')
+  # x.txt and x.csv share a results file next to them.
+  report = run(tmp_path,minsys_dir,[str(tmp_path/'a')])
+  assert (report['processed'],report['failed']) == (0,2)
+  assert 'would also be written for' in errors(report)['x.txt']
+  # Same-named files in different directories share a results file in output_dir.
+  report = run(tmp_path,minsys_dir,[str(tmp_path/'a'/'x.txt'),str(tmp_path/'b')],output_dir=str(tmp_path/'out'))
+  assert (report['processed'],report['failed']) == (0,2)
+  report = run(tmp_path,minsys_dir,[str(tmp_path/'a'/'x.txt'),str(tmp_path/'b')])
+  assert (report['processed'],report['failed']) == (2,0)
@@ -0,0 +1,35 @@
+# Stoichometry
+# tests/test_classify.py
+#
+# Tests of the classification of analyses by mineral system.
+#
+
+import numpy as np
+import pytest
+
+import stoich_calc
+from conftest import oxide_dataset
+
+def test_olivine_ranks_first(min_systems,sram_lib):
+  # Fo80 and Fo30 olivines, and an analysis without data.
+  dataset = oxide_dataset(sram_lib,[{'SiO2':1.0,'MgO':1.6,'FeO':0.4},{'SiO2':1.0,'MgO':0.6,'FeO':1.4},{}])
+  # Anhydrous silicates; non-silicates such as spinel (3 cations per 4 anions) fit olivine equally well.
+  systems = {k:v for (k,v) in min_systems.items() if v.isSilicate() and not v.isHydrous()}
+  classification = stoich_calc.classify_mineral_systems(dataset,systems,sram_lib)
+  assert list(classification['Best Fit'].iloc[:2]) == ['Olivine','Olivine']
+  assert classification['Best Fit'].isna().iloc[2]
+  np.testing.assert_allclose(classification['Olivine Total'].iloc[:2],3.0)
+  np.testing.assert_allclose(classification['Best Misfit'].iloc[:2],0.0,atol=1e-12)
+  assert list(classification['Olivine Rank'].iloc[:2]) == [1,1]
+  # Pyroxene (4 cations per 6 anions) gives 4.5 cations for olivine.
+  np.testing.assert_allclose(classification['Pyroxene Misfit'].iloc[:2],0.125)
+  assert classification.iloc[2].filter(regex='Misfit|Rank|Best').isna().all()
+
+def test_small_blocks(min_systems,sram_lib):
+  dataset = oxide_dataset(sram_lib,[{'SiO2':1.0,'MgO':2.0},{'SiO2':1.0,'MgO':1.0,'CaO':1.0}]*5)
+  expected = stoich_calc.classify_mineral_systems(dataset,min_systems,sram_lib)
+  assert stoich_calc.classify_mineral_systems(dataset,min_systems,sram_lib,block_rows=3).equals(expected)
+
+def test_no_systems(sram_lib):
+  with pytest.raises(ValueError,match='No mineral systems'):
+    stoich_calc.classify_mineral_systems(oxide_dataset(sram_lib,[{'SiO2':1.0}]),{},sram_lib)
@@ -0,0 +1,44 @@
+# Stoichometry
+# tests/test_endmembers.py
+#
+# Tests of the endmember proportion solver.
+#
+
+import numpy as np
+import pytest
+
+import stoich_calc
+from conftest import oxide_dataset
+
+def proportions(min_systems,sram_lib,name,analyses):
+  min_sys = min_systems[name]
+  formula_cations = stoich_calc.calc_stoich(oxide_dataset(sram_lib,analyses),min_sys,sram_lib)
+  return stoich_calc.calc_endmember_proportions(formula_cations,min_sys)
+
+def test_exact_olivine(min_systems,sram_lib):
+  props = proportions(min_systems,sram_lib,'Olivine',[{'SiO2':1.0,'MgO':1.6,'FeO':0.4},
+                                                      {'SiO2':1.0,'MgO':2.0},{'SiO2':1.0,'FeO':2.0}])
+  x = props[['X(Mg2SiO4)','X(Fe2SiO4)']].to_numpy()
+  np.testing.assert_allclose(x,[[0.8,0.2],[1.0,0.0],[0.0,1.0]],atol=1e-12)
+  assert (x >= 0.0).all()
+  np.testing.assert_allclose(props['Endmember Residual'],0.0,atol=1e-12)
+
+def test_proportions_are_non_negative(min_systems,sram_lib):
+  # Cations outside the endmember range: excess Mg, and Ca (in no olivine endmember).
+  props = proportions(min_systems,sram_lib,'Olivine',[{'SiO2':1.0,'MgO':2.5},{'SiO2':1.0,'MgO':1.0,'CaO':1.0}])
+  x = props[['X(Mg2SiO4)','X(Fe2SiO4)']].to_numpy()
+  assert (x >= 0.0).all()
+  np.testing.assert_allclose(x.sum(axis=1),1.0)
+  np.testing.assert_allclose(x[0],[1.0,0.0],atol=1e-12)
+  assert (props['Endmember Residual'] > 0.0).all()
+
+def test_ternary_garnet(min_systems,sram_lib):
+  # Roughly pyrope50 almandine30 andradite20, with all Fe as FeO (so the fit is not exact).
+  props = proportions(min_systems,sram_lib,'Garnet',[{'SiO2':3.0,'Al2O3':0.8,'MgO':1.5,'FeO':0.9,'CaO':0.6}])
+  x = props[['X(Mg3Al2Si3O12)','X(Fe3Al2Si3O12)','X(Ca3Fe2Si3O12)']].to_numpy()[0]
+  assert (x >= 0.0).all() and x.sum() == pytest.approx(1.0)
+  assert x[0] > x[1] > x[2] > 0.0
+
+def test_analyses_without_data(min_systems,sram_lib):
+  props = proportions(min_systems,sram_lib,'Olivine',[{}])
+  assert props[['X(Mg2SiO4)','X(Fe2SiO4)','Endmember Residual']].isna().all(axis=None)
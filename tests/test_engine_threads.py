@@ -0,0 +1,65 @@
+# Stoichometry
+# tests/test_engine_threads.py
+#
+# Tests of concurrent first use of a StoichiometryEngine: several threads start
+# calculations at once in a fresh interpreter, so resources, formula caches and
+# row caches are all created under contention.
+#
+
+import os
+import subprocess
+import sys
+
+script = '''
+import os
+import sys
+import threading
+import pandas as pd
+sys.path.insert(0,sys.argv[1])
+os.chdir(sys.argv[1])
+sys.path.insert(0,os.path.join(sys.argv[1],'tests'))
+import engine
+import stoich_calc
+from conftest import make_dataset
+
+(minsys_dir,tmp_dir,threads) = (sys.argv[2],sys.argv[3],int(sys.argv[4]))
+eng = engine.StoichiometryEngine(snapshot=None,minsys_dir=minsys_dir)
+systems = ['Olivine','Pyroxene','Amphibole','Chromite']
+datasets = [make_dataset(500,seed=i) for i in range(threads)]
+paths = []
+for (i,dataset) in enumerate(datasets):
+  paths.append(os.path.join(tmp_dir,'d{:}.txt'.format(i)))
+  dataset.to_csv(paths[-1],sep='\\t')
+barrier = threading.Barrier(threads)
+results, errors = {}, []
+
+def run(i):
+  try:
+    barrier.wait()
+    system = systems[i % len(systems)]
+    results[i] = eng.compute(datasets[i],system,incremental=(i % 2 == 1))
+    eng.compute_file(paths[i],paths[i] + '.out',system,chunksize=128)
+  except Exception as e:
+    errors.append(repr(e))
+
+workers = [threading.Thread(target=run,args=(i,)) for i in range(threads)]
+for t in workers:
+  t.start()
+for t in workers:
+  t.join()
+assert not errors, errors
+for i in range(threads):
+  system = eng.system(systems[i % len(systems)])
+  expected = stoich_calc.calc_stoich(datasets[i],system,eng.sram_lib)
+  pd.testing.assert_frame_equal(results[i],expected)
+  written = pd.read_csv(paths[i] + '.out',sep='\\t',index_col=0)
+  pd.testing.assert_frame_equal(written,expected,check_exact=False,check_names=False)
+print('ok')
+'''
+
+def test_concurrent_first_use(minsys_dir,tmp_path):
+  repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  proc = subprocess.run([sys.executable,'-c',script,repo_dir,minsys_dir,str(tmp_path),'8'],
+                        capture_output=True,text=True,timeout=300)
+  assert proc.returncode == 0, proc.stderr
+  assert proc.stdout.splitlines()[-1] == 'ok'
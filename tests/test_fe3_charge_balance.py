@@ -0,0 +1,65 @@
+# Stoichometry
+# tests/test_fe3_charge_balance.py
+#
+# Tests of calc_fe3_charge_balance (Droop, 1987) on stoichiometric compositions,
+# for which the charge balance equation recovers Fe2+ and Fe3+ exactly.
+#
+
+import numpy as np
+import pytest
+import stoich_calc
+from conftest import oxide_dataset
+
+def charge_balance(sram_lib,min_sys,analyses):
+  dataset = oxide_dataset(sram_lib,analyses)
+  formula_cations = stoich_calc.calc_stoich(dataset,min_sys,sram_lib)
+  return formula_cations, stoich_calc.calc_fe3_charge_balance(formula_cations,min_sys)
+
+def test_magnetite(sram_lib,min_systems):
+  # Fe3O4 with all Fe as FeO: 4 cations per 4 O, F = 2*4*(1 - 3/4) = 2.
+  formula_cations, balanced = charge_balance(sram_lib,min_systems['Spinel'],[{'FeO':3.0}])
+  assert formula_cations['Total'].iloc[0] == pytest.approx(4.0)
+  assert balanced['Fe3+/4 O'].iloc[0] == pytest.approx(2.0)
+  assert balanced['Fe2+/4 O'].iloc[0] == pytest.approx(1.0)
+
+def test_spinel_solid_solution(sram_lib,min_systems):
+  # 0.5 MgAl2O4 + 0.5 Fe3O4: Mg0.5 Fe2+0.5 Fe3+1 Al1 O4.
+  formula_cations, balanced = charge_balance(sram_lib,min_systems['Spinel'],[{'MgO':0.5,'Al2O3':0.5,'FeO':1.5}])
+  row = balanced.iloc[0]
+  assert row['Fe3+/4 O'] == pytest.approx(1.0)
+  assert row['Fe2+/4 O'] == pytest.approx(0.5)
+  assert row['Mg/4 O'] == pytest.approx(0.5)
+  assert row['Al/4 O'] == pytest.approx(1.0)
+
+def test_andradite(sram_lib,min_systems):
+  # Ca3Fe2Si3O12 with all Fe as FeO: 8 cations per 11 O, i.e., S = 96/11 per 12 O.
+  formula_cations, balanced = charge_balance(sram_lib,min_systems['Garnet'],[{'CaO':3.0,'FeO':2.0,'SiO2':3.0}])
+  assert formula_cations['Total'].iloc[0] == pytest.approx(96.0/11.0)
+  assert balanced['Fe3+/12 O'].iloc[0] == pytest.approx(2.0)
+  assert balanced['Fe2+/12 O'].iloc[0] == pytest.approx(0.0,abs=1e-12)
+  assert balanced['Si/12 O'].iloc[0] == pytest.approx(3.0)
+
+def test_clamped_at_zero(sram_lib,min_systems):
+  # Cation-deficient analysis (S < T): no Fe3+, and the formula is unchanged.
+  formula_cations, balanced = charge_balance(sram_lib,min_systems['Spinel'],[{'Al2O3':1.1,'FeO':1.0}])
+  assert formula_cations['Total'].iloc[0] < 3.0
+  assert balanced['Fe3+/4 O'].iloc[0] == 0.0
+  assert balanced['Fe2+/4 O'].iloc[0] == formula_cations['Fe/4 O'].iloc[0]
+  assert balanced['Al/4 O'].iloc[0] == formula_cations['Al/4 O'].iloc[0]
+
+def test_clamped_at_total_fe(sram_lib,min_systems):
+  # F = 2 exceeds the total Fe: all Fe is Fe3+.
+  formula_cations, balanced = charge_balance(sram_lib,min_systems['Spinel'],[{'MgO':1.0,'FeO':0.01}])
+  total_fe = formula_cations['Fe/4 O'].iloc[0]*3.0/formula_cations['Total'].iloc[0]
+  assert balanced['Fe3+/4 O'].iloc[0] == pytest.approx(total_fe)
+  assert balanced['Fe2+/4 O'].iloc[0] == 0.0
+
+def test_analyses_without_data(sram_lib,min_systems):
+  formula_cations, balanced = charge_balance(sram_lib,min_systems['Spinel'],[{'FeO':3.0},{'FeO':0.0}])
+  assert np.isnan(balanced['Fe2+/4 O'].iloc[1]) and np.isnan(balanced['Fe3+/4 O'].iloc[1])
+
+def test_requires_feo(sram_lib,min_systems):
+  min_sys = min_systems['Hematite']
+  formula_cations = stoich_calc.calc_stoich(oxide_dataset(sram_lib,[{'Fe2O3':1.0}]),min_sys,sram_lib)
+  with pytest.raises(ValueError,match='FeO'):
+    stoich_calc.calc_fe3_charge_balance(formula_cations,min_sys)
@@ -0,0 +1,43 @@
+# Stoichometry
+# tests/test_formula_cache.py
+#
+# Tests of the compiled formula cache and SRAM library versions.
+#
+
+import copy
+import pytest
+
+import util
+
+def test_library_formulas_are_cached(sram_lib):
+  lib = util.SRAMLibrary(copy.deepcopy(dict(sram_lib)))
+  first = util.compile_formula('Mg2SiO4',lib)
+  assert util.compile_formula('Mg2SiO4',lib) is first
+  # Patching the library gives it a new version, so the weight is recomputed.
+  patch = {'Mg':copy.deepcopy(lib['Mg'])}
+  patch['Mg']['SRAM']['value'] += 1.0
+  util.update_sram_lib(lib,patch)
+  assert util.compile_formula('Mg2SiO4',lib).weight == pytest.approx(first.weight + 2.0)
+
+def test_plain_dicts_are_not_cached(sram_lib):
+  plain = copy.deepcopy(dict(sram_lib))
+  assert util.sram_version(plain) is None
+  size = util.formula_cache.info()['size']
+  weight = util.molecular_weight('Mg2SiO4',plain)
+  assert util.formula_cache.info()['size'] == size
+  # Changes to a plain dict are seen by the next call.
+  plain['Mg']['SRAM']['value'] += 1.0
+  assert util.molecular_weight('Mg2SiO4',plain) == pytest.approx(weight + 2.0)
+
+def test_missing_element_raises(sram_lib):
+  lib = util.SRAMLibrary({k:v for (k,v) in sram_lib.items() if k != 'Mg'})
+  with pytest.raises(ValueError,match='Mg2SiO4'):
+    util.compile_formula('Mg2SiO4',lib)
+  assert ('Mg2SiO4',lib.version) not in dict(util.formula_cache.items())
+
+def test_sram_digests_are_bounded(sram_lib):
+  digest = util.sram_digest(sram_lib)
+  for i in range(2*util.sram_digests.maxsize):
+    assert util.sram_digest(util.SRAMLibrary(sram_lib)) == digest
+  assert len(util.sram_digests) <= util.sram_digests.maxsize
+  assert util.sram_digest(dict(sram_lib)) == digest
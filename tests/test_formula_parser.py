@@ -0,0 +1,64 @@
+# Stoichometry
+# tests/test_formula_parser.py
+#
+# Tests of the chemical formula parser and its bulk parse API.
+#
+
+import numpy as np
+import pytest
+
+import util
+
+@pytest.mark.parametrize('formula,expected',[
+  ('SiO2',{'Si':1,'O':2}),
+  ('Ca2(Mg,Fe)5(Si8O22)(OH)2',{'Ca':2,'Mg':2.5,'Fe':2.5,'Si':8,'O':24,'H':2}),
+  ('K[Fe(CN)6]',{'K':1,'Fe':1,'C':6,'N':6}),
+  ('((CO3)2)3',{'C':6,'O':18}),
+  ('Mg0.5Fe0.5SiO3',{'Mg':0.5,'Fe':0.5,'Si':1,'O':3}),
+  ('CaSO4·2H2O',{'Ca':1,'S':1,'O':6,'H':4}),
+  ('CaSO4*2H2O',{'Ca':1,'S':1,'O':6,'H':4}),
+  ('CaSO4.H2O',{'Ca':1,'S':1,'O':5,'H':2}),
+  ('Na2CO3 · 10H2O',{'Na':2,'C':1,'O':13,'H':20}),
+])
+def test_parse_formula(formula,expected):
+  assert util.parse_formula(formula) == pytest.approx(expected)
+
+def test_decimal_point_is_not_a_hydrate_separator():
+  assert util.parse_formula('CaSO4.2H2O') == pytest.approx({'Ca':1,'S':1,'O':5.2,'H':2})
+
+def test_no_depth_limit():
+  depth = 10000
+  assert util.parse_formula('('*depth + 'H2O' + ')'*depth) == {'H':2,'O':1}
+
+@pytest.mark.parametrize('formula,position,reason',[
+  ('',0,'empty chemical formula'),
+  ('(SiO2',0,'unmatched opening ('),
+  ('SiO2)',4,'unmatched closing )'),
+  ('(SiO2]',5,'mismatched closing ]'),
+  ('Si$O2',2,"invalid character '$'"),
+  ('()',1,'empty group'),
+  ('(,Mg)',1,'unexpected comma'),
+  ('SiO2 3',5,'unexpected number 3'),
+  ('SiO2*',5,'formula ends without elements'),
+  ('(H2O*H2O)',4,'unexpected hydrate separator'),
+])
+def test_malformed_formulas(formula,position,reason):
+  with pytest.raises(util.FormulaError) as e:
+    util.parse_formula(formula)
+  assert (e.value.formula,e.value.position,e.value.reason) == (formula,position,reason)
+  assert isinstance(e.value,ValueError)
+
+def test_parse_many_matches_parse_formula():
+  formulas = ['Mg2SiO4','Fe2SiO4','Ca2(Mg,Fe)5(Si8O22)(OH)2','CaSO4·2H2O','Mg2SiO4']
+  counts, elements = util.parse_many(formulas)
+  assert elements == ['Mg','Si','O','Fe','Ca','H','S']
+  for (formula,row) in zip(formulas,counts):
+    expected = util.parse_formula(formula)
+    assert dict((e,c) for (e,c) in zip(elements,row) if c) == pytest.approx(expected)
+
+def test_parse_many_with_elements():
+  counts, elements = util.parse_many(['SiO2','MgO'],['O','Si','Mg','Fe'])
+  assert elements == ['O','Si','Mg','Fe']
+  np.testing.assert_array_equal(counts,[[2,1,0,0],[1,0,1,0]])
+  with pytest.raises(ValueError,match='Ca'):
+    util.parse_many(['CaO'],['O','Si'])
@@ -0,0 +1,51 @@
+# Stoichometry
+# tests/test_instrument.py
+#
+# Tests of the opt-in instrumentation layer.
+#
+
+import threading
+import pytest
+import instrument
+import util
+
+@pytest.fixture
+def instrumentation():
+  instrument.reset()
+  instrument.enable()
+  yield
+  instrument.disable()
+  instrument.reset()
+
+@instrument.instrumented('test.stage')
+def stage():
+  return None
+
+def test_records_are_bounded(instrumentation,monkeypatch):
+  monkeypatch.setattr(instrument,'records',instrument.collections.deque(maxlen=10))
+  for i in range(25):
+    stage()
+  report = instrument.report()
+  assert len(report.records) == 10
+  assert report.summary()['test.stage']['calls'] == 25
+
+@instrument.instrumented('test.lookups')
+def lookups(formulas,barrier):
+  barrier.wait()
+  for comp in formulas:
+    util.parsed_compound(comp)
+
+def test_cache_counts_per_thread(instrumentation):
+  # Threads look up formulas concurrently; each counts only its own lookups.
+  util.parse_cache.invalidate()
+  formulas = ['SiO2','Al2O3','MgO','FeO']
+  barrier = threading.Barrier(8)
+  threads = [threading.Thread(target=lookups,args=(formulas*50,barrier)) for i in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  records = [rec for rec in instrument.report().records if rec.stage == 'test.lookups']
+  assert len(records) == 8
+  for rec in records:
+    assert rec.cache_hits + rec.cache_misses == 200
@@ -0,0 +1,46 @@
+# Stoichometry
+# tests/test_kernel.py
+#
+# Regression tests of the vectorized formula cations kernel: against the
+# row-by-row reference implementation, with and without a CationWorkspace, and
+# calculated in parallel shards.
+#
+
+import pandas as pd
+import pytest
+
+import parallel
+import stoich_calc
+from conftest import make_dataset
+
+# Mineral systems normalized on the anion basis (the basis of the reference).
+anion_systems = ['Olivine','Pyroxene','Amphibole','Spinel','Garnet','Hematite']
+
+@pytest.mark.parametrize('name',anion_systems)
+def test_kernel_matches_reference(min_systems,sram_lib,name):
+  min_sys = min_systems[name]
+  # The reference implementation does not handle analyses without any data.
+  dataset = make_dataset(60).drop('a3')
+  active_cols = stoich_calc.find_active_columns(dataset,min_sys)
+  pd.testing.assert_frame_equal(stoich_calc.calc_cations_per_formula_unit(dataset,active_cols,min_sys,sram_lib),
+                                stoich_calc.calc_cations_per_formula_unit_reference(dataset,active_cols,min_sys,sram_lib),
+                                check_exact=False,rtol=1e-12)
+
+def test_workspace_matches_plain(min_systems,sram_lib):
+  workspace = stoich_calc.CationWorkspace()
+  # Growing, shrinking and growing batches reuse the workspace buffers.
+  for name in min_systems:
+    for (rows,seed) in [(10,0),(500,1),(30,2),(500,3),(7,4)]:
+      dataset = make_dataset(rows,seed)
+      plain = stoich_calc.calc_stoich(dataset,min_systems[name],sram_lib)
+      reused = stoich_calc.calc_stoich(dataset,min_systems[name],sram_lib,workspace=workspace)
+      assert reused.equals(plain), name
+      assert reused.attrs == plain.attrs
+  assert workspace.info()['allocations'] <= 3
+
+def test_parallel_matches_serial(min_systems,sram_lib):
+  dataset = make_dataset(3000,seed=5)
+  for name in ['Amphibole','Chromite']:
+    serial = stoich_calc.calc_stoich(dataset,min_systems[name],sram_lib)
+    sharded = parallel.calc_stoich_parallel(dataset,min_systems[name],sram_lib,workers=2,shard_rows=700)
+    assert sharded.equals(serial), name
@@ -0,0 +1,71 @@
+# Stoichometry
+# tests/test_mineral_system.py
+#
+# Tests of mineral system definitions and the cached mineral system registry.
+#
+
+import os
+import pytest
+
+import mineral_system
+import util
+from conftest import minsys_definitions
+
+def write_systems(path,names=('olivine','garnet')):
+  for name in names:
+    (path/'{:}.minsys'.format(name)).write_text('\n'.join(minsys_definitions[name]) + '\n')
+
+def test_single_element_species_are_rejected(tmp_path):
+  lines = [l.replace('Oxides = SiO2,','Oxides = SiO2, F,') for l in minsys_definitions['amphibole']]
+  (tmp_path/'amphibole.minsys').write_text('\n'.join(lines) + '\n')
+  with pytest.raises(RuntimeError,match=r'Oxide "F" .*amphibole.minsys'):
+    util.load_mineral_systems(str(tmp_path))
+
+def test_systems_are_unpickled_lazily(tmp_path):
+  write_systems(tmp_path)
+  first = util.load_mineral_systems(str(tmp_path))
+  assert os.path.isfile(str(tmp_path/'mineral_systems.cache'))
+  registry = util.load_mineral_systems(str(tmp_path))
+  assert all(entry[1] is None for entry in registry.entries.values())
+  olivine = registry['Olivine']
+  assert registry.entries['Garnet'][1] is None
+  assert registry['Olivine'] is olivine
+  assert olivine.getOxideList() == first['Olivine'].getOxideList()
+  assert (olivine.getEndmemberComposition()[0] == first['Olivine'].getEndmemberComposition()[0]).all()
+
+def test_cache_is_invalidated_by_changes(tmp_path,monkeypatch):
+  write_systems(tmp_path)
+  util.load_mineral_systems(str(tmp_path))
+  # Only changed files are parsed again.
+  parsed = []
+  init = mineral_system.MineralSystem.__init__
+  def counting_init(self,filepath):
+    parsed.append(os.path.basename(filepath))
+    init(self,filepath)
+  monkeypatch.setattr(mineral_system.MineralSystem,'__init__',counting_init)
+  assert util.load_mineral_systems(str(tmp_path))['Olivine'].getAnionsPerFormulaUnit() == 4
+  assert parsed == []
+  path = tmp_path/'olivine.minsys'
+  path.write_text(path.read_text().replace('Anions per formula unit = 4','Anions per formula unit = 8'))
+  registry = util.load_mineral_systems(str(tmp_path))
+  assert parsed == ['olivine.minsys']
+  assert registry['Olivine'].getAnionsPerFormulaUnit() == 8
+  # Same size and contents, new modification time.
+  st = os.stat(str(path))
+  os.utime(str(path),ns=(st.st_atime_ns,st.st_mtime_ns + 10**9))
+  util.load_mineral_systems(str(tmp_path))
+  assert parsed == ['olivine.minsys']*2
+  # Removed and added files.
+  os.remove(str(path))
+  write_systems(tmp_path,['pyroxene'])
+  registry = util.load_mineral_systems(str(tmp_path))
+  assert sorted(registry.keys()) == ['Garnet','Pyroxene']
+  assert parsed[-1] == 'pyroxene.minsys'
+  # Systems cached in another format are parsed again.
+  monkeypatch.setattr(mineral_system,'cache_format',mineral_system.cache_format + 1)
+  util.load_mineral_systems(str(tmp_path))
+  assert sorted(parsed[-2:]) == ['garnet.minsys','pyroxene.minsys']
+
+def test_systems_are_immutable(min_systems):
+  with pytest.raises(AttributeError):
+    min_systems['Olivine'].apfu = 8
@@ -0,0 +1,54 @@
+# Stoichometry
+# tests/test_normalize.py
+#
+# Tests of the normalization of anhydrous oxides.
+#
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import stoich_calc
+
+active_cols = {'SiO2':'SiO2','FeO':'FeO','MgO':'MgO','H2O':'H2O'}
+
+def make_frame():
+  return pd.DataFrame({'SiO2':[40.0,30.0,np.nan,-1.0],'FeO':[10.0,np.nan,np.nan,0.0],
+                       'MgO':[45.0,-2.0,np.nan,0.0],'H2O':[5.0,20.0,np.nan,np.nan],'Comment':['a','b','c','d']},
+                      ['a0','a1','a2','a3'])
+
+def test_masking(min_systems,capsys):
+  dataset = make_frame()
+  normalized = stoich_calc.normalize_anhydrous_oxides(dataset,active_cols,min_systems['Olivine'])
+  # Non-positive and missing values are excluded from the sums and left unchanged.
+  np.testing.assert_allclose(normalized.loc['a0',list(active_cols)],[40.0,10.0,45.0,5.0])
+  np.testing.assert_allclose(normalized.loc['a1',['SiO2','H2O']],[60.0,40.0])
+  assert np.isnan(normalized.loc['a1','FeO']) and normalized.loc['a1','MgO'] == -2.0
+  # Analyses without any data are left unchanged, with a single warning.
+  assert normalized.loc['a2',list(active_cols)].isna().all()
+  assert list(normalized.loc['a3',['SiO2','FeO','MgO']]) == [-1.0,0.0,0.0]
+  assert capsys.readouterr().out.strip() == 'WARNING: No data for 2 analyses: a2, a3'
+  assert list(normalized['Comment']) == ['a','b','c','d']
+
+def test_copy_or_inplace(min_systems):
+  dataset = make_frame()
+  original = dataset.copy()
+  normalized = stoich_calc.normalize_anhydrous_oxides(dataset,active_cols,min_systems['Olivine'])
+  assert normalized is not dataset
+  pd.testing.assert_frame_equal(dataset,original)
+  same = stoich_calc.normalize_anhydrous_oxides(dataset,active_cols,min_systems['Olivine'],inplace=True)
+  assert same is dataset
+  pd.testing.assert_frame_equal(dataset,normalized)
+
+def test_custom_target(min_systems):
+  normalized = stoich_calc.normalize_anhydrous_oxides(make_frame(),active_cols,min_systems['Olivine'],target=50.0)
+  np.testing.assert_allclose(normalized.loc['a0',list(active_cols)],[20.0,5.0,22.5,2.5])
+
+def test_volatile_free(min_systems):
+  normalized = stoich_calc.normalize_anhydrous_oxides(make_frame(),active_cols,min_systems['Olivine'],
+                                                      target='volatile-free')
+  # Only the non-volatile oxides sum to 100; H2O is left unchanged.
+  np.testing.assert_allclose(normalized.loc['a0',list(active_cols)],[4000/95,1000/95,4500/95,5.0])
+  np.testing.assert_allclose(normalized.loc['a1',['SiO2','H2O']],[100.0,20.0])
+  with pytest.raises(ValueError,match='Unknown normalization target'):
+    stoich_calc.normalize_anhydrous_oxides(make_frame(),active_cols,min_systems['Olivine'],target='dry')
@@ -0,0 +1,61 @@
+# Stoichometry
+# tests/test_resolver.py
+#
+# Tests of the resolution of oxide columns from dataset headers.
+#
+
+import pandas as pd
+import pytest
+
+import stoich_calc
+import util
+
+oxides = ('SiO2','FeO','MgO','NiO')
+
+def resolve(columns,aliases=stoich_calc.column_aliases):
+  return stoich_calc.resolve_columns(columns,oxides,aliases)
+
+@pytest.mark.parametrize('columns,expected',[
+  (['SiO2','FeO','MgO'],{'SiO2':'SiO2','FeO':'FeO','MgO':'MgO'}),
+  (['SiO2 wt%','FeO (wt.%)','MgO_wt'],{'SiO2 wt%':'SiO2','FeO (wt.%)':'FeO','MgO_wt':'MgO'}),
+  (['FeOT','sio2','MGO'],{'sio2':'SiO2','FeOT':'FeO','MGO':'MgO'}),
+  (['FeO*','Fe2O3'],{'FeO*':'FeO'}),
+])
+def test_matches(columns,expected):
+  assert resolve(columns) == expected
+
+def test_precedence():
+  # Exact headers win over headers with units, which win over aliases and case-insensitive matches.
+  assert resolve(['FeO wt%','FeOT','FeO','feo']) == {'FeO':'FeO'}
+  assert resolve(['FeOT','feo','FeO wt%']) == {'FeO wt%':'FeO'}
+  assert resolve(['feo','FeOT']) == {'FeOT':'FeO'}
+  # Precedence holds over all oxides, whatever the column order.
+  assert resolve(['sio2','SiO2']) == {'SiO2':'SiO2'}
+
+def test_each_column_once():
+  assert resolve(['SiO2','SiO2 wt%']) == {'SiO2':'SiO2'}
+  assert stoich_calc.resolve_columns(['FeOT'],('FeO','Fe2O3'),{'FeOT':'FeO'}) == {'FeOT':'FeO'}
+
+def test_uncertainty_columns_are_skipped():
+  assert resolve(['SiO2 1s','SiO2_err','MgO']) == {'MgO':'MgO'}
+
+@pytest.mark.parametrize('column',['NiO ppm','Std SiO2','Avg SiO2','SiO2/Al2O3','NiO (ppb)'])
+def test_other_headers_are_rejected(column,capsys):
+  assert resolve([column]) == {}
+  assert "WARNING: Columns not used as oxide wt%: {!r}".format(column) in capsys.readouterr().out
+
+def test_no_warning_when_resolved(capsys):
+  assert resolve(['SiO2','Std SiO2']) == {'SiO2':'SiO2'}
+  assert capsys.readouterr().out == ''
+
+def test_find_active_columns_is_cached(min_systems,monkeypatch):
+  monkeypatch.setattr(stoich_calc,'resolver_cache',util.LRUCache(16))
+  calls = []
+  resolve_columns = stoich_calc.resolve_columns
+  monkeypatch.setattr(stoich_calc,'resolve_columns',lambda *args: calls.append(args) or resolve_columns(*args))
+  dataset = pd.DataFrame(columns=['Comment','SiO2 wt%','FeOT','MgO','NiO ppm','Total'])
+  for i in range(3):
+    active_cols = stoich_calc.find_active_columns(dataset,min_systems['Olivine'])
+    assert active_cols == {'SiO2 wt%':'SiO2','FeOT':'FeO','MgO':'MgO'}
+    active_cols.clear()
+  assert len(calls) == 1
@@ -0,0 +1,48 @@
+# Stoichometry
+# tests/test_results_io.py
+#
+# Tests of exporting and re-importing results in every results file format.
+#
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import results_io
+import stoich_calc
+from conftest import make_dataset
+
+@pytest.fixture(scope='module')
+def results(min_systems,sram_lib):
+  return stoich_calc.calc_stoich(make_dataset(40),min_systems['Pyroxene'],sram_lib)
+
+@pytest.mark.parametrize('ext',list(results_io.formats))
+@pytest.mark.parametrize('mmap',[True,False])
+def test_round_trip(tmp_path,results,ext,mmap):
+  fmt = results_io.formats[ext]
+  if fmt not in results_io.available_formats():
+    pytest.skip('The {:} format requires pyarrow.'.format(fmt))
+  path = str(tmp_path/('results' + ext))
+  results_io.export_results(results,path)
+  if fmt == 'npy':
+    assert os.path.isfile(results_io.sidecar_path(path))
+  imported = results_io.import_results(path,mmap=mmap)
+  assert list(imported.columns) == list(results.columns)
+  assert list(imported.index) == list(results.index)
+  np.testing.assert_allclose(imported.to_numpy(),results.to_numpy(),rtol=1e-12 if fmt == 'text' else 0)
+  if fmt == 'text':
+    # Text results do not carry metadata.
+    assert imported.attrs == {}
+  else:
+    assert imported.attrs == results.attrs
+    assert imported.attrs['sram_version'] == results.attrs['sram_version']
+
+def test_npy_requires_numeric_columns(tmp_path,results):
+  labeled = results.assign(Comment='x')
+  with pytest.raises(ValueError,match='Comment'):
+    results_io.export_results(labeled,str(tmp_path/'results.npy'))
+
+def test_unknown_extension(tmp_path,results):
+  with pytest.raises(ValueError,match='.xlsx'):
+    results_io.export_results(results,str(tmp_path/'results.xlsx'))
@@ -0,0 +1,45 @@
+# Stoichometry
+# tests/test_row_cache.py
+#
+# Tests of the per-row results cache of calc_stoich_incremental.
+#
+
+import numpy as np
+import pandas as pd
+
+import stoich_calc
+import util
+from conftest import make_dataset
+
+def test_incremental_matches_calc_stoich(min_systems,sram_lib,monkeypatch):
+  monkeypatch.setattr(stoich_calc,'row_caches',util.LRUCache(16))
+  min_sys = min_systems['Pyroxene']
+  dataset = make_dataset(300)
+  for stop in [100,150,300,300]:
+    pd.testing.assert_frame_equal(stoich_calc.calc_stoich_incremental(dataset[:stop],min_sys,sram_lib),
+                                  stoich_calc.calc_stoich(dataset[:stop],min_sys,sram_lib))
+  info = stoich_calc.row_cache_info()[0]
+  assert info['rows'] == 300
+  assert info['chunks'] <= 3
+
+def test_cache_is_bounded(min_systems,sram_lib,monkeypatch):
+  monkeypatch.setattr(stoich_calc,'max_cached_rows',10)
+  monkeypatch.setattr(stoich_calc,'row_caches',util.LRUCache(16))
+  min_sys = min_systems['Olivine']
+  dataset = make_dataset(40,seed=1)
+  # A reload that clears the cache, then a block larger than the cache.
+  for (start,stop) in [(0,8),(8,20),(0,40)]:
+    pd.testing.assert_frame_equal(stoich_calc.calc_stoich_incremental(dataset[start:stop],min_sys,sram_lib),
+                                  stoich_calc.calc_stoich(dataset[start:stop],min_sys,sram_lib))
+    assert stoich_calc.row_cache_info()[0]['rows'] <= 10
+
+def test_row_cache_chunks():
+  cache = stoich_calc.RowCache(1)
+  for start in range(0,1000,10):
+    hashes = np.arange(start,start + 10,dtype=np.uint64)
+    cache.add(hashes,hashes[:,None].astype(float))
+  assert cache.rows == 1000
+  assert len(cache.chunks) <= 10
+  values, missing = cache.take(np.array([5,999,1000],np.uint64))
+  assert list(missing) == [False,False,True]
+  assert list(values[:2,0]) == [5.0,999.0]
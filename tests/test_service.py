@@ -0,0 +1,81 @@
+# Stoichometry
+# tests/test_service.py
+#
+# Tests of request handling in the stoichiometry service.
+#
+
+import asyncio
+import os
+import pytest
+
+import batch
+import stoich_service
+
+def read(data):
+  '''
+  Returns the result of stoich_service.read_request for the specified raw request.
+  '''
+  async def run():
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return await stoich_service.read_request(reader)
+  return asyncio.run(run())
+
+def test_read_request_body():
+  assert read(b'POST /calculate HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}') == ('POST','/calculate',b'{}')
+
+@pytest.mark.parametrize('length',['abc','-1','1.5','\xb2'])
+def test_invalid_content_length(length):
+  request = 'POST /calculate HTTP/1.1\r\nContent-Length: {:}\r\n\r\n{{}}'.format(length).encode('latin-1')
+  with pytest.raises(stoich_service.ServiceError) as e:
+    read(request)
+  assert e.value.status == 400
+
+def test_parse_json():
+  assert stoich_service.parse_json(b'{"rows": []}') == {'rows':[]}
+  with pytest.raises(ValueError):
+    stoich_service.parse_json(b'{"rows": [')
+
+def test_warm_worker(minsys_dir,min_systems):
+  resources = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'resources')
+  batch.init_worker(os.path.join(resources,'AtomicWeights_IsotopicCompositions_NIST_4.1.txt'),
+                    os.path.join(resources,'SelectedGeologicAtomicWeights.txt'),None,minsys_dir)
+  assert stoich_service.warm_worker() == len(min_systems)
+  assert batch.worker_workspace.nbytes() > 0
+
+def parse_error(body,min_systems):
+  '''
+  Returns the ServiceError raised by stoich_service.parse_calculation for the
+  specified request body.
+  '''
+  with pytest.raises(stoich_service.ServiceError) as e:
+    stoich_service.parse_calculation(body,min_systems)
+  return e.value
+
+def test_parse_calculation_rows(min_systems):
+  body = {'system':'Olivine','columns':['SiO2','MgO'],'rows':[[40.0,50.0]]}
+  assert stoich_service.parse_calculation(body,min_systems) == ('Olivine',['SiO2','MgO'],[0],[[40.0,50.0]])
+  body = {'system':'Olivine','index':['a1','a2'],'rows':[{'SiO2':40.0},{'MgO':50.0}]}
+  assert stoich_service.parse_calculation(body,min_systems) == ('Olivine',['SiO2','MgO'],['a1','a2'],
+                                                                [[40.0,None],[None,50.0]])
+
+def test_parse_calculation_empty_rows(min_systems):
+  assert stoich_service.parse_calculation({'system':'Olivine','rows':[]},min_systems) == ('Olivine',[],[],[])
+
+@pytest.mark.parametrize('rows',[[{'SiO2':40.0},[50.0]],[[40.0],{'SiO2':40.0}],[[40.0],'SiO2']])
+def test_parse_calculation_mixed_rows(min_systems,rows):
+  error = parse_error({'system':'Olivine','columns':['SiO2'],'rows':rows},min_systems)
+  assert error.status == 400 and 'all objects or all lists' in str(error)
+
+def test_parse_calculation_no_oxide_columns(min_systems):
+  error = parse_error({'system':'Olivine','rows':[{'Sample':1.0,'Total':99.0}]},min_systems)
+  assert error.status == 400
+  assert 'No Olivine oxide columns' in str(error) and 'SiO2' in str(error)
+
+def test_calc_chunk_empty(minsys_dir):
+  resources = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'resources')
+  batch.init_worker(os.path.join(resources,'AtomicWeights_IsotopicCompositions_NIST_4.1.txt'),
+                    os.path.join(resources,'SelectedGeologicAtomicWeights.txt'),None,minsys_dir)
+  (columns,index,data) = stoich_service.calc_chunk('Olivine',[],[],[])
+  assert index == [] and data == []
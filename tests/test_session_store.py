@@ -0,0 +1,62 @@
+# Stoichometry
+# tests/test_session_store.py
+#
+# Tests of spilling and reloading entries of a SessionStore.
+#
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import results_io
+import session_store
+
+def make_frame(rows=100):
+  return pd.DataFrame({'Point':np.arange(rows,dtype=np.int64),'SiO2':np.linspace(40.0,50.0,rows)},
+                      ['a{:}'.format(i) for i in range(rows)])
+
+def spilled_store(tmp_path,value):
+  '''
+  Returns a store with the specified value spilled to disk under the key 'x'.
+  '''
+  store = session_store.SessionStore(budget=0,spill_dir=str(tmp_path))
+  store['x'] = value
+  store['y'] = pd.DataFrame({'z':[0.0]})
+  assert store.usage()[0][2] == 'disk'
+  return store
+
+def test_float_frame_is_mapped_and_writable(tmp_path):
+  frame = make_frame()[['SiO2']]
+  store = spilled_store(tmp_path,frame)
+  value = store['x']
+  assert store.usage()[-1][2] == 'mapped'
+  pd.testing.assert_frame_equal(value,frame)
+  value.iloc[0,0] = -1.0
+  assert store['x'].iloc[0,0] == -1.0
+  # The spill file is unchanged.
+  assert results_io.import_results(store.entries['x'].path).iloc[0,0] == frame.iloc[0,0]
+  store.close()
+
+def test_mixed_dtypes_are_preserved(tmp_path):
+  if 'feather' not in results_io.available_formats():
+    pytest.skip('pyarrow is not available')
+  frame = make_frame()
+  store = spilled_store(tmp_path,frame)
+  value = store['x']
+  pd.testing.assert_frame_equal(value,frame)
+  assert value['Point'].dtype == np.int64
+  value.loc['a0','Point'] = 7
+  # The modified value is written again when it is next spilled.
+  store['y'] = pd.DataFrame({'z':[0.0]})
+  assert store['x'].loc['a0','Point'] == 7
+  store.close()
+
+def test_mixed_dtypes_stay_in_memory_without_feather(tmp_path,monkeypatch):
+  monkeypatch.setattr(results_io,'available_formats',lambda: ['text','npy','npz'])
+  frame = make_frame()
+  store = session_store.SessionStore(budget=0,spill_dir=str(tmp_path))
+  store['x'] = frame
+  store['y'] = pd.DataFrame({'z':[0.0]})
+  assert store.usage()[0][2] == 'memory'
+  assert store['x'] is frame
+  store.close()
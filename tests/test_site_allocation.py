@@ -0,0 +1,58 @@
+# Stoichometry
+# tests/test_site_allocation.py
+#
+# Tests of site allocation rules and the site allocation engine.
+#
+
+import numpy as np
+import pytest
+
+import mineral_system
+import stoich_calc
+import util
+from conftest import minsys_definitions, oxide_dataset
+
+def allocate(min_systems,sram_lib,analyses):
+  min_sys = min_systems['Pyroxene']
+  formula_cations = stoich_calc.calc_stoich(oxide_dataset(sram_lib,analyses),min_sys,sram_lib)
+  return stoich_calc.calc_site_allocation(formula_cations,min_sys)
+
+def test_pyroxene_fills_t_before_m(min_systems,sram_lib):
+  # Si1.8 Al0.4 Mg1.0 Ca0.8 O6: Al fills T to 2, then M1 with Mg; the rest of Mg and Ca go to M2.
+  allocation = allocate(min_systems,sram_lib,[{'SiO2':1.8,'Al2O3':0.2,'MgO':1.0,'CaO':0.8}]).iloc[0]
+  expected = {'Si(T)':1.8,'Al(T)':0.2,'Vacancy(T)':0.0,'Al(M1)':0.2,'Mg(M1)':0.8,'Fe(M1)':0.0,'Vacancy(M1)':0.0,
+              'Mg(M2)':0.2,'Ca(M2)':0.8,'Na(M2)':0.0,'Vacancy(M2)':0.0,'Unallocated':0.0}
+  for (column,value) in expected.items():
+    assert allocation[column] == pytest.approx(value,abs=1e-12), column
+
+def test_vacancies_and_unallocated(min_systems,sram_lib):
+  # Si1.9 Mg2.2 per 6 O (4.1 cations): T is not full, and Mg is left over after M2.
+  allocation = allocate(min_systems,sram_lib,[{'SiO2':1.9,'MgO':2.2},{}])
+  row = allocation.iloc[0]
+  assert row['Vacancy(T)'] == pytest.approx(0.1)
+  assert (row['Mg(M1)'],row['Mg(M2)']) == (pytest.approx(1.0),pytest.approx(1.0))
+  assert row['Unallocated'] == pytest.approx(0.2)
+  # Analyses without data have no occupancies.
+  assert allocation.iloc[1].filter(regex=r'\(|Unallocated').isna().all()
+
+def test_no_site_rules(min_systems,sram_lib):
+  formula_cations = stoich_calc.calc_stoich(oxide_dataset(sram_lib,[{'SiO2':1.0,'MgO':2.0}]),
+                                            min_systems['Olivine'],sram_lib)
+  with pytest.raises(ValueError,match='No site rules'):
+    stoich_calc.calc_site_allocation(formula_cations,min_systems['Olivine'])
+
+def test_parse_sites():
+  sites = mineral_system.parse_sites('T(2): Si, Al; M1(1): Mg;','x.minsys')
+  assert sites == (('T',2.0,('Si','Al')),('M1',1.0,('Mg',)))
+
+@pytest.mark.parametrize('text',['T(2) Si, Al','T: Si','T2: Si','T(0): Si','T(-1): Si','T(x): Si',
+                                 '(2): Si','T(2): ','T(2): Si, Si'])
+def test_parse_sites_rejects_malformed_rules(text):
+  with pytest.raises(RuntimeError,match='Invalid site rule.*x.minsys'):
+    mineral_system.parse_sites(text,'x.minsys')
+
+def test_invalid_sites_in_file(tmp_path):
+  lines = [l for l in minsys_definitions['pyroxene'] if not l.startswith('Sites')] + ['Sites = T(2) Si, Al']
+  (tmp_path/'pyroxene.minsys').write_text('\n'.join(lines) + '\n')
+  with pytest.raises(RuntimeError,match='pyroxene.minsys'):
+    util.load_mineral_systems(str(tmp_path))['Pyroxene'].getSiteList()
@@ -0,0 +1,53 @@
+# Stoichometry
+# tests/test_sram_snapshot.py
+#
+# Tests of the binary snapshot of the SRAM library.
+#
+
+import os
+import shutil
+
+import engine
+import util
+from conftest import repo_dir
+
+def copy_sources(tmp_path):
+  '''
+  Returns the paths of copies of the SRAM library source files in tmp_path.
+  '''
+  sources = []
+  for path in [engine.def_sram_nist_path,engine.def_sram_patch_path]:
+    sources.append(str(tmp_path/os.path.basename(path)))
+    shutil.copyfile(os.path.join(repo_dir,path),sources[-1])
+  return sources
+
+def test_snapshot_is_current(tmp_path):
+  sources = copy_sources(tmp_path)
+  snapshot_path = str(tmp_path/'sram_lib.snapshot')
+  sram_lib = util.load_sram_library(sources[0],sources[1],snapshot_path)
+  snapshot = {'sources':[util.source_signature(path) for path in sources],'library':sram_lib}
+  assert util.snapshot_is_current(snapshot,sources)
+  assert util.load_sram_library(sources[0],sources[1],snapshot_path) == sram_lib
+  # A touched file with the same contents is still current.
+  st = os.stat(sources[1])
+  os.utime(sources[1],ns=(st.st_atime_ns,st.st_mtime_ns + 10**9))
+  assert util.snapshot_is_current(snapshot,sources)
+  # Changed contents (even of the same size) make the snapshot stale.
+  with open(sources[1],'rb') as f:
+    content = f.read()
+  with open(sources[1],'wb') as f:
+    f.write(content.replace(b'Notes',b'NOTES',1))
+  assert os.path.getsize(sources[1]) == st.st_size
+  assert not util.snapshot_is_current(snapshot,sources)
+  # A different list of sources is stale too.
+  assert not util.snapshot_is_current(snapshot,sources[:1])
+
+def test_snapshot_path_per_sources(tmp_path):
+  default = engine.sram_snapshot_path(engine.def_sram_nist_path,engine.def_sram_patch_path)
+  assert default == engine.def_sram_snapshot_path
+  sources = copy_sources(tmp_path)
+  custom = engine.sram_snapshot_path(*sources)
+  assert custom != default and os.path.dirname(custom) == os.path.dirname(default)
+  assert engine.sram_snapshot_path(sources[0],engine.def_sram_patch_path) not in [default,custom]
+  # Explicit snapshot paths are used as they are.
+  assert engine.sram_snapshot_path(*sources,snapshot=str(tmp_path/'s')) == str(tmp_path/'s')
@@ -0,0 +1,42 @@
+# Stoichometry
+# tests/test_startup.py
+#
+# Tests of the startup time budget: import time of the stoichiometry module and
+# latency of a first small calculation, measured in a fresh interpreter.
+#
+
+import json
+import os
+import subprocess
+import sys
+import pytest
+import benchmark
+from conftest import repo_dir
+
+# Modules that importing the stoichiometry module must not import.
+deferred_modules = ['pandas','stoich_calc','batch','results_io','session_store','parallel']
+
+def test_import_defers_modules():
+  script = 'import json, sys, stoichiometry; print(json.dumps(sorted(sys.modules)))'
+  output = subprocess.run([sys.executable,'-c',script],cwd=repo_dir,capture_output=True,
+                          text=True,check=True).stdout
+  loaded = set(json.loads(output.splitlines()[-1]))
+  assert [m for m in deferred_modules if m in loaded] == []
+
+# Wall-clock times depend on the machine and its load, so the budget is only
+# checked when STOICH_TIMING_TESTS is set.
+@pytest.mark.skipif(not os.environ.get('STOICH_TIMING_TESTS'),
+                    reason='set STOICH_TIMING_TESTS to check the startup budget')
+def test_startup_within_budget(minsys_dir):
+  record = benchmark.measure_startup(minsys_dir,'Olivine')
+  assert record['system'] == 'Olivine'
+  assert benchmark.check_startup(record) == []
+
+def test_check_startup_reports_overruns():
+  record = {'import_seconds':0.5,'first_result_seconds':3.0}
+  failures = benchmark.check_startup(record,{'import_seconds':1.0,'first_result_seconds':2.0})
+  assert len(failures) == 1 and failures[0].startswith('first_result_seconds')
+
+def test_no_mineral_systems(tmp_path):
+  with pytest.raises(RuntimeError,match='No mineral systems'):
+    benchmark.measure_startup(str(tmp_path))
@@ -0,0 +1,45 @@
+# Stoichometry
+# tests/test_uncertainty.py
+#
+# Tests of the Monte Carlo uncertainty propagation (calc_cations_uncertainty).
+#
+
+import numpy as np
+import pytest
+import stoich_calc
+from conftest import make_dataset
+
+@pytest.fixture
+def dataset_with_sigmas():
+  dataset = make_dataset(60,seed=1)
+  dataset['SiO2 1s'] = 0.5
+  dataset['MgO 1s'] = 0.2
+  return dataset
+
+def uncertainty(dataset,min_sys,sram_lib,**kwargs):
+  active_cols = stoich_calc.find_active_columns(dataset,min_sys)
+  return stoich_calc.calc_cations_uncertainty(dataset,active_cols,min_sys,sram_lib,draws=50,seed=7,**kwargs)
+
+def test_reproducible_across_block_sizes(dataset_with_sigmas,sram_lib,min_systems):
+  min_sys = min_systems['Olivine']
+  mean, std = uncertainty(dataset_with_sigmas,min_sys,sram_lib)
+  for max_block_bytes in [2**12,2**15,2**18]:
+    block_mean, block_std = uncertainty(dataset_with_sigmas,min_sys,sram_lib,max_block_bytes=max_block_bytes)
+    np.testing.assert_allclose(block_mean.to_numpy(),mean.to_numpy(),rtol=1e-12,atol=1e-15)
+    np.testing.assert_allclose(block_std.to_numpy(),std.to_numpy(),rtol=1e-9,atol=1e-15)
+
+def test_same_seed_same_results(dataset_with_sigmas,sram_lib,min_systems):
+  min_sys = min_systems['Olivine']
+  first, second = uncertainty(dataset_with_sigmas,min_sys,sram_lib), uncertainty(dataset_with_sigmas,min_sys,sram_lib)
+  assert first[0].equals(second[0]) and first[1].equals(second[1])
+
+def test_mean_close_to_nominal(dataset_with_sigmas,sram_lib,min_systems):
+  min_sys = min_systems['Olivine']
+  active_cols = stoich_calc.find_active_columns(dataset_with_sigmas,min_sys)
+  nominal = stoich_calc.calc_cations_per_formula_unit(dataset_with_sigmas,active_cols,min_sys,sram_lib)
+  mean, std = uncertainty(dataset_with_sigmas,min_sys,sram_lib)
+  assert list(mean.columns) == list(nominal.columns)
+  # Rows with data have a positive spread in Si; deviations stay within a few sigma.
+  has_si = nominal['Si/4 O'].notna() & mean['Si/4 O'].notna()
+  assert (std['Si/4 O'][has_si] > 0.0).all()
+  assert ((mean['Si/4 O'] - nominal['Si/4 O'])[has_si].abs() < 5.0*std['Si/4 O'][has_si]).all()
@@ -9,22 +9,45 @@
 # Copyright (C), 2017
 #
 
-from mineral_system import MineralSystem
-import numpy as np  # Import numpy module.
 import re           # Import module for regular expressions.
-import pandas as pd # Module for managing large datasets.
 import json         # Module for reading/writing JSON files.
 import os, sys      # Modules for performing common OS and system tasks.
 import glob         # Module for finding files in directories.
+import itertools    # Module for efficient iterators (version counters).
+import pickle       # Module for binary snapshots of loaded data.
+import hashlib      # Module for hashing snapshot source files.
+import threading    # Module for locks shared between threads.
+import numpy as np  # Import numpy module.
+import instrument
+import mineral_system
+from collections import OrderedDict, namedtuple
 
 # Variables and methods for loading atomic weight information.
 sram_types = {'unknown':'standard relative atomic mass not known',
               'interval':'standard relative atomic mass varies widely in natural materials, so an interval is published',
               'quantity':'standard relative atomic mass given as a value with decisional uncertainties',
               'most_stable':'standard relative atomic mass is that of the most stable isotope of the element of interest'}
+sram_version_counter = itertools.count(1)
 CURSOR_UP_ONE = '\x1b[1A'
 DELETE_LINE = '\x1b[2K'
 
+# SRAMLibrary class.
+class SRAMLibrary(dict):
+  '''
+  Dictionary of elements and their atomic weight information, as returned by
+  load_atomic_weights. Each library carries a version number that is unique
+  within the process and changes whenever the library is patched with
+  update_sram_lib, so that cached results can be keyed by it.
+  '''
+  def __init__(self,*args,**kwargs):
+    dict.__init__(self,*args,**kwargs)
+    self.version = next(sram_version_counter)
+
+  def __reduce__(self):
+    # Unpickled libraries get a fresh version number.
+    return (SRAMLibrary,(dict(self),))
+
+@instrument.instrumented()
 def load_atomic_weights(filepath):
   '''
   Loads atomic weights from the specified NIST linearized ASCII file,
@@ -34,14 +57,14 @@ def load_atomic_weights(filepath):
   - filepath - the path to the NIST datafile.
   '''
   # Create dict container for elements data.
-  elems = dict()
+  elems = SRAMLibrary()
   # Read file and parse the contents.
   with open(filepath,'r') as f:
     lines = f.readlines()
   # Define variables.
   cz, lz = 0, 0     # Current and last Z values (proton number).
   ce = ''           # Current element symbol.
-  mse, msa = [], [] # Most stable nuclide search lists (element, mass number A).
+  ms = {}           # Mass numbers A of most stable nuclides, by element.
   for line in lines:
     if line == "":
       # Skip blank lines
@@ -78,8 +101,7 @@ def load_atomic_weights(filepath):
               # The sram indicates the mass number of the most stable isotope.
               elems[ce]['A'] = int(sram.replace('[','').replace(']',''))
               elems[ce]['N'] = elems[ce]['A'] - elems[ce]['Z'] # Recalculate N.
-              mse.append(ce)
-              msa.append(elems[ce]['A'])
+              ms[ce] = elems[ce]['A']
           else:
             # The sram is given as a value with an uncertainty.
             nums = sram.replace(')','').split('(')
@@ -106,7 +128,7 @@ def load_atomic_weights(filepath):
       elif items[0] == 'Mass Number':
         ca = int(items[1])
       elif items[0] == 'Relative Atomic Mass':
-        if ce in mse and ca == msa[mse.index(ce)]:
+        if ms.get(ce) == ca:
           nums = items[1].replace(')','').split('(')
           ndec = len(nums[0]) - nums[0].index('.') - 1
           uncert = '0.' + '0'*(ndec - len(nums[1])) + nums[1]
@@ -120,90 +142,362 @@ def update_sram_lib(subject,patch):
   patch sram_lib, only for those elements that are present in the patch lib.
   The updated subject lib is returned.
   '''
+  old_version = sram_version(subject)
   for (k,v) in patch.items():
     subject[k] = v
+  # Give the patched library a new version, and drop stale cached formulas.
+  # (Nothing is cached for plain dictionaries.)
+  if isinstance(subject,SRAMLibrary):
+    subject.version = next(sram_version_counter)
+    formula_cache.invalidate(lambda key: key[1] == old_version)
   return subject
 
-# Regular expressions and methods for parsing chemical formulas.
-re_elem = re.compile(r'([A-Z][a-z]?)([0-9]+)?') # elem, with repeats
-re_enor = re.compile(r'([A-Z][a-z]?)')          # elem, no repeats
-re_lpar = re.compile(r'\(')                     # opening left paren
-re_rpar = re.compile(r'\)([0-9]+)?')            # closing right paren, with repeats
+def sram_version(sram_lib):
+  '''
+  Returns the version of the specified sram_lib, for use in cache keys, or None
+  for plain dictionaries (rather than SRAMLibrary objects): their contents may
+  change at any time, so results computed with them are not cached. Wrap them
+  with SRAMLibrary (see as_sram_library) to benefit from the caches.
+  '''
+  if isinstance(sram_lib,SRAMLibrary):
+    return sram_lib.version
+  return None
+
+def as_sram_library(sram_lib):
+  '''
+  Returns the specified sram_lib as an SRAMLibrary; plain dictionaries are
+  copied into a new SRAMLibrary.
+  '''
+  return sram_lib if isinstance(sram_lib,SRAMLibrary) else SRAMLibrary(sram_lib)
+
+def sram_digest(sram_lib):
+  '''
+  Returns a short content hash of the specified sram_lib. Unlike sram_version,
+  the digest is the same across processes for the same library contents, so it
+  can be stored with results.
+  '''
+  version = sram_version(sram_lib)
+  digest = None if version is None else sram_digests.get(version)
+  if digest is None:
+    content = json.dumps(sram_lib,sort_keys=True).encode('utf-8')
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    if version is not None:
+      sram_digests.put(version,digest)
+  return digest
+
+@instrument.instrumented()
+def load_sram_library(nist,patch,snapshot_path=None):
+  '''
+  Returns the SRAM library loaded from the specified NIST file and patched with
+  the specified patch file (see load_atomic_weights and update_sram_lib).
+
+  If a snapshot path is specified, the patched library is loaded from that
+  binary snapshot when it is up to date with the source files (checked by
+  modification time and size, falling back to a content hash), and the
+  snapshot is regenerated otherwise.
+  '''
+  if snapshot_path is not None and os.path.isfile(snapshot_path):
+    try:
+      with open(snapshot_path,'rb') as f:
+        snapshot = pickle.load(f)
+      if snapshot_is_current(snapshot,[nist,patch]):
+        return snapshot['library']
+    except (OSError,EOFError,pickle.UnpicklingError,KeyError,TypeError):
+      pass # Unreadable snapshot; regenerate it below.
+  sram_lib = update_sram_lib(load_atomic_weights(nist),load_atomic_weights(patch))
+  if snapshot_path is not None:
+    try:
+      write_sram_snapshot(sram_lib,[nist,patch],snapshot_path)
+    except OSError:
+      print('Warning: could not write SRAM library snapshot: {:}'.format(snapshot_path))
+  return sram_lib
+
+def write_sram_snapshot(sram_lib,sources,snapshot_path):
+  '''
+  Writes a binary snapshot of the specified sram_lib, recording the state of the
+  specified source files so that stale snapshots can be detected.
+  '''
+  snapshot = {'sources':[source_signature(path) for path in sources],'library':sram_lib}
+  # Write to a temporary file first so that concurrent readers never see a partial snapshot.
+  tmp_path = '{:}.{:}.tmp'.format(snapshot_path,os.getpid())
+  with open(tmp_path,'wb') as f:
+    pickle.dump(snapshot,f,pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_path,snapshot_path)
+
+def source_signature(path,with_hash=True):
+  '''
+  Returns a dict describing the state of the specified source file: its absolute
+  path, modification time, size and (optionally) SHA-256 digest.
+  '''
+  st = os.stat(path)
+  sig = {'path':os.path.abspath(path),'mtime':st.st_mtime_ns,'size':st.st_size}
+  if with_hash:
+    with open(path,'rb') as f:
+      sig['sha256'] = hashlib.sha256(f.read()).hexdigest()
+  return sig
+
+def snapshot_is_current(snapshot,sources):
+  '''
+  Returns True if the source signatures recorded in the specified snapshot match
+  the specified source files.
+  '''
+  if len(snapshot['sources']) != len(sources):
+    return False
+  for (recorded,path) in zip(snapshot['sources'],sources):
+    current = source_signature(path,False)
+    if current['path'] != recorded['path']:
+      return False
+    if current['mtime'] != recorded['mtime'] or current['size'] != recorded['size']:
+      # The file was touched or changed; compare contents.
+      if source_signature(path)['sha256'] != recorded['sha256']:
+        return False
+  return True
+
+# LRUCache class.
+class LRUCache(object):
+  '''
+  A bounded, least-recently-used cache that keeps hit, miss and eviction counts.
+  All operations hold a lock, so caches can be shared between threads. Lookups
+  in instrumented caches are also counted for the open stages of the calling
+  thread (see instrument.record_cache).
+  '''
+  def __init__(self,maxsize=1024,instrumented=False):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.hits, self.misses, self.evictions = 0, 0, 0
+    self.instrumented = instrumented
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self,key):
+    '''
+    Returns the value cached for the specified key, or None on a miss.
+    '''
+    with self.lock:
+      try:
+        value = self.entries[key]
+        self.entries.move_to_end(key)
+        self.hits += 1
+      except KeyError:
+        value = None
+        self.misses += 1
+    if self.instrumented and instrument.enabled:
+      instrument.record_cache(value is not None)
+    return value
+
+  def put(self,key,value):
+    '''
+    Caches the value for the specified key, evicting the least recently used
+    entries if the cache is full.
+    '''
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def setdefault(self,key,value):
+    '''
+    Returns the value cached for the specified key, caching the specified value
+    first on a miss (so that threads racing on a miss share one value).
+    '''
+    with self.lock:
+      hit = key in self.entries
+      if hit:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        value = self.entries[key]
+      else:
+        self.misses += 1
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+          self.entries.popitem(last=False)
+          self.evictions += 1
+    if self.instrumented and instrument.enabled:
+      instrument.record_cache(hit)
+    return value
+
+  def items(self):
+    '''
+    Returns a list of the (key, value) pairs in the cache.
+    '''
+    with self.lock:
+      return list(self.entries.items())
+
+  def invalidate(self,predicate=None):
+    '''
+    Removes all entries whose keys satisfy the specified predicate (or all
+    entries, if no predicate is given).
+    '''
+    with self.lock:
+      if predicate is None:
+        self.entries.clear()
+      else:
+        for key in [k for k in self.entries if predicate(k)]:
+          del self.entries[key]
+
+  def info(self):
+    '''
+    Returns a dictionary of cache statistics.
+    '''
+    with self.lock:
+      return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,
+              'size':len(self.entries),'maxsize':self.maxsize}
+
+# Regular expression and methods for parsing chemical formulas.
+re_token = re.compile(r'''
+  (?P<elem>[A-Z][a-z]?)       # element symbol
+ |(?P<num>[0-9]+(?:\.[0-9]+)?) # count, or hydrate multiplier
+ |(?P<open>[(\[])             # opening parenthesis or bracket
+ |(?P<close>[)\]])            # closing parenthesis or bracket
+ |(?P<alt>,)                  # separator of site-mixing alternatives, e.g. (Mg,Fe)
+ |(?P<hyd>[\u00b7*.])         # hydrate separator, e.g. CaSO4\u00b72H2O or CaSO4.H2O
+ |(?P<space>\s+)              # whitespace (ignored)
+ |(?P<bad>.)                  # anything else is invalid
+''',re.VERBOSE)
+
+# FormulaError class.
+class FormulaError(ValueError):
+  '''
+  Raised when a chemical formula cannot be parsed. The formula, the position of
+  the offending character and the reason are available as attributes.
+  '''
+  def __init__(self,formula,position,reason):
+    self.formula = formula
+    self.position = position
+    self.reason = reason
+    ValueError.__init__(self,'Invalid chemical formula {!r} at position {:}: {:}'.format(formula,position,reason))
+
+def parse_formula(comp):
+  '''
+  Parses the specified chemical compound string in a single pass and returns a
+  dict of the constituent elements and their counts (see parse_compound).
+
+  Besides elements, counts and nested parentheses, the parser understands
+  decimal counts, square brackets, site-mixing alternatives such as (Mg,Fe)5
+  (the count is shared equally between the alternatives) and hydrate
+  separators with multipliers, such as CaSO4*2H2O or CaSO4\u00b72H2O. A '.'
+  also separates hydrates (CaSO4.H2O), except between digits, where it is a
+  decimal point. Nesting depth is not limited. Raises a FormulaError for
+  malformed input.
+  '''
+  if not isinstance(comp,str) or not comp.strip():
+    raise FormulaError(comp,0,'empty chemical formula')
+  total = {}         # Element counts of completed hydrate segments.
+  frames = [[{}]]    # Alternatives (dicts of element counts) for each open group.
+  opens = []         # Opening brackets (character, position) of open groups.
+  pending = None     # Last element or closed group, as [counts, counted flag].
+  multiplier = 1     # Multiplier of the current hydrate segment.
+  for m in re_token.finditer(comp):
+    kind, text, pos = m.lastgroup, m.group(), m.start()
+    if kind == 'space':
+      continue
+    if kind == 'num':
+      num = float(text) if '.' in text else int(text)
+      if pending is not None and not pending[1]:
+        pending = [{k:v*num for (k,v) in pending[0].items()},True]
+      elif pending is None and len(frames) == 1 and not frames[0][0] and multiplier == 1:
+        multiplier = num
+      else:
+        raise FormulaError(comp,pos,'unexpected number {:}'.format(text))
+      continue
+    # Any other token completes the pending element or group.
+    if pending is not None:
+      add_counts(frames[-1][-1],pending[0])
+      pending = None
+    if kind == 'elem':
+      pending = [{text:1},False]
+    elif kind == 'open':
+      frames.append([{}])
+      opens.append((text,pos))
+    elif kind == 'close':
+      if not opens:
+        raise FormulaError(comp,pos,'unmatched closing {:}'.format(text))
+      if opens.pop()[0] + text not in ['()','[]']:
+        raise FormulaError(comp,pos,'mismatched closing {:}'.format(text))
+      alts = frames.pop()
+      if not all(alts):
+        raise FormulaError(comp,pos,'empty group')
+      group = {}
+      for alt in alts:
+        add_counts(group,alt,1.0/len(alts) if len(alts) > 1 else 1)
+      pending = [group,False]
+    elif kind == 'alt':
+      if not opens or not frames[-1][-1]:
+        raise FormulaError(comp,pos,'unexpected comma')
+      frames[-1].append({})
+    elif kind == 'hyd':
+      if opens or not frames[0][0]:
+        raise FormulaError(comp,pos,'unexpected hydrate separator')
+      add_counts(total,frames[0][0],multiplier)
+      frames, multiplier = [[{}]], 1
+    else:
+      raise FormulaError(comp,pos,'invalid character {!r}'.format(text))
+  # Complete the last element or group, and the last hydrate segment.
+  if pending is not None:
+    add_counts(frames[-1][-1],pending[0])
+  if opens:
+    raise FormulaError(comp,opens[-1][1],'unmatched opening {:}'.format(opens[-1][0]))
+  if not frames[0][0]:
+    raise FormulaError(comp,len(comp),'formula ends without elements')
+  add_counts(total,frames[0][0],multiplier)
+  return total
+
+def add_counts(target,counts,scale=1):
+  '''
+  Helper for parse_formula; adds scaled element counts to the target dict.
+  '''
+  for (k,v) in counts.items():
+    target[k] = target.get(k,0) + scale*v
+
+# Caches of parsed formulas (keyed by formula) and compiled formulas (keyed by
+# formula and SRAM library version).
+parse_cache = LRUCache(4096,instrumented=True)
+formula_cache = LRUCache(4096,instrumented=True)
+# Digests of SRAM libraries (keyed by SRAM library version; see sram_digest).
+sram_digests = LRUCache(16)
+CompiledFormula = namedtuple('CompiledFormula',['formula','elements','counts','weight'])
 
 def parse_compound(comp):
   '''
   Parses the specified chemical compound string and returns a dict of the
   constituent elements, with the numbers of each element that are present
-  in the compound formula. Calls the rpc helper method.
+  in the compound formula. Calls the parse_formula method.
   '''
-  return rpc(comp)[0]
+  return dict(parsed_compound(comp))
 
-def rpc(comp,stack=[],nolp=0):
+def parsed_compound(comp):
   '''
-  Recursive helper function for parse_compound() method.
-  
-  Arguments:
-  - comp  - The chemical compound to parse.
-  - stack - List of dicts containing elements and how many of them there are.
-  - nolp  - The number of opening left parentheses that have not been closed.
-  '''
-  # Check for bad input.
-  if not comp:
-    print('Error - cannot parse empty chemical formula.')
-    return
-  # Declare variables for formula fragments. 
-  tail, head, num = [], [], 1
-  # Initialize the stack (if stack == []), or use existing one (e.g., if stack == [{}]).
-  stack = stack or [{}] 
-  # Test chemical formula for RE matches.
-  em = re_elem.match(comp)
-  lm = re_lpar.match(comp)
-  rm = re_rpar.match(comp)
-  if em:
-    head = em.group()
-    tail = comp[len(head):]
-    elem = re_enor.match(head).group()
-    num = 1
-    if len(head) > len(elem):
-      num = int(head[len(elem):])
-    if elem not in stack[-1]:
-      # First time adding this element to the dict.
-      stack[-1][elem] = num
-    else:
-      # Increment number for this element (head).
-      stack[-1][elem] += num
-  elif lm:
-    tail = comp[1:]
-    nolp += 1
-    stack.append({})
-  elif rm:
-    head = rm.group()
-    tail = comp[len(head):]
-    num = 1
-    if len(head) > 1:
-      num = int(head[1:])
-    nolp -= 1
-    if nolp < 0:
-      print('Error - unmatched right parenthesis in formula: {:}'.format(comp))
-    for (k,v) in stack.pop().items():
-      if k not in stack[-1]:
-        # First time adding this element to dict.
-        stack[-1][k] = num*v
-      else:
-        # Increment number for this element.
-        stack[-1][k] += num*v
-  else:
-    print('Error - {:} is an invalid chemical formula.')
-    return
-  # Terminate or continue recursion.
-  if len(tail) > 0:
-    stack = rpc(tail,stack,nolp)
-    return stack
-  else:
-    if nolp > 0:
-      print('Error - unmatched left parenthesis in formula: {:}'.format(comp))
-      return
-    return stack
+  Cached version of parse_compound, returning an immutable tuple of (element,
+  count) pairs. Each formula is only parsed once.
+  '''
+  parsed = parse_cache.get(comp)
+  if parsed is None:
+    parsed = tuple(parse_formula(comp).items())
+    parse_cache.put(comp,parsed)
+  return parsed
+
+def parse_many(formulas,elements=None):
+  '''
+  Parses a list of chemical formulas and returns a tuple of (counts, elements),
+  where counts is a dense array with one row per formula and one column per
+  element. Elements are listed in order of first appearance, unless a list of
+  elements is specified (formulas with other elements then raise a ValueError).
+  '''
+  parsed = [parsed_compound(comp) for comp in formulas]
+  if elements is None:
+    elements = list(dict.fromkeys(k for atoms in parsed for (k,v) in atoms))
+  columns = {elem:j for (j,elem) in enumerate(elements)}
+  counts = np.zeros((len(parsed),len(elements)))
+  for (i,atoms) in enumerate(parsed):
+    for (k,v) in atoms:
+      if k not in columns:
+        raise ValueError('Element {:} of {:} is not in the element list.'.format(k,formulas[i]))
+      counts[i,columns[k]] = v
+  return counts, list(elements)
 
 # Method for getting molecular weight.
 def molecular_weight(comp,sram_lib):
@@ -213,11 +507,46 @@ def molecular_weight(comp,sram_lib):
   should be imported with the load_atomic_weights method, and modified as
   needed with the update_sram_lib method.
   '''
-  # Parse the compound.
-  atoms = parse_compound(comp)
+  return compile_formula(comp,sram_lib).weight
+
+# Method for compiling chemical formulas.
+def compile_formula(comp,sram_lib):
+  '''
+  Returns a CompiledFormula for the specified chemical compound, i.e., its
+  elements, an immutable array of element counts, and its molecular weight
+  computed with the specified sram_lib. Results are cached per formula and
+  SRAM library version (for SRAMLibrary objects only); see formula_cache_info.
+  Raises a ValueError if an element is missing from the sram_lib (nothing is
+  cached then).
+  '''
+  key = (comp,sram_version(sram_lib))
+  compiled = None if key[1] is None else formula_cache.get(key)
+  if compiled is None:
+    atoms = parsed_compound(comp)
+    weight = sum_atomic_weights(atoms,sram_lib)
+    if weight is None:
+      raise ValueError('Cannot compute the molecular weight of {:}: element missing from the SRAM library.'.format(comp))
+    counts = np.array([v for (k,v) in atoms],dtype=float)
+    counts.flags.writeable = False
+    compiled = CompiledFormula(comp,tuple(k for (k,v) in atoms),counts,weight)
+    if key[1] is not None:
+      formula_cache.put(key,compiled)
+  return compiled
+
+def formula_cache_info():
+  '''
+  Returns statistics for the parsed and compiled formula caches.
+  '''
+  return {'parse':parse_cache.info(),'formula':formula_cache.info()}
+
+def sum_atomic_weights(atoms,sram_lib):
+  '''
+  Helper for compile_formula; sums the atomic weights of the specified (element,
+  count) pairs. Returns None if an element is missing from the sram_lib.
+  '''
   # Loop over constituent atoms, summing up the molecular weight.
   mw = 0.0
-  for (k,v) in atoms.items():
+  for (k,v) in atoms:
     if k in sram_lib:
       if sram_lib[k]['SRAM']['Type'] in ['quantity','most_stable']:
         mw += sram_lib[k]['SRAM']['value']*v
@@ -290,8 +619,9 @@ def import_dataset(wdir,delimiter='\t'):
       # Return None to indicate canceled import.
       return None, None
   else:
-    # Read in file.
-    ds = pd.read_csv(path,delimiter,index_col=0)
+    # Read in file (pandas is only imported once a dataset is).
+    import pandas as pd
+    ds = pd.read_csv(path,sep=delimiter,index_col=0)
     # Clear the menu from stdout, then return dataset.
     clear_stdout_lines(lc)
     return os.path.splitext(fname)[0], ds
@@ -300,17 +630,20 @@ def import_dataset(wdir,delimiter='\t'):
 # To write later.
 
 # load_mineral_systems function.
-def load_mineral_systems(dir):
+@instrument.instrumented()
+def load_mineral_systems(dir,cache_path=None):
   '''
   Loads all mineral systems from the specified directory, and returns a
-  dictionary with the names of the mineral systems as the keys.
-  '''
-  systems = {}
-  mslist = glob.glob(os.path.join(dir,'*.minsys'))
-  for msf in mslist:
-    ms = MineralSystem(msf)
-    systems[ms.getSystemName()] = ms
-  return systems
+  MineralSystemRegistry (a read-only mapping) with the names of the mineral
+  systems as the keys.
+
+  Parsed systems are cached in a file (by default, mineral_systems.cache in the
+  same directory); only .minsys files changed since the cache was written are
+  parsed again.
+  '''
+  if cache_path is None:
+    cache_path = os.path.join(dir,'mineral_systems.cache')
+  return mineral_system.MineralSystemRegistry(dir,cache_path)
 
 # filter_mineral_systems function.
 def filter_mineral_systems(systems,hydrous_flag,silicate_flag):